@@ -1,31 +1,793 @@
-from flask import Flask, jsonify, render_template, request, redirect, url_for, flash, session
-from pymongo.mongo_client import MongoClient
+from flask import (
+    Flask, Response, g, jsonify, render_template, request, redirect, url_for, flash, session,
+    stream_with_context
+)
+from pymongo import DESCENDING, ReplaceOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from pymongo.server_api import ServerApi
 from bson.objectid import ObjectId  # To handle MongoDB ObjectIds
 import os
 import datetime
-import bcrypt
+import contextvars
+import threading
+import hashlib
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.middleware.proxy_fix import ProxyFix
+import click
 import requests
+from archive import archive_expenses
+from indexes import ensure_indexes, find_collscans
+from settlement import suggest_settlements
+from ledger import ARCHIVE_SUMMARY, batched, invalidate_snapshots, reconcile_balances
+from expense_import import detect_format, read_rows, split_inputs
+from expense_export import MIMETYPES, export_ledger
+from cache import LRUCache
+from passwords import PasswordHasher, PasswordHasherBusy, green_threads
+from metrics import Metrics, MongoCommandListener
+from mongo import LazyMongo, client_options
+from compression import IMMUTABLE_CACHE_CONTROL, StaticAssets, compress_response, negotiate_encoding
+from live_updates import OVERFLOW, Broker, BrokerFull, format_event
+from ratelimit import MemoryBackend, RateLimited, RateLimiter, parse_rate
+from splits import SplitError, balance_deltas, split_amount, to_cents
 
 load_dotenv()
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY")
 
-# MongoDB Connection
-uri = os.getenv("MONGO_URI")
-client = MongoClient(uri, server_api=ServerApi('1'))
-mydb = client[os.getenv("MONGO_DBNAME")]
-col_users = mydb["USERS"]
-col_groups = mydb["GROUPS"]
+# Behind a load balancer or reverse proxy, remote_addr is the proxy's. With
+# TRUSTED_PROXIES set to the number of proxies in front of the app, the client
+# address (which the rate limits key on) is read from X-Forwarded-For instead.
+TRUSTED_PROXIES = int(os.getenv("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
 
-# Test Connection
-try:
-    client.admin.command('ping')
-    print("Pinged your deployment. You successfully connected to MongoDB!")
-except Exception as e:
-    print(f"Error connecting to MongoDB: {e}")
+# Compiled templates persist on disk, so new workers skip compiling them
+# (`flask compile-templates` fills the cache ahead of time). Without
+# JINJA_CACHE_DIR, Jinja uses a private directory under the system temp dir.
+if os.getenv("JINJA_CACHE_DIR"):
+    os.makedirs(os.getenv("JINJA_CACHE_DIR"), exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.getenv("JINJA_CACHE_DIR") or None)
+
+# HTML and JSON responses of at least COMPRESS_MIN_SIZE bytes are gzip/brotli
+# compressed for clients that accept it. Static files are served under
+# content-hashed names from copies compressed once at startup.
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() != "false"
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "500"))
+static_assets = StaticAssets(app.static_folder)
+
+# Per-route latency and Mongo command counts, served at /metrics. Requests that
+# issue more than MONGO_COMMAND_WARN_THRESHOLD commands are logged (0 disables).
+metrics = Metrics(command_warn_threshold=int(os.getenv("MONGO_COMMAND_WARN_THRESHOLD", "25")))
+
+
+indexes_ready = threading.Event()
+
+
+def prepare_database(db):
+    """Runs in each process once its MongoDB client exists, and from /readyz until it succeeds."""
+    try:
+        ensure_indexes(db)
+        indexes_ready.set()
+    except Exception as e:
+        print(f"Error ensuring MongoDB indexes: {e}")
+
+
+# MongoDB Connection. The client is created on first use in each worker process
+# (after a pre-forking server has forked it), with pool settings from MONGO_*.
+mongo = LazyMongo(
+    os.getenv("MONGO_URI"),
+    os.getenv("MONGO_DBNAME"),
+    on_connect=prepare_database,
+    server_api=ServerApi('1'),
+    event_listeners=[MongoCommandListener(metrics)],
+    **client_options()
+)
+mydb = mongo.db()
+col_users = mongo.collection("USERS")
+col_groups = mongo.collection("GROUPS")
+col_expenses = mongo.collection("EXPENSES")
+col_archive = mongo.collection("EXPENSES_ARCHIVE")
+
+# Fields the group pickers and summaries need; leaves the expenses array behind
+GROUP_SUMMARY_PROJECTION = ["group_name", "group_members", "balances", "version"]
+
+# Rows written per bulk operation by the expense import
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "500"))
+
+# Ledger entries fetched per cursor round trip and sent per chunk by the export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+
+# archive-expenses moves ledger entries older than this, or behind a point where
+# every balance was zero, to EXPENSES_ARCHIVE
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "365"))
+
+# Expenses are listed newest first, one page at a time
+EXPENSES_PAGE_SIZE = 20
+EXPENSE_SORT = [("created_at", DESCENDING), ("_id", DESCENDING)]
+
+# Group summaries and formatted expense pages, invalidated by every write to a group
+group_cache = LRUCache(
+    maxsize=int(os.getenv("GROUP_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("GROUP_CACHE_TTL", "30")),
+    enabled=os.getenv("GROUP_CACHE_ENABLED", "true").lower() != "false"
+)
+
+# Rendered expense-list HTML, keyed by group version so a write never serves a
+# stale fragment; the TTL only bounds memory for versions no one asks for again
+fragment_cache = LRUCache(
+    maxsize=int(os.getenv("FRAGMENT_CACHE_SIZE", "512")),
+    ttl=float(os.getenv("FRAGMENT_CACHE_TTL", "600")),
+    enabled=os.getenv("FRAGMENT_CACHE_ENABLED", "true").lower() != "false"
+)
+
+# Short-lived "does this username exist" answers for the create-group member checks
+user_exists_cache = LRUCache(
+    maxsize=int(os.getenv("USER_EXISTS_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("USER_EXISTS_CACHE_TTL", "10")),
+    enabled=os.getenv("USER_EXISTS_CACHE_ENABLED", "true").lower() != "false"
+)
+MAX_USERNAME_BATCH = 100
+
+# Each user's groups_version, which changes whenever their group list does. The
+# session keeps a copy of the user's identity and groups stamped with it.
+user_version_cache = LRUCache(
+    maxsize=int(os.getenv("USER_VERSION_CACHE_SIZE", "4096")),
+    ttl=float(os.getenv("USER_VERSION_CACHE_TTL", "5")),
+    enabled=os.getenv("USER_VERSION_CACHE_ENABLED", "true").lower() != "false"
+)
+# Longer group lists stay out of the session cookie, which browsers cap at about 4 KB
+SESSION_MAX_GROUPS = int(os.getenv("SESSION_MAX_GROUPS", "50"))
+CURRENT_USER_PROJECTION = ["name", "groups", "groups_version"]
+
+# Independent lookups within one request run side by side on this pool. Under the
+# gevent server (serve_async.py) its threads are greenlets.
+lookup_pool = ThreadPoolExecutor(max_workers=int(os.getenv("LOOKUP_POOL_SIZE", "16")))
+
+# Request threads per gunicorn gthread worker (gunicorn.conf.py). A request that
+# waits, on bcrypt for example, holds one of them. Under gevent every request
+# gets its own greenlet, so waiting is cheap.
+REQUEST_THREADS = None if green_threads() else int(os.getenv("GUNICORN_THREADS", "4"))
+
+# Live group streams (see the broker below) each hold a request thread for
+# minutes at a time, so by default they get at most half of them
+LIVE_UPDATES_MAX_STREAMS = int(os.getenv(
+    "LIVE_UPDATES_MAX_STREAMS", str(REQUEST_THREADS // 2 if REQUEST_THREADS else 1000)
+))
+
+# bcrypt runs on its own bounded pool so a login burst can't take every request
+# thread: with threads, hashing plus waiting callers get what the streams leave,
+# less one that always stays free for everything else
+BCRYPT_SLOTS = max(1, REQUEST_THREADS - 1 - LIVE_UPDATES_MAX_STREAMS) if REQUEST_THREADS else None
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(min(os.cpu_count() or 1, BCRYPT_SLOTS or math.inf))))
+password_hasher = PasswordHasher(
+    workers=BCRYPT_WORKERS,
+    max_queue=int(os.getenv("BCRYPT_MAX_QUEUE", str(max(0, BCRYPT_SLOTS - BCRYPT_WORKERS) if BCRYPT_SLOTS else 16))),
+    rounds=int(os.getenv("BCRYPT_ROUNDS", "12"))
+)
+PASSWORD_RETRY_AFTER = os.getenv("BCRYPT_RETRY_AFTER", "2")
+
+# Token-bucket limits on signing in, signing up and username checks, applied
+# before any bcrypt or database work. Each RATE_LIMIT_<NAME> is "requests/seconds".
+rate_limit_backend = MemoryBackend(maxsize=int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000")))
+RATE_LIMITS_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() != "false"
+RATE_LIMIT_DEFAULTS = {
+    "login_ip": "20/60",
+    "login_user": "5/60",
+    "registration_ip": "5/300",
+    "check_user_ip": "60/60",
+}
+rate_limiters = {
+    name: RateLimiter(
+        name, *parse_rate(os.getenv(f"RATE_LIMIT_{name.upper()}", default)),
+        backend=rate_limit_backend, enabled=RATE_LIMITS_ENABLED
+    )
+    for name, default in RATE_LIMIT_DEFAULTS.items()
+}
+
+# Open group pages follow writes over Server-Sent Events. Writes publish to the
+# group's streams in this process; a stream more than LIVE_UPDATES_QUEUE_SIZE
+# events behind gets a fresh snapshot instead of the backlog. Pages past
+# LIVE_UPDATES_MAX_STREAMS fall back to reloading.
+broker = Broker(
+    queue_size=int(os.getenv("LIVE_UPDATES_QUEUE_SIZE", "64")),
+    max_subscribers=LIVE_UPDATES_MAX_STREAMS
+)
+# Idle streams send a keepalive this often, after checking for writes made by other workers
+LIVE_UPDATES_POLL_SECONDS = float(os.getenv("LIVE_UPDATES_POLL_SECONDS", "15"))
+# Streams end after this long and the browser reconnects, so none holds a worker forever
+LIVE_UPDATES_MAX_SECONDS = float(os.getenv("LIVE_UPDATES_MAX_SECONDS", "300"))
+LIVE_UPDATE_FIELDS = ["version", "balances"]
+
+
+def load_group_summaries(group_ids, versions=None):
+    """Fetch all of a user's groups in the order they were given.
+
+    Cached summaries are used where available; the rest come from one $in query.
+    With ``versions`` ({group_id: version}), a cached summary older than the
+    version given (written through another worker, say) is fetched again.
+    """
+    groups_by_id = {}
+    missing = []
+    for group_id in group_ids:
+        group = group_cache.get(("summary", group_id))
+        if group is None or (versions and group.get("version", 0) < versions.get(group_id, 0)):
+            missing.append(group_id)
+        else:
+            groups_by_id[group_id] = group
+
+    if missing:
+        for group in col_groups.find({"_id": {"$in": missing}}, GROUP_SUMMARY_PROJECTION):
+            group_cache.set(("summary", group["_id"]), group)
+            groups_by_id[group["_id"]] = group
+    return [groups_by_id[group_id] for group_id in group_ids if group_id in groups_by_id]
+
+
+def remember_user(user):
+    """Keep a user loaded from the database, minus the password hash, in the session."""
+    cached = {
+        "_id": str(user["_id"]),
+        "name": user["name"],
+        "groups": user.get("groups", []),
+        "groups_version": user.get("groups_version", 0)
+    }
+    user_version_cache.set(cached["name"], cached["groups_version"])
+    if len(cached["groups"]) <= SESSION_MAX_GROUPS:
+        session["user"] = cached
+    else:
+        session.pop("user", None)
+    return cached
+
+
+def current_user():
+    """The logged-in user's id, name and group ids, loaded at most once per request.
+
+    The session's copy is used while the version cache says its groups_version is
+    current. Otherwise the user is read again, without the password hash, and that
+    one read both checks and replaces the copy. None if nobody is logged in or the
+    account is gone.
+    """
+    if "current_user" in g:
+        return g.current_user
+
+    user = None
+    username = session.get("username")
+    if username:
+        cached = session.get("user")
+        if cached and cached["name"] == username and cached["groups_version"] == user_version_cache.get(username):
+            user = cached
+        else:
+            loaded = col_users.find_one({"name": username}, CURRENT_USER_PROJECTION)
+            user = remember_user(loaded) if loaded else None
+    g.current_user = user
+    return user
+
+
+def load_balance_dashboard(username):
+    """The user's own balance in each of their groups, plus totals, from one aggregation.
+
+    Only the user's entry of each group's balances leaves the database; member
+    lists and expenses are never read.
+    """
+    balance = {"$ifNull": [f"$balances.{username}", 0]}
+    pipeline = [
+        {"$match": {"group_members": username}},
+        {"$project": {"group_name": 1, "balance": balance}},
+        {"$sort": {"group_name": 1}},
+        {"$facet": {
+            "groups": [],
+            "totals": [{"$group": {
+                "_id": None,
+                "owed": {"$sum": {"$cond": [{"$gt": ["$balance", 0]}, "$balance", 0]}},
+                "owes": {"$sum": {"$cond": [{"$lt": ["$balance", 0]}, "$balance", 0]}}
+            }}]
+        }}
+    ]
+    result = next(iter(col_groups.aggregate(pipeline)), {"groups": [], "totals": []})
+    totals = next(iter(result["totals"]), {"owed": 0, "owes": 0})
+    return {
+        "groups": [
+            {"group_id": group["_id"], "group_name": group["group_name"], "balance": round(group["balance"], 2)}
+            for group in result["groups"]
+        ],
+        "owed": round(totals["owed"], 2),
+        "owes": round(-totals["owes"], 2),
+        "net": round(totals["owed"] + totals["owes"], 2)
+    }
+
+
+def run_concurrently(*calls):
+    """Run independent zero-argument lookups at the same time and return their results in order."""
+    # Each call carries the request's context so its Mongo commands are counted against it
+    futures = [lookup_pool.submit(contextvars.copy_context().run, call) for call in calls]
+    return [future.result() for future in futures]
+
+
+def add_group_to_members(group):
+    # $addToSet keeps the fan-out safe to repeat when finishing a pending group
+    col_users.update_many(
+        {"name": {"$in": group["group_members"]}},
+        {"$addToSet": {"groups": group["_id"]}, "$inc": {"groups_version": 1}}
+    )
+    for member in group["group_members"]:
+        user_version_cache.delete(member)
+    col_groups.update_one({"_id": group["_id"]}, {"$unset": {"pending": ""}})
+
+
+def insert_group_with_members(group):
+    """Insert a group and add it to every member's group list in a fixed number of writes.
+
+    The group is written first and marked pending until the fan-out finishes, so a
+    user can never point at a group that doesn't exist. If a worker dies in
+    between, complete_pending_groups() finishes the job.
+    """
+    col_groups.insert_one({**group, "pending": True})
+    invalidate_group(group["_id"])
+    add_group_to_members(group)
+
+
+def complete_pending_groups(min_age=datetime.timedelta(minutes=5)):
+    """Finish the member fan-out of groups whose creation was interrupted."""
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - min_age
+    completed = []
+    for group in col_groups.find({"pending": True}, {"group_members": 1}):
+        # Group ids are ObjectIds, so they carry their creation time
+        if ObjectId(group["_id"]).generation_time <= cutoff:
+            add_group_to_members(group)
+            completed.append(group["_id"])
+    return completed
+
+
+def invalidate_group(group_id):
+    """Drop the cached summary, expense pages and fragments of a group after writing to it."""
+    group_cache.delete_where(lambda key: key[1] == group_id)
+    fragment_cache.delete_where(lambda key: key[0] == group_id)
+
+
+def render_expense_list(group_id, version, before=None):
+    """The group-details expense list and pagination as HTML, cached per group version."""
+    key = (group_id, version, before)
+    html = fragment_cache.get(key)
+    if html is None:
+        expenses, next_cursor = format_expense_page(group_id, before=before, version=version)
+        html = Markup(render_template(
+            'expense-list.html', expenses=expenses, group_id=group_id, before=before, next_cursor=next_cursor
+        ))
+        fragment_cache.set(key, html)
+    return html
+
+
+def format_expense_page(group_id, before=None, version=None):
+    """One page of a group's expenses, formatted for group-details.html.
+
+    Pages are cached per group ``version``, so a write made through another
+    worker, which this worker's cache never hears about, can't be served stale
+    to a caller that has already seen the new version.
+    """
+    key = ("expenses", group_id, version, before)
+    cached = group_cache.get(key)
+    if cached is not None:
+        return cached
+
+    expenses, next_cursor = list_group_expenses(group_id, before=before)
+
+    page = ([format_expense(expense) for expense in expenses], next_cursor)
+    group_cache.set(key, page)
+    return page
+
+
+def format_expense(expense):
+    """An expense or settlement as expense-list.html (and the live updates) show it."""
+    if expense.get("kind") == ARCHIVE_SUMMARY:
+        return {
+            "expense_id": expense["_id"],
+            "kind": ARCHIVE_SUMMARY,
+            "description": expense.get("description"),
+            "amount": expense.get("amount"),
+            "entries": expense.get("entries", 0),
+            "first_date": expense["first_created_at"].strftime("%Y-%m-%d"),
+            "last_date": expense["created_at"].strftime("%Y-%m-%d")
+        }
+
+    paid_by_name = expense.get("paid_by", "Unknown")  # Paid_by is stored as name directly
+    split_among = expense.get("split_among", {})
+
+    split_among_detailed = [
+        {"name": name, "amount": share}
+        for name, share in split_among.items()
+    ]
+
+    return {
+        "expense_id": expense["_id"],
+        "kind": expense.get("kind", "expense"),
+        "description": expense.get("description"),
+        "amount": expense.get("amount"),
+        "paid_by": paid_by_name,
+        "split_among": split_among_detailed
+    }
+
+
+def encode_expense_cursor(expense):
+    """Turn the last expense on a page into an opaque cursor for the next page."""
+    created_ms = int((expense["created_at"] - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+    return f"{created_ms}_{expense['_id']}"
+
+
+def decode_expense_cursor(cursor):
+    """The (created_at, _id) in a cursor; ValueError if encode_expense_cursor didn't make it."""
+    created_ms, _, expense_id = cursor.partition("_")
+    try:
+        created_at = datetime.datetime(1970, 1, 1) + datetime.timedelta(milliseconds=int(created_ms))
+    except (ValueError, OverflowError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    if not expense_id:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return created_at, expense_id
+
+
+def valid_expense_cursor(cursor):
+    try:
+        decode_expense_cursor(cursor)
+    except ValueError:
+        return False
+    return True
+
+
+def list_group_expenses(group_id, before=None, limit=EXPENSES_PAGE_SIZE):
+    """Return one page of a group's expenses (newest first) and the cursor for the next page.
+
+    Pages are fetched by seeking past the previous page's last (created_at, _id) on the
+    group_id index, so every page costs the same however long the group's history is.
+    """
+    return page_expenses(col_expenses, {"group_id": group_id}, before, limit)
+
+
+def list_archived_expenses(group_id, archive_id, before=None, limit=EXPENSES_PAGE_SIZE):
+    """One page of the entries an archive summary stands for, paged like list_group_expenses."""
+    return page_expenses(col_archive, {"archive_id": archive_id, "group_id": group_id}, before, limit)
+
+
+def page_expenses(collection, query, before, limit):
+    if before:
+        created_at, expense_id = decode_expense_cursor(before)
+        query["$or"] = [
+            {"created_at": {"$lt": created_at}},
+            {"created_at": created_at, "_id": {"$lt": expense_id}}
+        ]
+
+    page = list(collection.find(query).sort(EXPENSE_SORT).limit(limit + 1))
+    next_cursor = encode_expense_cursor(page[limit - 1]) if len(page) > limit else None
+    return page[:limit], next_cursor
+
+
+def current_timestamp():
+    # Mongo keeps milliseconds, so truncate up front to keep cursors exact
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def expense_balance_cents(expense):
+    """Each member's balance change from an expense, in cents."""
+    # Summed in cents so the payer's credit is exactly what the others owe. The payer
+    # is always present, so the $inc is never empty when they covered the whole expense.
+    shares = {member: to_cents(share) for member, share in expense["split_among"].items()}
+    return balance_deltas(expense["paid_by"], shares)
+
+
+def balance_increments(cents, sign=1):
+    """The $inc document for balance changes given in cents."""
+    return {f"balances.{member}": sign * amount / 100 for member, amount in cents.items()}
+
+
+def expense_balance_deltas(expense, reverse=False):
+    """Build the $inc document that applies (or, with reverse, undoes) an expense."""
+    return balance_increments(expense_balance_cents(expense), -1 if reverse else 1)
+
+
+class ExpenseError(ValueError):
+    """A problem with an expense or payment that the user has to fix; shown to them as-is."""
+
+    def __init__(self, message, category="error"):
+        super().__init__(message)
+        self.category = category
+
+
+def bump_version(update):
+    """Add the version bump and modification time that every write to a group carries."""
+    update.setdefault("$inc", {})["version"] = 1
+    update.setdefault("$set", {})["updated_at"] = current_timestamp()
+    return update
+
+
+def update_group_balances(query, deltas):
+    """Apply balance deltas with a version bump; returns the updated group, or None if none matched.
+
+    The new version and balances are only read back when a live stream is
+    waiting for them; otherwise just the group's _id is returned.
+    """
+    update = bump_version({"$inc": dict(deltas)})
+    if broker.has_subscribers(query["_id"]):
+        return col_groups.find_one_and_update(
+            query, update, projection=LIVE_UPDATE_FIELDS, return_document=ReturnDocument.AFTER
+        )
+    result = col_groups.update_one(query, update)
+    return {"_id": query["_id"]} if result.matched_count else None
+
+
+def publish_group_update(group, name, expense, deltas):
+    """Tell the group's live streams in this process about a write.
+
+    ``group`` is the version and balances after the write; ``deltas`` is the $inc
+    it applied. Costs nothing when no one has the group open.
+    """
+    if "version" not in group or not broker.has_subscribers(group["_id"]):
+        return
+    balances = group.get("balances", {})
+    broker.publish(group["_id"], {
+        "name": name,
+        "version": group.get("version", 0),
+        "balances": balances,
+        "changes": {key.split(".", 1)[1]: round(delta, 2) for key, delta in deltas.items() if delta},
+        "settlements": suggest_settlements(balances),
+        "expense": format_expense(expense)
+    })
+
+
+def build_expense(group_id, description, amount, paid_by, split_with, values, mode="percentage"):
+    """Validate an expense's split and build its document; membership is checked by the caller.
+
+    ``mode`` is one of splits.MODES and ``values`` holds its percentages, shares or
+    exact amounts. Shares are worked out in cents and always add up to the amount.
+    """
+    try:
+        total = to_cents(amount)
+        shares = split_amount(total, split_with, mode, values)
+    except SplitError as e:
+        raise ExpenseError(str(e))
+
+    split_among = {member: share / 100 for member, share in zip(split_with, shares)}
+
+    # Create expense document
+    expense = {
+        "_id": str(ObjectId()),
+        "group_id": group_id,
+        "description": description,
+        "amount": total / 100,
+        "paid_by": paid_by,
+        "split_among": split_among,
+        "created_at": current_timestamp()
+    }
+    return expense
+
+
+def record_expense(group_id, description, amount, paid_by, split_with, values, mode="percentage", recorded_by=None):
+    """Validate and store an expense and apply it to the group's balances.
+
+    With ``recorded_by``, the user adding the expense must belong to the group too.
+    """
+    expense = build_expense(group_id, description, amount, paid_by, split_with, values, mode)
+
+    # The ledger entry goes in before the version bump, so an expense page read
+    # at the new version always has it. The balance update only matches if
+    # everyone involved belongs to the group, so it doubles as validation.
+    col_expenses.insert_one(expense)
+    deltas = expense_balance_deltas(expense)
+    group = update_group_balances(
+        {"_id": group_id, "group_members": {"$all": [paid_by, *split_with, *filter(None, [recorded_by])]}}, deltas
+    )
+    if group is None:
+        col_expenses.delete_one({"_id": expense["_id"]})
+        # A page read in between may have been cached with the expense in it
+        col_groups.update_one({"_id": group_id}, bump_version({}))
+        invalidate_group(group_id)
+        raise ValueError("group not found or members are not part of it")
+
+    invalidate_group(group_id)
+    publish_group_update(group, "expense_added", expense, deltas)
+    return expense
+
+
+def import_expenses(group, rows, batch_size=IMPORT_BATCH_SIZE):
+    """Store the valid rows of an import in batches and yield an outcome for every row.
+
+    ``rows`` yields ``(row_number, fields or error)`` as expense_import.read_rows does.
+    Each batch costs one $inc of the combined balance deltas and one insert_many, and
+    only one batch is held in memory however long the file is. Outcomes are yielded
+    in row order once their batch is written.
+    """
+    members = set(group["group_members"])
+    for batch in batched(rows, batch_size):
+        outcomes = []
+        expenses = []
+        deltas = {}
+        for number, fields in batch:
+            try:
+                if isinstance(fields, Exception):
+                    raise fields
+                expense = build_expense(group["_id"], *fields)
+                if not members.issuperset([expense["paid_by"], *expense["split_among"]]):
+                    raise ExpenseError("Members are not part of the group.")
+            except ValueError as e:
+                outcomes.append({"row": number, "ok": False, "message": str(e)})
+                continue
+            for member, cents in expense_balance_cents(expense).items():
+                deltas[member] = deltas.get(member, 0) + cents
+            expenses.append(expense)
+            outcomes.append({"row": number, "ok": True, "expense_id": expense["_id"]})
+
+        if expenses:
+            # Same order as record_expense: the ledger entries, then the balances and version
+            col_expenses.insert_many(expenses)
+            col_groups.update_one({"_id": group["_id"]}, bump_version({"$inc": balance_increments(deltas)}))
+            invalidate_group(group["_id"])
+            # Too many rows to send one by one; open pages reload the group instead
+            broker.publish(group["_id"], {"name": "changed"})
+        yield from outcomes
+
+
+def remove_expense(expense_id):
+    """Delete an expense and reverse its effect on balances; None if it doesn't exist."""
+    # Only the request that actually deletes the expense reverses its balances.
+    # Archive summaries aren't expenses and can't be deleted.
+    expense = col_expenses.find_one_and_delete({"_id": expense_id, "kind": {"$ne": ARCHIVE_SUMMARY}})
+    if not expense:
+        return None
+
+    deltas = expense_balance_deltas(expense, reverse=True)
+    group = update_group_balances({"_id": expense["group_id"]}, deltas)
+    invalidate_snapshots(mydb, expense)
+    invalidate_group(expense["group_id"])
+    if group:
+        publish_group_update(group, "expense_deleted", expense, deltas)
+    return expense
+
+
+def record_settlement(group_id, username, payment_amount):
+    """Pay ``username``'s debt in a group to its creditors and record it in the ledger."""
+    if payment_amount <= 0:
+        raise ExpenseError("Payment amount must be greater than zero.")
+
+    group = col_groups.find_one({"_id": group_id}, {"balances": 1})
+    if not group:
+        raise ExpenseError("Group not found.")
+
+    balances = group["balances"]
+    if balances[username] >= 0:
+        raise ExpenseError("You have no outstanding balance to settle.", category="info")
+
+    remaining_debt = abs(balances[username])
+    if payment_amount >= remaining_debt:
+        payment_amount = remaining_debt
+
+    # Pay creditors in turn; the settlement is recorded in the ledger like an
+    # expense paid by the debtor and split among the creditors it went to
+    paid_to = {}
+    creditors = [name for name, balance in balances.items() if balance > 0]
+    remaining_payment = payment_amount
+    for creditor in creditors:
+        if remaining_payment <= 0:
+            break
+        pay_to_creditor = min(balances[creditor], remaining_payment)
+        paid_to[creditor] = pay_to_creditor
+        remaining_payment -= pay_to_creditor
+
+    settlement_entry = {
+        "_id": str(ObjectId()),
+        "group_id": group["_id"],
+        "kind": "settlement",
+        "description": "Settlement payment",
+        "amount": payment_amount,
+        "paid_by": username,
+        "split_among": paid_to,
+        "created_at": current_timestamp()
+    }
+    deltas = expense_balance_deltas(settlement_entry)
+    col_expenses.insert_one(settlement_entry)
+    group = update_group_balances({"_id": group["_id"]}, deltas)
+    invalidate_group(group["_id"])
+    publish_group_update(group, "settlement", settlement_entry, deltas)
+    return settlement_entry
+
+
+def migrate_embedded_expenses():
+    """Move expenses still embedded in GROUPS documents into the EXPENSES collection.
+
+    Safe to re-run: expenses are upserted by id before the embedded array is removed.
+    """
+    migrated = 0
+    for group in col_groups.find({"expenses.0": {"$exists": True}}, {"expenses": 1}):
+        operations = []
+        for expense in group["expenses"]:
+            expense_id = expense.get("expense_id") or str(ObjectId())
+            created_at = expense.get("created_at")
+            if created_at is None and ObjectId.is_valid(expense_id):
+                created_at = ObjectId(expense_id).generation_time.replace(tzinfo=None)
+            operations.append(ReplaceOne({"_id": expense_id}, {
+                "_id": expense_id,
+                "group_id": group["_id"],
+                "description": expense.get("description"),
+                "amount": expense.get("amount"),
+                "paid_by": expense.get("paid_by"),
+                "split_among": expense.get("split_among", {}),
+                "created_at": created_at or current_timestamp()
+            }, upsert=True))
+
+        col_expenses.bulk_write(operations, ordered=False)
+        col_groups.update_one({"_id": group["_id"]}, bump_version({"$unset": {"expenses": ""}}))
+        migrated += len(operations)
+    return migrated
+
+
+@app.cli.command("migrate-expenses")
+def migrate_expenses_command():
+    """Move embedded group expenses into the EXPENSES collection."""
+    migrated = migrate_embedded_expenses()
+    print(f"Migrated {migrated} expenses into EXPENSES.")
+
+
+@app.cli.command("ensure-indexes")
+def ensure_indexes_command():
+    """Create any missing indexes the app relies on."""
+    created = ensure_indexes(mydb)
+    print(f"Indexes in place: {', '.join(created)}")
+
+
+@app.cli.command("check-indexes")
+def check_indexes_command():
+    """Report query shapes whose plan falls back to a collection scan."""
+    collscans = find_collscans(mydb)
+    for collection, query, sort in collscans:
+        print(f"COLLSCAN on {collection}: filter={query} sort={sort}")
+    if collscans:
+        raise SystemExit(1)
+    print("All query shapes use an index.")
+
+
+@app.cli.command("repair-groups")
+def repair_groups_command():
+    """Finish adding interrupted new groups to their members' group lists."""
+    completed = complete_pending_groups()
+    print(f"Completed {len(completed)} pending groups.")
+
+
+@app.cli.command("compile-templates")
+def compile_templates_command():
+    """Compile every template into the Jinja bytecode cache."""
+    app.jinja_env.cache.clear()
+    for name in app.jinja_env.list_templates(extensions=["html"]):
+        app.jinja_env.get_template(name)
+    print(f"Compiled templates into {app.jinja_env.bytecode_cache.directory}")
+
+
+@app.cli.command("reconcile-balances")
+def reconcile_balances_command():
+    """Check every group's balances against its ledger and checkpoint them."""
+    drifted = reconcile_balances(mydb)
+    for group in drifted:
+        print(f"Group {group['group_id']} drifted: stored={group['stored']} expected={group['expected']}")
+    if drifted:
+        raise SystemExit(1)
+    print("All group balances match their ledgers.")
+
+
+@app.cli.command("archive-expenses")
+@click.option("--days", type=int, default=ARCHIVE_AFTER_DAYS, show_default=True,
+              help="Archive entries older than this many days.")
+def archive_expenses_command(days):
+    """Move old and settled ledger entries to EXPENSES_ARCHIVE, leaving a summary row per batch."""
+    summaries = archive_expenses(mydb, datetime.timedelta(days=days))
+    for summary in summaries:
+        # The group's expense list changed, so cached pages and fragments must go
+        col_groups.update_one({"_id": summary["group_id"]}, bump_version({}))
+        invalidate_group(summary["group_id"])
+    archived = sum(summary["entries"] for summary in summaries)
+    print(f"Archived {archived} entries from {len(summaries)} groups.")
 
 
 @app.route('/')
@@ -39,7 +801,9 @@ def home():
         flash("Not logged in. Please log in first", "error")
         return redirect(url_for("login"))
 
-    return render_template('home.html', username=session['username'])
+    return render_template(
+        'home.html', username=session['username'], dashboard=load_balance_dashboard(session['username'])
+    )
 
 
 @app.route('/groups')
@@ -48,33 +812,65 @@ def groups():
         flash("Not logged in. Please log in first", "error")
         return redirect(url_for("login"))
 
-    username = session['username']
-    user = col_users.find_one({"name": username})
+    user = current_user()
     if not user:
         flash("User not found.", "error")
         return redirect(url_for("home"))
 
-    user_groups = user.get("groups", [])
+    user_groups = user["groups"]
     group_details = []
 
     # Fetch group details
-    for group_id in user_groups:
-        group = col_groups.find_one({"_id": group_id})
-        if group:
-            group_details.append({
-                "group_name": group["group_name"],
-                "group_members": group["group_members"],
-                "balances": group["balances"],
-                "group_id": group["_id"]
-            })
+    for group in load_group_summaries(user_groups):
+        group_details.append({
+            "group_name": group["group_name"],
+            "group_members": group["group_members"],
+            "balances": group["balances"],
+            "group_id": group["_id"]
+        })
 
     return render_template('groups.html', groups=group_details)
 
+def existing_usernames(usernames):
+    """Map each username to whether an account exists.
+
+    Cached answers are used where available; the rest come from one projected $in query.
+    """
+    results = {}
+    missing = []
+    for username in usernames:
+        exists = user_exists_cache.get(username)
+        if exists is None:
+            missing.append(username)
+        else:
+            results[username] = exists
+
+    if missing:
+        found = {user["name"] for user in col_users.find({"name": {"$in": missing}}, {"name": 1, "_id": 0})}
+        for username in missing:
+            results[username] = username in found
+            user_exists_cache.set(username, results[username])
+    return results
+
+
 @app.route('/check-user')
 def check_user():
+    rate_limiters["check_user_ip"].hit(request.remote_addr)
     username = request.args.get('username')
-    user = col_users.find_one({"name": username})
-    return {"exists": bool(user)}
+    return {"exists": existing_usernames([username])[username]}
+
+
+@app.route('/check-users', methods=['POST'])
+def check_users():
+    rate_limiters["check_user_ip"].hit(request.remote_addr)
+    usernames = (request.get_json(silent=True) or {}).get("usernames")
+    if not isinstance(usernames, list) or not all(isinstance(name, str) for name in usernames):
+        return jsonify({'success': False, 'message': 'Expected a list of usernames'}), 400
+    if len(usernames) > MAX_USERNAME_BATCH:
+        return jsonify({'success': False, 'message': f'At most {MAX_USERNAME_BATCH} usernames per request'}), 400
+
+    usernames = list(dict.fromkeys(name.strip() for name in usernames if name.strip()))
+    return jsonify({"exists": existing_usernames(usernames)})
 
 @app.route('/create-group', methods=["GET", "POST"])
 def create_group():
@@ -86,26 +882,24 @@ def create_group():
         group_name = request.form.get("group_name")
         members = request.form.get("members").split(",")  # Split usernames by commas
 
-        # Fetch user IDs for members
-        member_objects = []
-        balances = {}
-        member_names = []
-        for member_name in members:
-            user = col_users.find_one({"name": member_name.strip()})
-            if user:
-                member_objects.append({"user_id": user["_id"], "name": user["name"]})
-                member_names.append(user["name"])
-#                balances[user["name"]] = 0
-
-            else:
-                flash(f"User '{member_name.strip()}' does not exist.", "error")
+        # Look up every listed member, plus the current user, in one query
+        requested = list(dict.fromkeys(member_name.strip() for member_name in members))
+        found = {
+            user["name"]
+            for user in col_users.find({"name": {"$in": requested + [session['username']]}}, {"name": 1})
+        }
+        for member_name in requested:
+            if unsafe_username(member_name):
+                flash(f"User '{member_name}' can't be added to a group.", "error")
+                return redirect(url_for("create_group"))
+            if member_name not in found:
+                flash(f"User '{member_name}' does not exist.", "error")
                 return redirect(url_for("create_group"))
 
         # Ensure the current user is also added to the group
-        current_user = col_users.find_one({"name": session['username']})
-        if current_user and current_user["name"] not in member_names:
-            member_objects.append({"user_id": current_user["_id"], "name": current_user["name"]})
-            member_names.append(current_user["name"])
+        member_names = requested
+        if session['username'] in found and session['username'] not in member_names:
+            member_names.append(session['username'])
 
         # Create the group with a 2D array for group members
         new_group = {
@@ -113,17 +907,10 @@ def create_group():
             "group_name": group_name,
             "group_members": member_names,
             "balances": {name: 0 for name in member_names},
-            "expenses": []
+            "version": 1,
+            "updated_at": current_timestamp()
         }
-
-        col_groups.insert_one(new_group)
-
-        # Add the group ID to each member's group list
-        for member_name in member_names:
-            col_users.update_one(
-                {"name": member_name},
-                {"$push": {"groups": str(new_group["_id"])}}
-                                 )
+        insert_group_with_members(new_group)
 
         flash(f"Group '{group_name}' created successfully!", "success")
         return redirect(url_for("groups"))
@@ -138,43 +925,29 @@ def group_details(group_id):
         return redirect(url_for("login"))
 
     try:
-        # Fetch group details
-        group = col_groups.find_one({"_id": group_id})
-        if not group:
+        # The summary carries the group's version, which picks the cached expense list
+        before = request.args.get("before")
+        if before and not valid_expense_cursor(before):
+            before = None
+        group = next(iter(load_group_summaries([group_id])), None)
+        if not group or session['username'] not in group.get("group_members", []):
             flash("Group not found.", "error")
             return redirect(url_for("groups"))
 
         # Format group members (name and balance)
         group_name = group.get("group_name", "Unnamed Group")
         group_members = group.get("group_members", [])
-        balances = group.get("balances", [])
-        expenses = group.get("expenses", [])
-
-        # Format expenses (paid_by and split_among)
-        detailed_expenses = []
-        for expense in group.get("expenses", []):
-            paid_by_name = expense.get("paid_by", "Unknown")  # Paid_by is stored as name directly
-            split_among = expense.get("split_among", {})
-
-            split_among_detailed = [
-                {"name": name, "amount": share}
-                for name, share in split_among.items()
-            ]
-
-            detailed_expenses.append({
-                "expense_id": expense.get("expense_id"),
-                "description": expense.get("description"),
-                "amount": expense.get("amount"),
-                "paid_by": paid_by_name,
-                "split_among": split_among_detailed
-            })
+        balances = group.get("balances", {})
 
         return render_template(
             'group-details.html',
+            group_id=group_id,
+            before=before,
             group_name=group_name,
             group_members=group_members,
             balances=balances,
-            expenses=detailed_expenses
+            expense_list=render_expense_list(group_id, group.get("version", 0), before),
+            settlements=suggest_settlements(balances)
         )
 
     except Exception as e:
@@ -183,6 +956,140 @@ def group_details(group_id):
 
 
 
+@app.route('/group/<group_id>/archive/<archive_id>')
+def archived_expenses(group_id, archive_id):
+    """The entries behind an archive summary, as HTML the group page loads when asked."""
+    if 'username' not in session:
+        return "Not logged in", 401
+    if not member_group_version(group_id, session['username']):
+        return "Group not found", 404
+
+    before = request.args.get("before")
+    if before and not valid_expense_cursor(before):
+        return "Invalid cursor", 400
+    expenses, next_cursor = list_archived_expenses(group_id, archive_id, before=before)
+    return render_template(
+        'archived-expenses.html',
+        expenses=[format_expense(expense) for expense in expenses],
+        group_id=group_id,
+        archive_id=archive_id,
+        next_cursor=next_cursor
+    )
+
+
+@app.route('/cache-stats')
+def cache_stats():
+    return jsonify(group_cache.stats())
+
+
+@app.route('/rate-limit-stats')
+def rate_limit_stats():
+    return jsonify({name: limiter.stats() for name, limiter in rate_limiters.items()})
+
+
+@app.route('/live-stats')
+def live_stats():
+    return jsonify(broker.stats())
+
+
+@app.route('/group/<group_id>/settlements')
+def group_settlements(group_id):
+    if 'username' not in session:
+        return jsonify({'success': False, 'message': 'Not logged in'}), 401
+
+    # Same membership check as member_group_version, reading the balances in the same query
+    group = col_groups.find_one({"_id": group_id, "group_members": session['username']}, ["balances"])
+    if not group:
+        return jsonify({'success': False, 'message': 'Group not found'}), 404
+
+    return jsonify({
+        'success': True,
+        'group_id': group_id,
+        'settlements': suggest_settlements(group.get("balances", {}))
+    })
+
+
+def group_snapshot(group_id, since):
+    """A "snapshot" event with the group's balances and newest expenses if its version is past ``since``.
+
+    Returns ``(version, event or None)``, or None if the group is gone.
+    """
+    group = col_groups.find_one({"_id": group_id}, LIVE_UPDATE_FIELDS)
+    if not group:
+        return None
+    version = group.get("version", 0)
+    if version <= since:
+        return version, None
+    balances = group.get("balances", {})
+    return version, format_event("snapshot", {
+        "version": version,
+        "balances": balances,
+        "settlements": suggest_settlements(balances),
+        "expense_list": render_expense_list(group_id, version)
+    }, event_id=version)
+
+
+@app.route('/group/<group_id>/events')
+def group_events(group_id):
+    """Stream a group's writes to its open page as Server-Sent Events.
+
+    Each event carries the group version as its id. Events that arrive in order
+    are sent as they are; after a gap (a slow stream, a reconnect, or a write on
+    another worker, noticed when polling) the page gets a full snapshot.
+    """
+    if 'username' not in session:
+        return api_error('Not logged in', 401)
+
+    group = member_group_version(group_id, session['username'])
+    if not group:
+        return api_error('Group not found', 404)
+
+    try:
+        subscription = broker.subscribe(group_id)
+    except BrokerFull:
+        return (
+            jsonify({'success': False, 'message': 'Too many live connections; try again shortly'}),
+            503,
+            {"Retry-After": str(int(LIVE_UPDATES_POLL_SECONDS))}
+        )
+
+    # A reconnecting browser sends the id, i.e. the version, of the last event it saw
+    last_event_id = request.headers.get("Last-Event-ID", "")
+    seen = int(last_event_id) if last_event_id.isdigit() else group.get("version", 0)
+
+    def events(version):
+        deadline = time.monotonic() + LIVE_UPDATES_MAX_SECONDS
+        yield f"retry: {int(LIVE_UPDATES_POLL_SECONDS * 1000)}\n\n"
+        resync = version < group.get("version", 0)
+        while True:
+            if not resync:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                event = subscription.get(min(LIVE_UPDATES_POLL_SECONDS, remaining))
+                if event is not None and event is not OVERFLOW and event["name"] != "changed":
+                    if event["version"] == version + 1:
+                        version = event["version"]
+                        yield format_event(event["name"], event, event_id=version)
+                    # Older events are already covered; newer ones mean one was missed
+                    resync = event["version"] > version
+                    continue
+
+            snapshot = group_snapshot(group_id, version)
+            if snapshot is None:
+                return
+            version, message = snapshot
+            yield message or ": keepalive\n\n"
+            resync = False
+
+    response = Response(stream_with_context(events(seen)), mimetype="text/event-stream")
+    # The server closes every response, even one whose body is never read (HEAD, say)
+    response.call_on_close(subscription.close)
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
 @app.route('/add-expense', methods=["GET", "POST"])
 def add_expense():
     if 'username' not in session:
@@ -190,24 +1097,22 @@ def add_expense():
         return redirect(url_for("login"))
 
     username = session['username']
-    user = col_users.find_one({"name": username})
+    user = current_user()
     if not user:
         flash("User not found.", "error")
         return redirect(url_for("groups"))
         
-    user_groups = user.get("groups", [])
+    user_groups = user["groups"]
     print(f"Groups for user {username}: {user_groups}")
     
     group_details = []
-    for group_id in user_groups:
-        group = col_groups.find_one({"_id": group_id})
-        if group:
-            group_data = {
-                "_id": str(group["_id"]),
-                "group_name": group["group_name"],
-                "group_members": group["group_members"]
-            }
-            group_details.append(group_data)
+    for group in load_group_summaries(user_groups):
+        group_data = {
+            "_id": str(group["_id"]),
+            "group_name": group["group_name"],
+            "group_members": group["group_members"]
+        }
+        group_details.append(group_data)
     print(f"Group details being sent to template: {group_details}")
 
     if request.method == "POST":
@@ -217,69 +1122,159 @@ def add_expense():
             amount = float(request.form.get("amount"))
             paid_by = request.form.get("paid_by")
             split_with = request.form.getlist("split_with[]")
-            percentages = [float(p) for p in request.form.get("percentages").split(",")]
-
-            # Validate percentages
-            if len(percentages) != len(split_with):
-                flash("The number of split members and percentages do not match.", "error")
-                return redirect(url_for("add_expense"))
-
-            if sum(percentages) != 1.0:
-                flash("Split percentages must sum to 1.0.", "error")
-                return redirect(url_for("add_expense"))
-
-            # Prepare split_among
-            split_among = {
-                member: round(amount * percentages[i], 2) for i, member in enumerate(split_with)
-            }
-
-            # Create expense document
-            expense_id = str(ObjectId())
-            expense = {
-                "expense_id": expense_id,
-                "description": description,
-                "amount": amount,
-                "paid_by": paid_by,
-                "split_among": split_among
-            }
-            
+            mode, values = split_inputs(
+                request.form.get("split_mode"),
+                request.form.get("split_values", request.form.get("percentages"))
+            )
+
+            expense = record_expense(
+                group_id, description, amount, paid_by, split_with, values, mode, recorded_by=username
+            )
             print(f"Expense document: {expense}")
-            
-            group = col_groups.find_one({"_id": group_id})
-            for member, share in split_among.items():
-                if member != paid_by:
-                    group["balances"][member] -= share
-                    group["balances"][paid_by] += share
-
-            # Add expense to the group
-            col_groups.update_one({"_id": group_id}, {
-                "$push": {"expenses": expense},
-                "$set": {"balances": group["balances"]}
-                                  })
             print(f"Expense added successfully to group {group_id}")
             flash("Expense added successfully!", "success")
             return redirect(url_for("group_details", group_id=group_id))
 
+        except ExpenseError as e:
+            flash(str(e), e.category)
+            return redirect(url_for("add_expense"))
+
         except Exception as e:
             flash(f"Error adding expense: {str(e)}", "error")
             return redirect(url_for("add_expense"))
 
     return render_template('add-expense.html', groups=group_details)
 
+def upgrade_password_hash(user, password):
+    """Re-hash a password made with an old work factor, now that we have it in plain text."""
+    try:
+        col_users.update_one(
+            {"_id": user["_id"], "password": user["password"]},
+            {"$set": {"password": password_hasher.hash(password)}}
+        )
+    except PasswordHasherBusy:
+        # Not worth failing the login over; it will be upgraded next time
+        pass
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_stats, g.request_stats_token = metrics.start_request(request.endpoint or "unmatched")
+
+
+@app.after_request
+def remember_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    # Teardown runs even when an exception escapes, so the context variable is always reset
+    if "request_stats" in g:
+        metrics.finish_request(
+            g.pop("request_stats"), g.pop("request_stats_token"), request.method, g.get("response_status", 500)
+        )
+
+
+@app.after_request
+def compress(response):
+    if COMPRESSION_ENABLED and request.endpoint != "static":
+        compress_response(response, request.accept_encodings, COMPRESS_MIN_SIZE)
+    return response
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', filename='css/style.css') -> /static/css/style.<hash>.css
+    if endpoint == "static" and "filename" in values:
+        values["filename"] = static_assets.hashed_filename(values["filename"])
+
+
+def serve_static(filename):
+    """Serve a fingerprinted asset with far-future caching; other names fall back to Flask's handler."""
+    asset = static_assets.lookup(filename)
+    if asset is None:
+        return app.send_static_file(filename)
+
+    encoding = negotiate_encoding(request.accept_encodings, [name for name in asset.variants if name])
+    response = app.response_class(asset.variants[encoding], mimetype=asset.mimetype)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    if len(asset.variants) > 1:
+        response.vary.add("Accept-Encoding")
+    response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    response.set_etag(f"{asset.digest}-{encoding or 'identity'}")
+    return response.make_conditional(request)
+
+
+app.view_functions["static"] = serve_static
+
+
+@app.route('/readyz')
+def readiness():
+    """Ready once MongoDB answers a ping; load balancers and orchestrators poll this."""
+    try:
+        mydb.command('ping')
+    except Exception as e:
+        return jsonify({'ready': False, 'error': str(e)}), 503
+    if not indexes_ready.is_set():
+        prepare_database(mydb)
+    return jsonify({'ready': True, 'indexes': indexes_ready.is_set()})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    return (
+        "Too many sign-ins at the moment. Please try again in a few seconds.",
+        503,
+        {"Retry-After": PASSWORD_RETRY_AFTER}
+    )
+
+
+@app.errorhandler(RateLimited)
+def rate_limited(error):
+    metrics.rate_limited.inc(error.limiter)
+    headers = {"Retry-After": str(math.ceil(error.retry_after))}
+    if request.endpoint in ("check_user", "check_users"):
+        return jsonify({'success': False, 'message': 'Too many requests'}), 429, headers
+    return "Too many attempts. Please wait a moment and try again.", 429, headers
+
+
+def unsafe_username(username):
+    """Usernames become $inc paths like ``balances.<name>``, so dots and a leading $ would break them."""
+    return "." in username or username.startswith("$")
+
+
 @app.route("/registration", methods=["GET", "POST"])
 def registration():
     if request.method == "POST":
+        rate_limiters["registration_ip"].hit(request.remote_addr)
         username = request.form["username"]
         password = request.form["password"]
 
-        if col_users.find_one({"name": username}):
+        if unsafe_username(username):
+            flash("Usernames can't contain '.' or start with '$'.", "error")
+            return redirect(url_for("registration"))
+
+        if col_users.find_one({"name": username}, ["_id"]):
             flash("Username already in use.", "error")
             return redirect(url_for("registration"))
             
-        salt = bcrypt.gensalt()
-        hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
+        hashed_password = password_hasher.hash(password)
 
-        col_users.insert_one({"name": username, "password": hashed_password, "groups": []})
+        try:
+            col_users.insert_one({"name": username, "password": hashed_password, "groups": [], "groups_version": 0})
+        except DuplicateKeyError:
+            # Another registration claimed the name between the check and the insert
+            flash("Username already in use.", "error")
+            return redirect(url_for("registration"))
+        user_exists_cache.delete(username)
         flash("Registration successful. Please log in.", "success")
         return redirect(url_for("login"))
 
@@ -291,13 +1286,19 @@ def login():
     if request.method == "POST":
         username = request.form["username"]
         password = request.form["password"]
+        # Per address against stuffing from one client, per username against a distributed guess
+        rate_limiters["login_ip"].hit(request.remote_addr)
+        rate_limiters["login_user"].hit(username)
 
         user = col_users.find_one({"name": username})
         if user:
             
             stored_password=user['password']
-            if bcrypt.checkpw(password.encode('utf-8'), stored_password):
+            if password_hasher.verify(password, stored_password):
+                if password_hasher.needs_rehash(stored_password):
+                    upgrade_password_hash(user, password)
                 session["username"] = username
+                remember_user(user)
                 flash("Login successful!", "success")
                 return redirect(url_for("home"))
             else:
@@ -312,6 +1313,7 @@ def login():
 @app.route("/logout")
 def logout():
     session.pop("username", None)
+    session.pop("user", None)
     flash("Logged out successfully.", "success")
     return redirect(url_for("base"))
 
@@ -320,19 +1322,15 @@ def delete_expense(expense_id):
     if 'username' not in session:
         return jsonify({'success': False, 'message': 'Not logged in'}), 401
 
-    username = session['username']
-    user = col_users.find_one({"name": username})
-    if not user:
+    if not current_user():
         return jsonify({'success': False, 'message': 'User not found'}), 404
 
-    group = col_groups.find_one({"expenses.expense_id": expense_id})
-    if not group:
+    expense = col_expenses.find_one({"_id": expense_id}, ["group_id"])
+    if not expense or not member_group_version(expense["group_id"], session['username']):
         return jsonify({'success': False, 'message': 'Expense not found'}), 404
 
-    col_groups.update_one(
-        {"_id": group["_id"]},
-        {"$pull": {"expenses": {"expense_id": expense_id}}}
-    )
+    if not remove_expense(expense_id):
+        return jsonify({'success': False, 'message': 'Expense not found'}), 404
 
     return jsonify({'success': True, 'message': 'Expense deleted successfully'})
     
@@ -343,69 +1341,303 @@ def settle_payment():
         return redirect(url_for("login"))
 
     username = session['username']
-    user = col_users.find_one({"name": username})
+    user = current_user()
     if not user:
         flash("User not found.", "error")
         return redirect(url_for("home"))
 
-    user_groups = user.get("groups", [])
+    user_groups = user["groups"]
     group_details = []
-    for group_id in user_groups:
-        group = col_groups.find_one({"_id": group_id})
-        if group:
-            group_details.append({
-                "group_name": group["group_name"],
-                "group_id": group["_id"],
-                "balances": group["balances"]
-            })
+    for group in load_group_summaries(user_groups):
+        group_details.append({
+            "group_name": group["group_name"],
+            "group_id": group["_id"],
+            "balances": group["balances"]
+        })
 
     if request.method == 'POST':
         try:
             group_id = request.form.get("group_id")
             payment_amount = float(request.form.get("payment_amount"))
 
-            if payment_amount <= 0:
-                flash("Payment amount must be greater than zero.", "error")
-                return redirect(url_for("settle_payment"))
-
-            group = col_groups.find_one({"_id": group_id})
-            if not group:
-                flash("Group not found.", "error")
-                return redirect(url_for("settle_payment"))
-
-            balances = group["balances"]
-            if balances[username] >= 0:
-                flash("You have no outstanding balance to settle.", "info")
-                return redirect(url_for("settle_payment"))
-
-            remaining_debt = abs(balances[username])
-            if payment_amount >= remaining_debt:
-                payment_amount = remaining_debt
-
-            balances[username] += payment_amount
-            creditors = [name for name, balance in balances.items() if balance > 0]
-
-            for creditor in creditors:
-                if payment_amount <= 0:
-                    break
-                creditor_balance = balances[creditor]
-                pay_to_creditor = min(creditor_balance, payment_amount)
-                balances[creditor] -= pay_to_creditor
-                payment_amount -= pay_to_creditor
-
-            col_groups.update_one(
-                {"_id": group["_id"]},
-                {"$set": {"balances": balances}}
-            )
+            record_settlement(group_id, username, payment_amount)
 
             flash("Payment settled successfully!", "success")
             return redirect(url_for("groups"))
 
+        except ExpenseError as e:
+            flash(str(e), e.category)
+            return redirect(url_for("settle_payment"))
+
         except Exception as e:
             flash(f"An error occurred: {str(e)}", "error")
             return redirect(url_for("settle_payment"))
 
     return render_template("settle-payment.html", groups=group_details)
 
+# JSON API (v1). Every write to a group bumps its version, which the read
+# endpoints turn into an ETag so polling clients get a cheap 304 when nothing changed.
+
+API_VERSION_FIELDS = ["version", "updated_at"]
+
+
+def api_error(message, status):
+    return jsonify({'success': False, 'message': message}), status
+
+
+def version_etag(*parts):
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def http_timestamp(updated_at):
+    # Stored as naive UTC; HTTP dates have whole-second precision
+    return updated_at.replace(tzinfo=datetime.timezone.utc, microsecond=0) if updated_at else None
+
+
+def not_modified(etag, last_modified=None):
+    """True if the client's cached copy (If-None-Match, else If-Modified-Since) is current."""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and last_modified:
+        return last_modified <= request.if_modified_since
+    return False
+
+
+def versioned_response(etag, last_modified, payload=None):
+    """A 304 if ``payload`` is None, otherwise ``payload`` as JSON, both carrying the validators."""
+    response = app.response_class(status=304) if payload is None else jsonify(payload)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def member_group_version(group_id, username):
+    """The version fields of a group ``username`` belongs to, or None."""
+    return col_groups.find_one({"_id": group_id, "group_members": username}, API_VERSION_FIELDS)
+
+
+@app.route('/api/v1/groups')
+def api_groups():
+    if 'username' not in session:
+        return api_error('Not logged in', 401)
+
+    username = session['username']
+    user = current_user()
+    if not user:
+        return api_error('User not found', 404)
+
+    # Validate against the versions alone before reading or serializing any group
+    group_ids = user["groups"]
+    versions = {
+        group["_id"]: group
+        for group in col_groups.find({"_id": {"$in": group_ids}}, API_VERSION_FIELDS)
+    }
+    etag = version_etag(username, [(gid, versions[gid].get("version", 0)) for gid in group_ids if gid in versions])
+    timestamps = [group["updated_at"] for group in versions.values() if group.get("updated_at")]
+    last_modified = http_timestamp(max(timestamps)) if timestamps else None
+    if not_modified(etag, last_modified):
+        return versioned_response(etag, last_modified)
+
+    return versioned_response(etag, last_modified, {
+        'success': True,
+        'groups': [{
+            "group_id": group["_id"],
+            "group_name": group["group_name"],
+            "group_members": group["group_members"],
+            "balances": group["balances"],
+            "version": versions[group["_id"]].get("version", 0)
+        } for group in load_group_summaries(
+            group_ids, {group_id: group.get("version", 0) for group_id, group in versions.items()}
+        )]
+    })
+
+
+@app.route('/api/v1/dashboard')
+def api_dashboard():
+    if 'username' not in session:
+        return api_error('Not logged in', 401)
+
+    return jsonify({'success': True, **load_balance_dashboard(session['username'])})
+
+
+@app.route('/api/v1/groups/<group_id>')
+def api_group_details(group_id):
+    if 'username' not in session:
+        return api_error('Not logged in', 401)
+
+    version = member_group_version(group_id, session['username'])
+    if not version:
+        return api_error('Group not found', 404)
+
+    before = request.args.get("before")
+    if before and not valid_expense_cursor(before):
+        return api_error('Invalid cursor', 400)
+    current = version.get("version", 0)
+    etag = version_etag(group_id, current, before)
+    last_modified = http_timestamp(version.get("updated_at"))
+    if not_modified(etag, last_modified):
+        return versioned_response(etag, last_modified)
+
+    # The body must be at least as new as the version the ETag names
+    summaries, (expenses, next_cursor) = run_concurrently(
+        lambda: load_group_summaries([group_id], {group_id: current}),
+        lambda: format_expense_page(group_id, before=before, version=current)
+    )
+    group = summaries[0]
+    return versioned_response(etag, last_modified, {
+        'success': True,
+        'group_id': group_id,
+        'group_name': group["group_name"],
+        'group_members': group["group_members"],
+        'balances': group["balances"],
+        'settlements': suggest_settlements(group["balances"]),
+        'expenses': expenses,
+        'next_cursor': next_cursor,
+        'version': current
+    })
+
+
+@app.route('/api/v1/groups/<group_id>/expenses', methods=['POST'])
+def api_add_expense(group_id):
+    if 'username' not in session:
+        return api_error('Not logged in', 401)
+
+    if not member_group_version(group_id, session['username']):
+        return api_error('Group not found', 404)
+
+    data = request.get_json(silent=True) or {}
+    try:
+        mode, values = split_inputs(data.get("split_mode"), data.get("split_values", data.get("percentages")))
+        expense = record_expense(
+            group_id,
+            data["description"],
+            float(data["amount"]),
+            data.get("paid_by", session['username']),
+            list(data["split_with"]),
+            values,
+            mode
+        )
+    except KeyError as e:
+        return api_error(f"Missing field: {e.args[0]}", 400)
+    except (TypeError, ValueError) as e:
+        return api_error(str(e), 400)
+
+    return jsonify({'success': True, 'expense_id': expense["_id"]}), 201
+
+
+@app.route('/api/v1/groups/<group_id>/expenses/import', methods=['POST'])
+def api_import_expenses(group_id):
+    """Import a CSV or NDJSON file of expenses sent as the raw request body.
+
+    The body is read straight off the connection rather than as a multipart
+    upload, which would be spooled whole before the import starts. The response
+    streams one NDJSON outcome per row, then a summary line.
+    """
+    if 'username' not in session:
+        return api_error('Not logged in', 401)
+
+    group = col_groups.find_one(
+        {"_id": group_id, "group_members": session['username']}, ["group_members"]
+    )
+    if not group:
+        return api_error('Group not found', 404)
+
+    stream = request.stream
+    fmt = detect_format(request.args.get("format"), request.mimetype)
+    if not fmt:
+        return api_error('Unknown file format; use CSV or NDJSON', 400)
+
+    def outcomes():
+        imported = failed = 0
+        for outcome in import_expenses(group, read_rows(stream, fmt), IMPORT_BATCH_SIZE):
+            if outcome["ok"]:
+                imported += 1
+            else:
+                failed += 1
+            yield json.dumps(outcome) + "\n"
+        yield json.dumps({"imported": imported, "failed": failed}) + "\n"
+
+    return Response(stream_with_context(outcomes()), mimetype="application/x-ndjson")
+
+
+@app.route('/api/v1/groups/<group_id>/export')
+def api_export_group(group_id):
+    """Download a group's expenses, settlements and balances as CSV (default) or NDJSON."""
+    if 'username' not in session:
+        return api_error('Not logged in', 401)
+
+    fmt = detect_format(request.args.get("format", "csv"))
+    if not fmt:
+        return api_error('Unknown format; use csv or ndjson', 400)
+
+    group = col_groups.find_one(
+        {"_id": group_id, "group_members": session['username']}, ["group_name", "balances"]
+    )
+    if not group:
+        return api_error('Group not found', 404)
+
+    response = Response(
+        stream_with_context(export_ledger(mydb, group, fmt, EXPORT_BATCH_SIZE)),
+        mimetype=MIMETYPES[fmt]
+    )
+    response.headers["Content-Disposition"] = f'attachment; filename="group-{group_id}.{fmt}"'
+    response.headers["Cache-Control"] = "private, no-cache"
+    # Ask proxies such as nginx to pass chunks on as they come rather than buffer the export
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+@app.route('/api/v1/expenses/<expense_id>', methods=['DELETE'])
+def api_delete_expense(expense_id):
+    if 'username' not in session:
+        return api_error('Not logged in', 401)
+
+    expense = col_expenses.find_one({"_id": expense_id}, ["group_id"])
+    if not expense or not member_group_version(expense["group_id"], session['username']):
+        return api_error('Expense not found', 404)
+
+    if not remove_expense(expense_id):
+        return api_error('Expense not found', 404)
+    return jsonify({'success': True, 'message': 'Expense deleted successfully'})
+
+
+@app.route('/api/v1/groups/<group_id>/settlements', methods=['POST'])
+def api_settle_payment(group_id):
+    if 'username' not in session:
+        return api_error('Not logged in', 401)
+
+    username = session['username']
+    if not member_group_version(group_id, username):
+        return api_error('Group not found', 404)
+
+    data = request.get_json(silent=True) or {}
+    try:
+        entry = record_settlement(group_id, username, float(data["amount"]))
+    except KeyError:
+        return api_error("Missing field: amount", 400)
+    except ExpenseError as e:
+        return api_error(str(e), 409 if e.category == "info" else 400)
+    except (TypeError, ValueError) as e:
+        return api_error(str(e), 400)
+
+    return jsonify({'success': True, 'amount': entry["amount"], 'paid_to': entry["split_among"]}), 201
+
+
+def create_app(config=None):
+    """Return the app configured for serving; wsgi.py is the production entry point.
+
+    ``config`` updates app.config, and its MONGO_URI / MONGO_DBNAME point the
+    connection elsewhere. Nothing connects here: each worker process opens its
+    own MongoDB client on its first request.
+    """
+    if config:
+        app.config.update(config)
+        if config.get("MONGO_URI") or config.get("MONGO_DBNAME"):
+            mongo.configure(uri=config.get("MONGO_URI"), dbname=config.get("MONGO_DBNAME"))
+    return app
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8080)
+    create_app().run(host='0.0.0.0', port=8080)
@@ -0,0 +1,189 @@
+"""Move cold ledger entries out of EXPENSES into EXPENSES_ARCHIVE.
+
+An entry is cold once it is older than the archive horizon, or once a later
+point in the ledger brought every member's balance back to zero: nothing after
+a fully settled point depends on what came before it. Archiving always takes
+the oldest stretch of a group's ledger, so what stays in EXPENSES is an
+unbroken run of recent entries.
+
+Each batch leaves one summary row in EXPENSES, in the archived entries' place.
+It carries the net balance change of the batch, so replaying the ledger gives
+the same balances as before, and the group page shows it as a link that loads
+the archived entries on request.
+"""
+import datetime
+
+from bson.objectid import ObjectId
+from pymongo import ReplaceOne
+
+from ledger import ARCHIVE_SUMMARY, SNAPSHOT_MIN_AGE, batched
+from splits import to_cents
+
+# Entries copied per bulk write
+ARCHIVE_BATCH_SIZE = 500
+
+PLAN_FIELDS = ["kind", "amount", "paid_by", "split_among", "balance_deltas", "created_at"]
+
+# What an archived entry keeps: enough to list and export it, nothing else
+ARCHIVED_FIELDS = ["group_id", "kind", "description", "amount", "paid_by", "split_among", "created_at"]
+
+
+def entry_deltas(entry):
+    """A ledger entry's effect on balances in cents, as its payer and shares imply."""
+    deltas = {}
+    for member, share in entry["split_among"].items():
+        if member != entry["paid_by"]:
+            deltas[member] = deltas.get(member, 0) - to_cents(share)
+            deltas[entry["paid_by"]] = deltas.get(entry["paid_by"], 0) + to_cents(share)
+    return deltas
+
+
+def through_entry(group_id, created_at, entry_id):
+    """Match a group's ledger entries up to and including (``created_at``, ``entry_id``)."""
+    return {"group_id": group_id, "kind": {"$ne": ARCHIVE_SUMMARY}, "$or": [
+        {"created_at": {"$lt": created_at}},
+        {"created_at": created_at, "_id": {"$lte": entry_id}}
+    ]}
+
+
+def finish_interrupted_run(db, group_id):
+    """Delete entries an earlier run summarised but stopped before deleting; returns how many.
+
+    Until then they are counted twice, once themselves and once in the summary.
+    Everything up to a summary's last entry was copied to EXPENSES_ARCHIVE
+    before the summary was written, so deleting it again is always safe.
+    """
+    summary = db["EXPENSES"].find_one(
+        {"group_id": group_id, "kind": ARCHIVE_SUMMARY}, ["created_at", "through_id"],
+        sort=[("created_at", -1), ("_id", -1)]
+    )
+    if summary is None:
+        return 0
+    return db["EXPENSES"].delete_many(through_entry(group_id, summary["created_at"], summary["through_id"])).deleted_count
+
+
+def plan_archive(db, group_id, horizon, settled_before):
+    """Find the oldest stretch of a group's ledger that can be archived, or None.
+
+    Entries are archivable if they were recorded before ``horizon``, or before a
+    later point where every balance was zero. Only entries older than
+    ``settled_before`` are considered, so in-flight writes are never caught.
+    The ledger is read once, oldest first, keeping running balances in cents.
+    """
+    cursor = (
+        db["EXPENSES"].find({"group_id": group_id}, PLAN_FIELDS)
+        .sort([("created_at", 1), ("_id", 1)])
+        .batch_size(ARCHIVE_BATCH_SIZE)
+    )
+    start = {}  # Balances left by earlier archive batches
+    running = {}
+    nonzero = 0
+    count = amount = 0
+    first_created_at = None
+    plan = None
+    pending = False  # The plan's balance_deltas still equal the running ones
+
+    def settle_plan():
+        plan["balance_deltas"] = {
+            member: cents - start.get(member, 0)
+            for member, cents in running.items() if cents != start.get(member, 0)
+        }
+
+    try:
+        for entry in cursor:
+            if entry.get("kind") == ARCHIVE_SUMMARY:
+                deltas = {member: to_cents(delta) for member, delta in entry["balance_deltas"].items()}
+                for member, cents in deltas.items():
+                    start[member] = start.get(member, 0) + cents
+            elif entry["created_at"] >= settled_before:
+                break
+            else:
+                if pending:
+                    settle_plan()
+                    pending = False
+                deltas = entry_deltas(entry)
+                count += 1
+                amount += to_cents(entry.get("amount", 0))
+                first_created_at = first_created_at or entry["created_at"]
+            for member, cents in deltas.items():
+                before = running.get(member, 0)
+                running[member] = before + cents
+                nonzero += bool(running[member]) - bool(before)
+            if entry.get("kind") != ARCHIVE_SUMMARY and (entry["created_at"] < horizon or not nonzero):
+                plan = {
+                    "through": (entry["created_at"], entry["_id"]),
+                    "entries": count,
+                    "amount": amount,
+                    "first_created_at": first_created_at,
+                }
+                pending = True
+        if pending:
+            settle_plan()
+    finally:
+        cursor.close()
+    return plan
+
+
+def archive_group(db, group_id, horizon, settled_before, batch_size=ARCHIVE_BATCH_SIZE):
+    """Archive the cold end of one group's ledger; returns the summary row, or None.
+
+    Entries are copied to EXPENSES_ARCHIVE first, tagged with the summary's id,
+    then the summary is written and the originals deleted. A run that stopped
+    before the summary left only copies, which the next run overwrites. One
+    that stopped after it left originals the summary already counts, which the
+    next run deletes before planning. Snapshots taken inside the archived
+    stretch are dropped: replays from them would count the summary on top of
+    entries they already include.
+    """
+    finish_interrupted_run(db, group_id)
+    plan = plan_archive(db, group_id, horizon, settled_before)
+    if plan is None:
+        return None
+
+    created_at, entry_id = plan["through"]
+    archived = through_entry(group_id, created_at, entry_id)
+    summary_id = str(ObjectId())
+    cursor = db["EXPENSES"].find(archived, ARCHIVED_FIELDS).batch_size(batch_size)
+    try:
+        for batch in batched(cursor, batch_size):
+            db["EXPENSES_ARCHIVE"].bulk_write([
+                ReplaceOne({"_id": entry["_id"]}, {**entry, "archive_id": summary_id}, upsert=True)
+                for entry in batch
+            ], ordered=False)
+    finally:
+        cursor.close()
+
+    summary = {
+        "_id": summary_id,
+        "group_id": group_id,
+        "kind": ARCHIVE_SUMMARY,
+        "description": f"{plan['entries']} archived entries",
+        "amount": plan["amount"] / 100,
+        "entries": plan["entries"],
+        # No payer and no shares, so the share-based replay skips it and reads balance_deltas
+        "split_among": {},
+        "balance_deltas": {member: cents / 100 for member, cents in plan["balance_deltas"].items()},
+        "first_created_at": plan["first_created_at"],
+        # Sorts where the last archived entry was, ahead of everything left in EXPENSES
+        "created_at": created_at,
+        "through_id": entry_id,
+        "archived_at": datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None),
+    }
+    db["EXPENSES"].insert_one(summary)
+    db["EXPENSES"].delete_many(archived)
+    db["BALANCE_SNAPSHOTS"].delete_many({"group_id": group_id, "through_created_at": {"$lte": created_at}})
+    return summary
+
+
+def archive_expenses(db, max_age, batch_size=ARCHIVE_BATCH_SIZE, now=None):
+    """Archive every group's entries older than ``max_age`` or behind a settled point.
+
+    Returns the summary rows written, one per group that had anything to archive.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    summaries = []
+    for group in db["GROUPS"].find({}, ["_id"]):
+        summary = archive_group(db, group["_id"], now - max_age, now - SNAPSHOT_MIN_AGE, batch_size)
+        if summary:
+            summaries.append(summary)
+    return summaries
@@ -0,0 +1,147 @@
+"""Compare requests/sec of the sync server with the gevent server (serve_async.py).
+
+Both servers run the real app against a mongomock stand-in that sleeps for a
+fixed time on every Mongo command, standing in for the network round trip.
+Run from the webapp folder:
+
+    python -m benchmarks.async_bench --clients 20 --duration 5 --latency-ms 5
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from benchmarks.commands import CommandHook
+
+
+def serve(mode, port, latency, groups):
+    """Run one server in this process on the stand-in database (used by the subprocesses)."""
+    if mode == "async":
+        from gevent import monkey
+        monkey.patch_all()
+
+    os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/?serverSelectionTimeoutMS=100")
+    os.environ.setdefault("MONGO_DBNAME", "benchmark")
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ["GROUP_CACHE_ENABLED"] = "false"
+
+    import bcrypt
+    import mongomock
+    from bson import ObjectId
+
+    import app
+
+    db = mongomock.MongoClient()["benchmark"]
+    app.mydb = db
+    # Sleep before every command, like a network round trip
+    def round_trip(collection, command):
+        time.sleep(latency)
+
+    app.col_users = CommandHook(db["USERS"], round_trip)
+    app.col_groups = CommandHook(db["GROUPS"], round_trip)
+    app.col_expenses = CommandHook(db["EXPENSES"], round_trip)
+
+    group_ids = [str(ObjectId()) for _ in range(groups)]
+    db["GROUPS"].insert_many([{
+        "_id": group_id,
+        "group_name": f"Group {i}",
+        "group_members": ["bench", "friend"],
+        "balances": {"bench": 0, "friend": 0}
+    } for i, group_id in enumerate(group_ids)])
+    db["USERS"].insert_one({
+        "name": "bench",
+        "password": bcrypt.hashpw(b"bench", bcrypt.gensalt(rounds=4)),
+        "groups": group_ids
+    })
+
+    if mode == "async":
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(("127.0.0.1", port), app.app, log=None).serve_forever()
+    else:
+        # One blocking worker, like a single sync worker process
+        from werkzeug.serving import make_server
+        make_server("127.0.0.1", port, app.app, threaded=False).serve_forever()
+
+
+def wait_until_ready(base_url, timeout=60):
+    import requests
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(base_url + "/", timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server at {base_url} did not start")
+
+
+def run_load(base_url, path, clients, duration):
+    """Hit ``path`` from ``clients`` logged-in threads for ``duration`` seconds."""
+    import threading
+    import requests
+
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        session.post(base_url + "/login", data={"username": "bench", "password": "bench"})
+        own = []
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            session.get(base_url + path).raise_for_status()
+            own.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    return {
+        "requests_per_sec": len(latencies) / duration,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--path", default="/groups")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--serve", choices=["sync", "async"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port, args.latency_ms / 1000, args.groups)
+        return
+
+    print(f"{args.clients} clients on {args.path}, {args.latency_ms} ms per Mongo command")
+    print(f"{'mode':>6} {'req/s':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for offset, mode in enumerate(["sync", "async"]):
+        port = args.port + offset
+        server = subprocess.Popen([
+            sys.executable, "-m", "benchmarks.async_bench", "--serve", mode, "--port", str(port),
+            "--latency-ms", str(args.latency_ms), "--groups", str(args.groups)
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            wait_until_ready(base_url)
+            result = run_load(base_url, args.path, args.clients, args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{mode:>6} {result['requests_per_sec']:>10.1f} {result['p50_ms']:>10.1f} {result['p95_ms']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""Wrap a collection to run a hook before every command sent through it.
+
+The benchmarks use it to count commands and to add network latency, and the
+tests use it to check how many commands a request issues.
+"""
+
+# Every collection method that sends a command to the server
+COMMANDS = {
+    "find", "find_one", "insert_one", "insert_many", "update_one", "update_many",
+    "delete_one", "delete_many", "aggregate", "bulk_write", "count_documents",
+    "find_one_and_update", "find_one_and_delete", "find_one_and_replace", "replace_one",
+}
+
+
+class CommandHook:
+    """Wrap a collection and call ``hook(collection_name, command)`` before each command."""
+
+    def __init__(self, collection, hook):
+        self._collection = collection
+        self._hook = hook
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in COMMANDS:
+            return attr
+
+        def hooked(*args, **kwargs):
+            self._hook(self._collection.name, name)
+            return attr(*args, **kwargs)
+        return hooked
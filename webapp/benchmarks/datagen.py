@@ -0,0 +1,98 @@
+"""Seeded synthetic SplitSmart data for the benchmarks.
+
+The same seed and sizes always produce the same users, groups and expenses.
+Group sizes follow a Pareto distribution, so most groups are small and a few
+are very large, as in real use. Every group's stored balances agree with its
+generated expenses.
+"""
+import datetime
+import random
+
+import bcrypt
+from bson import ObjectId
+
+from ledger import batched
+from splits import allocate
+
+PASSWORD = "bench"
+
+
+def group_size(rng, skew, users):
+    """A group size of at least 2, heavy-tailed: smaller ``skew`` means bigger outliers."""
+    return max(2, min(users, int(rng.paretovariate(skew) * 2)))
+
+
+def random_split(rng, amount, members):
+    """Split ``amount`` among ``members`` in whole cents, summing exactly to ``amount``."""
+    weights = [rng.randint(1, 4) for _ in members]
+    shares = allocate(round(amount * 100), weights)
+    return {member: share / 100 for member, share in zip(members, shares)}
+
+
+def generate(db, seed=42, users=200, groups=50, expenses_per_group=100, skew=1.2, bcrypt_rounds=4):
+    """Fill ``db`` with a synthetic dataset and return what the scenarios need to address it.
+
+    Every user's password is PASSWORD, hashed with ``bcrypt_rounds``.
+    """
+    rng = random.Random(seed)
+    names = [f"user{i}" for i in range(users)]
+    password = bcrypt.hashpw(PASSWORD.encode("utf-8"), bcrypt.gensalt(rounds=bcrypt_rounds))
+    memberships = {name: [] for name in names}
+    start = datetime.datetime(2024, 1, 1)
+
+    group_docs = []
+    expenses = []
+    for g in range(groups):
+        group_id = str(ObjectId())
+        members = rng.sample(names, group_size(rng, skew, users))
+        balances = {member: 0 for member in members}
+        for e in range(expenses_per_group):
+            amount = rng.randint(100, 20000) / 100
+            paid_by = rng.choice(members)
+            split_among = random_split(rng, amount, rng.sample(members, rng.randint(1, len(members))))
+            for member, share in split_among.items():
+                if member != paid_by:
+                    balances[member] -= share
+                    balances[paid_by] += share
+            expenses.append({
+                "_id": str(ObjectId()),
+                "group_id": group_id,
+                "description": f"Expense {e}",
+                "amount": amount,
+                "paid_by": paid_by,
+                "split_among": split_among,
+                "created_at": start + datetime.timedelta(minutes=g * expenses_per_group + e)
+            })
+        for member in members:
+            memberships[member].append(group_id)
+        group_docs.append({
+            "_id": group_id,
+            "group_name": f"Group {g}",
+            "group_members": members,
+            "balances": {member: round(balance, 2) for member, balance in balances.items()},
+            "version": 1,
+            "updated_at": start
+        })
+
+    db["USERS"].insert_many([
+        {"name": name, "password": password, "groups": memberships[name]} for name in names
+    ])
+    db["GROUPS"].insert_many(group_docs)
+    for batch in batched(expenses, 1000):
+        db["EXPENSES"].insert_many(batch)
+
+    busiest_user = max(names, key=lambda name: len(memberships[name]))
+    largest_group = max(
+        (group for group in group_docs if busiest_user in group["group_members"]),
+        key=lambda group: len(group["group_members"])
+    )
+    return {
+        "users": users,
+        "groups": groups,
+        "expenses": len(expenses),
+        "largest_group_size": max(len(group["group_members"]) for group in group_docs),
+        "user": busiest_user,
+        "user_groups": len(memberships[busiest_user]),
+        "group_id": largest_group["_id"],
+        "group_members": largest_group["group_members"],
+    }
@@ -0,0 +1,212 @@
+"""Measure per-route latency, throughput and Mongo commands on a seeded dataset.
+
+Each scenario sends requests through Flask's test client, in process, so the
+numbers cover the app and the database but not HTTP parsing or the network.
+The data lives in mongomock by default, or in a throwaway database on a local
+mongod with --mongo-uri. Run from the webapp folder:
+
+    python -m benchmarks.route_bench --output results.json
+    python -m benchmarks.route_bench --output new.json --compare results.json
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from benchmarks.commands import CommandHook
+
+
+def scenarios(dataset):
+    """(name, method, path, form data, setup) for each measured route."""
+    user = dataset["user"]
+    group_id = dataset["group_id"]
+    other = next(member for member in dataset["group_members"] if member != user)
+
+    def owe_money(db):
+        # Untimed: give the user a debt so every settlement does the full work
+        db["GROUPS"].update_one(
+            {"_id": group_id}, {"$inc": {f"balances.{user}": -10, f"balances.{other}": 10}}
+        )
+
+    return [
+        ("groups", "GET", "/groups", None, None),
+        ("group_details", "GET", f"/group/{group_id}", None, None),
+        ("add_expense", "POST", "/add-expense", {
+            "group_id": group_id,
+            "description": "Benchmark",
+            "amount": "12.50",
+            "paid_by": user,
+            "split_with[]": [user, other],
+            "percentages": "0.5,0.5"
+        }, None),
+        ("settle_payment", "POST", "/settle-payment", {
+            "group_id": group_id,
+            "payment_amount": "10"
+        }, owe_money),
+        ("login", "POST", "/login", {"username": user, "password": "bench"}, None),
+    ]
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def run_scenario(client, db, counts, method, path, data, setup, requests, warmup):
+    latencies = []
+    commands = Counter()
+    for i in range(warmup + requests):
+        if setup:
+            setup(db)
+        counts.clear()
+        # Keep the routes' debug prints out of the timings and the report
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {path} returned {response.status_code}")
+        if i >= warmup:
+            latencies.append(elapsed)
+            commands.update(counts)
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "throughput_rps": requests / sum(latencies),
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mongo_commands_per_request": sum(commands.values()) / requests,
+        "mongo_commands": {name: count / requests for name, count in sorted(commands.items())},
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print(f"{'scenario':>15} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'cmds/req':>9}")
+    for name, result in results["scenarios"].items():
+        line = (
+            f"{name:>15} {result['throughput_rps']:>9.1f} {result['p50_ms']:>8.2f} "
+            f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} {result['mongo_commands_per_request']:>9.1f}"
+        )
+        before = (baseline or {}).get("scenarios", {}).get(name)
+        if before:
+            change = (result["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100
+            commands = result["mongo_commands_per_request"] - before["mongo_commands_per_request"]
+            line += f"   p50 {change:+.0f}%, cmds/req {commands:+.1f}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=50)
+    parser.add_argument("--expenses", type=int, default=100, help="expenses per group")
+    parser.add_argument("--skew", type=float, default=1.2, help="Pareto shape of group sizes")
+    parser.add_argument("--requests", type=int, default=200, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4)
+    parser.add_argument("--no-cache", action="store_true", help="disable the app's in-process caches")
+    parser.add_argument("--mongo-uri", help="use a local mongod instead of mongomock")
+    parser.add_argument("--scenario", action="append", help="run only these scenarios")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="show changes against an earlier --output file")
+    args = parser.parse_args()
+
+    # Configure the app before importing it
+    os.environ["MONGO_URI"] = args.mongo_uri or "mongodb://localhost:27017/?serverSelectionTimeoutMS=100"
+    os.environ.setdefault("SECRET_KEY", "benchmark")
+    os.environ["MONGO_DBNAME"] = "splitsmart_benchmark"
+    os.environ["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    # The login scenario signs in far faster than any real client may
+    os.environ["RATE_LIMIT_ENABLED"] = "false"
+    if args.no_cache:
+        os.environ["GROUP_CACHE_ENABLED"] = "false"
+        os.environ["USER_EXISTS_CACHE_ENABLED"] = "false"
+
+    import mongomock
+    from pymongo import MongoClient
+
+    import app
+    from indexes import ensure_indexes
+    from benchmarks.datagen import generate
+
+    if args.mongo_uri:
+        mongo = MongoClient(args.mongo_uri)
+        mongo.drop_database("splitsmart_benchmark")
+        db = mongo["splitsmart_benchmark"]
+    else:
+        db = mongomock.MongoClient()["splitsmart_benchmark"]
+    ensure_indexes(db)
+    dataset = generate(
+        db, seed=args.seed, users=args.users, groups=args.groups,
+        expenses_per_group=args.expenses, skew=args.skew, bcrypt_rounds=args.bcrypt_rounds
+    )
+
+    counts = Counter()
+    app.mydb = db
+
+    def count(collection, command):
+        counts[f"{collection}.{command}"] += 1
+
+    app.col_users = CommandHook(db["USERS"], count)
+    app.col_groups = CommandHook(db["GROUPS"], count)
+    app.col_expenses = CommandHook(db["EXPENSES"], count)
+
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session["username"] = dataset["user"]
+
+    results = {
+        "meta": {
+            "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "git_revision": git_revision(),
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "backend": "mongod" if args.mongo_uri else "mongomock",
+            "seed": args.seed,
+            "cache": not args.no_cache,
+            "dataset": {key: value for key, value in dataset.items() if key != "group_members"},
+        },
+        "scenarios": {},
+    }
+    for name, method, path, data, setup in scenarios(dataset):
+        if args.scenario and name not in args.scenario:
+            continue
+        results["scenarios"][name] = run_scenario(
+            client, db, counts, method, path, data, setup, args.requests, args.warmup
+        )
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.mongo_uri:
+        db.client.drop_database("splitsmart_benchmark")
+
+
+if __name__ == "__main__":
+    main()
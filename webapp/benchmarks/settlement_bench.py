@@ -0,0 +1,67 @@
+"""Compare the heap-based settlement engine with the old creditor-by-creditor loop.
+
+Run from the webapp folder:
+
+    python -m benchmarks.settlement_bench --sizes 10 100 1000 5000
+"""
+import argparse
+import random
+import time
+
+from settlement import suggest_settlements
+
+
+def settle_creditor_by_creditor(balances):
+    """The /settle-payment loop applied to every debtor: pay creditors in dict order."""
+    balances = dict(balances)
+    transfers = []
+    for debtor in list(balances):
+        if balances[debtor] >= 0:
+            continue
+        payment = -balances[debtor]
+        balances[debtor] = 0
+        creditors = [name for name, balance in balances.items() if balance > 0]
+        for creditor in creditors:
+            if payment <= 0:
+                break
+            pay_to_creditor = min(balances[creditor], payment)
+            balances[creditor] -= pay_to_creditor
+            payment -= pay_to_creditor
+            transfers.append({"from": debtor, "to": creditor, "amount": pay_to_creditor})
+    return transfers
+
+
+def random_balances(size, rng):
+    """Balances in whole cents that sum to exactly zero."""
+    cents = [rng.randint(-50000, 50000) for _ in range(size - 1)]
+    cents.append(-sum(cents))
+    return {f"member{i}": amount / 100 for i, amount in enumerate(cents)}
+
+
+def best_time(func, balances, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        transfers = func(balances)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000, len(transfers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'members':>8} {'heap ms':>10} {'heap transfers':>15} {'loop ms':>10} {'loop transfers':>15}")
+    for size in args.sizes:
+        balances = random_balances(size, rng)
+        heap_ms, heap_count = best_time(suggest_settlements, balances, args.repeat)
+        loop_ms, loop_count = best_time(settle_creditor_by_creditor, balances, args.repeat)
+        print(f"{size:>8} {heap_ms:>10.2f} {heap_count:>15} {loop_ms:>10.2f} {loop_count:>15}")
+
+
+if __name__ == "__main__":
+    main()
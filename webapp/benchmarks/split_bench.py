@@ -0,0 +1,67 @@
+"""Compare the integer-cent split engine with the old per-member float rounding.
+
+Both compute an expense's shares and the balance changes it makes. The old way
+rounds each member's share on its own, so the shares can miss the total by a
+few cents; the report counts how many. Run from the webapp folder:
+
+    python -m benchmarks.split_bench --sizes 10 100 1000 10000
+"""
+import argparse
+import random
+import time
+
+from splits import balance_deltas, split_amount
+
+
+def split_per_member(amount, members, percentages):
+    """The old build_expense and expense_balance_deltas: floats, each share rounded alone."""
+    split_among = {member: round(amount * percentages[i], 2) for i, member in enumerate(members)}
+    paid_by = members[0]
+    deltas = {paid_by: 0}
+    for member, share in split_among.items():
+        if member != paid_by:
+            deltas[member] = deltas.get(member, 0) - share
+            deltas[paid_by] += share
+    return split_among, deltas
+
+
+def split_in_cents(amount, members, percentages):
+    shares = split_amount(round(amount * 100), members, "shares", percentages)
+    split_among = dict(zip(members, shares))
+    return split_among, balance_deltas(members[0], split_among)
+
+
+def best_time(func, repeat, *args):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print(f"{'members':>8} {'cents ms':>10} {'float ms':>10} {'float cents off':>16}")
+    for size in args.sizes:
+        members = [f"member{i}" for i in range(size)]
+        amount = rng.randint(100, 10_000_000) / 100
+        weights = [rng.randint(1, 4) for _ in members]
+        # The old path needs fractions summing to 1; give it the closest floats
+        percentages = [weight / sum(weights) for weight in weights]
+
+        cents_ms, (cents_split, _) = best_time(split_in_cents, args.repeat, amount, members, weights)
+        float_ms, (float_split, _) = best_time(split_per_member, args.repeat, amount, members, percentages)
+        assert sum(cents_split.values()) == round(amount * 100)
+        cents_off = round(sum(float_split.values()) * 100) - round(amount * 100)
+        print(f"{size:>8} {cents_ms:>10.2f} {float_ms:>10.2f} {cents_off:>+16}")
+
+
+if __name__ == "__main__":
+    main()
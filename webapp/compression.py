@@ -0,0 +1,113 @@
+"""gzip/brotli response compression and fingerprinted, precompressed static assets.
+
+Brotli is optional: without the ``brotli`` package only gzip is offered.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = {
+    "text/html", "text/css", "text/plain", "text/csv", "text/javascript",
+    "application/javascript", "application/json", "image/svg+xml",
+}
+
+# One year, the longest max-age caches are expected to honour
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def available_encodings():
+    """Content codings this process can produce, most preferred first."""
+    return ["br", "gzip"] if brotli else ["gzip"]
+
+
+def negotiate_encoding(accept_encodings, offered):
+    """The best coding among ``offered`` that the client's Accept-Encoding allows, or None."""
+    return accept_encodings.best_match(offered) if offered else None
+
+
+def compress(data, encoding, static=False):
+    """Compress ``data``; static assets are compressed once, so they get the slowest, smallest setting."""
+    if encoding == "br":
+        return brotli.compress(data, quality=11 if static else 5)
+    return gzip.compress(data, compresslevel=9 if static else 6)
+
+
+def compress_response(response, accept_encodings, min_size=500):
+    """Compress a buffered text or JSON response in place if the client accepts it."""
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    response.vary.add("Accept-Encoding")
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.status_code < 200
+        or response.status_code in (204, 304)
+    ):
+        return response
+
+    data = response.get_data()
+    if len(data) < min_size:
+        return response
+    encoding = negotiate_encoding(accept_encodings, available_encodings())
+    if not encoding:
+        return response
+
+    response.set_data(compress(data, encoding))
+    response.headers["Content-Encoding"] = encoding
+    # The compressed bytes differ from the identity ones, so a strong validator becomes weak
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+class StaticAsset:
+    def __init__(self, filename, data):
+        self.filename = filename
+        self.digest = hashlib.sha256(data).hexdigest()[:12]
+        root, ext = os.path.splitext(filename)
+        self.hashed_filename = f"{root}.{self.digest}{ext}"
+        self.mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        self.variants = {None: data}
+        if self.mimetype in COMPRESSIBLE_MIMETYPES:
+            for encoding in available_encodings():
+                compressed = compress(data, encoding, static=True)
+                if len(compressed) < len(data):
+                    self.variants[encoding] = compressed
+
+
+class StaticAssets:
+    """Every file under a static folder, content-hashed and precompressed in memory.
+
+    ``css/style.css`` is served as ``css/style.<hash>.css``: its URL changes
+    whenever its contents do, so it can be cached forever.
+    """
+
+    def __init__(self, folder):
+        self.by_filename = {}
+        self.by_hashed_filename = {}
+        if not folder or not os.path.isdir(folder):
+            return
+        for directory, _, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(directory, name)
+                filename = os.path.relpath(path, folder).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    asset = StaticAsset(filename, f.read())
+                self.by_filename[filename] = asset
+                self.by_hashed_filename[asset.hashed_filename] = asset
+
+    def hashed_filename(self, filename):
+        """The fingerprinted name for ``filename``, or ``filename`` itself if it isn't known."""
+        asset = self.by_filename.get(filename)
+        return asset.hashed_filename if asset else filename
+
+    def lookup(self, hashed_filename):
+        return self.by_hashed_filename.get(hashed_filename)
@@ -0,0 +1,113 @@
+"""Stream a group's ledger out as CSV or NDJSON, straight from a Mongo cursor.
+
+The export lists every expense and settlement oldest first, archived ones
+included, then the group's
+balances as they stood when the export began. Entries are pulled from the
+cursor ``batch_size`` at a time, and each batch is sent as one chunk, so memory
+use doesn't depend on the size of the group's history.
+"""
+import csv
+import io
+import json
+from itertools import chain
+
+from ledger import ARCHIVE_SUMMARY, batched
+
+# Default number of ledger entries fetched per cursor round trip and sent per chunk
+EXPORT_BATCH_SIZE = 500
+
+CSV_COLUMNS = ["type", "expense_id", "created_at", "description", "amount", "paid_by", "split_among"]
+
+ENTRY_FIELDS = ["kind", "description", "amount", "paid_by", "split_among", "created_at"]
+
+MIMETYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+def ledger_entries(db, group_id, batch_size=EXPORT_BATCH_SIZE):
+    """Cursors over a group's archived and then current ledger entries, oldest first.
+
+    Archiving always takes the oldest entries, so reading EXPENSES_ARCHIVE and
+    then EXPENSES (less the archive summaries) keeps the whole ledger in order.
+    """
+    return [
+        db[collection].find(query, ENTRY_FIELDS).sort([("created_at", 1), ("_id", 1)]).batch_size(batch_size)
+        for collection, query in (
+            ("EXPENSES_ARCHIVE", {"group_id": group_id}),
+            ("EXPENSES", {"group_id": group_id, "kind": {"$ne": ARCHIVE_SUMMARY}}),
+        )
+    ]
+
+
+def entry_record(entry):
+    return {
+        "type": entry.get("kind", "expense"),
+        "expense_id": entry["_id"],
+        "created_at": entry["created_at"].isoformat() + "Z" if entry.get("created_at") else None,
+        "description": entry.get("description"),
+        "amount": entry.get("amount"),
+        "paid_by": entry.get("paid_by"),
+        "split_among": entry.get("split_among", {}),
+    }
+
+
+def balance_records(balances):
+    return [{"type": "balance", "member": member, "balance": balance} for member, balance in balances.items()]
+
+
+# Spreadsheets run a cell starting with one of these as a formula
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def csv_text(value):
+    """Quote user-entered text so a spreadsheet shows it rather than evaluating it."""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_chunks(records_in_batches, balances):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_COLUMNS)
+
+    def flush():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    writer.writeheader()
+    yield flush()
+    for records in records_in_batches:
+        for record in records:
+            record["split_among"] = csv_text(
+                ",".join(f"{name}:{share}" for name, share in record["split_among"].items())
+            )
+            record["description"] = csv_text(record["description"])
+            record["paid_by"] = csv_text(record["paid_by"])
+            writer.writerow(record)
+        yield flush()
+    # Balances share the columns: the member goes under paid_by and the balance under amount
+    for record in balance_records(balances):
+        writer.writerow({"type": "balance", "paid_by": csv_text(record["member"]), "amount": record["balance"]})
+    yield flush()
+
+
+def ndjson_chunks(records_in_batches, balances):
+    for records in records_in_batches:
+        yield "".join(json.dumps(record) + "\n" for record in records)
+    yield "".join(json.dumps(record) + "\n" for record in balance_records(balances))
+
+
+def export_ledger(db, group, fmt, batch_size=EXPORT_BATCH_SIZE):
+    """Yield the export of ``group`` (which must carry ``balances``) in chunks of text."""
+    balances = group.get("balances", {})
+    cursors = ledger_entries(db, group["_id"], batch_size)
+    records_in_batches = (
+        [entry_record(entry) for entry in batch] for batch in batched(chain(*cursors), batch_size)
+    )
+    chunks = csv_chunks if fmt == "csv" else ndjson_chunks
+    try:
+        yield from chunks(records_in_batches, balances)
+    finally:
+        for cursor in cursors:
+            cursor.close()
@@ -0,0 +1,126 @@
+"""Read uploaded expense files (CSV or NDJSON) one row at a time.
+
+Both formats carry the add-expense form's fields: description, amount, paid_by,
+split_with, and optionally split_mode (percentage by default) with its
+split_values. The old percentages column is still read as the split values. In
+CSV, split_with and split_values hold comma-separated lists, like the form; in
+NDJSON they may also be JSON arrays.
+"""
+import codecs
+import csv
+import json
+
+FORMATS = {
+    "csv": "csv",
+    "ndjson": "ndjson",
+    "jsonl": "ndjson",
+    "text/csv": "csv",
+    "application/x-ndjson": "ndjson",
+    "application/jsonl": "ndjson",
+}
+
+
+REQUIRED_FIELDS = ["description", "amount", "paid_by", "split_with"]
+
+
+class ImportRowError(ValueError):
+    """A row that can't be read; reported for that row without stopping the import."""
+
+
+def detect_format(*hints):
+    """Pick the file format from the first hint (format name or MIME type) that names one."""
+    for hint in hints:
+        if not hint:
+            continue
+        hint = hint.lower().split(";")[0].strip()
+        if hint in FORMATS:
+            return FORMATS[hint]
+    return None
+
+
+def text_lines(stream, encoding="utf-8"):
+    """Decode a binary stream line by line without reading it all into memory."""
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    pending = ""
+    for chunk in iter(lambda: stream.read(64 * 1024), b""):
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line + "\n"
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+def split_list(value):
+    if isinstance(value, list):
+        return value
+    return [item.strip() for item in str(value or "").split(",") if item.strip()]
+
+
+def split_values_field(mode):
+    """The field a split mode's values are asked for under, in error messages."""
+    return "percentages" if mode == "percentage" else "split_values"
+
+
+def split_inputs(mode, values):
+    """Normalise a split mode and its raw values (a list or comma-separated string).
+
+    Raises KeyError naming the missing field if a mode other than equal has no values.
+    """
+    mode = str(mode or "percentage").strip().lower()
+    if values is None:
+        if mode != "equal":
+            raise KeyError(split_values_field(mode))
+        return mode, []
+    return mode, [str(value) for value in split_list(values)]
+
+
+def expense_fields(row):
+    """Turn one parsed row into record_expense's (description, amount, paid_by, split_with, values, mode)."""
+    for field in REQUIRED_FIELDS:
+        if row.get(field) is None:
+            raise ImportRowError(f"Missing field: {field}")
+    try:
+        description = str(row["description"]).strip()
+        amount = float(row["amount"])
+        paid_by = str(row["paid_by"]).strip()
+        split_with = [str(member) for member in split_list(row["split_with"])]
+        mode, values = split_inputs(row.get("split_mode"), row.get("split_values", row.get("percentages")))
+    except KeyError as e:
+        raise ImportRowError(f"Missing field: {e.args[0]}")
+    except (TypeError, ValueError) as e:
+        raise ImportRowError(f"Invalid value: {e}")
+    if not description or not paid_by or not split_with:
+        raise ImportRowError("description, paid_by and split_with must not be empty.")
+    return description, amount, paid_by, split_with, values, mode
+
+
+def read_rows(stream, fmt):
+    """Yield ``(row_number, fields or ImportRowError)`` for each row of a binary stream.
+
+    Rows are numbered from 1, not counting the CSV header, and blank lines are skipped.
+    """
+    lines = text_lines(stream)
+    if fmt == "csv":
+        for number, row in enumerate(csv.DictReader(lines), start=1):
+            try:
+                yield number, expense_fields(row)
+            except ImportRowError as e:
+                yield number, e
+        return
+
+    number = 0
+    for line in lines:
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ImportRowError("Each line must be a JSON object.")
+            yield number, expense_fields(row)
+        except json.JSONDecodeError as e:
+            yield number, ImportRowError(f"Invalid JSON: {e.msg}")
+        except ImportRowError as e:
+            yield number, e
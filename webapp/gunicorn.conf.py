@@ -0,0 +1,27 @@
+"""Gunicorn settings for SplitSmart, each overridable from the environment.
+
+The default is a few threaded workers (gthread). Set GUNICORN_WORKER_CLASS=gevent
+to get one event loop per worker instead, as serve_async.py does. Every worker
+opens its own MongoDB pool of up to MONGO_MAX_POOL_SIZE connections, so the
+database sees at most workers x MONGO_MAX_POOL_SIZE of them.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count() * 2 + 1)))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+# Concurrent requests per worker when worker_class is gevent
+worker_connections = int(os.getenv("ASYNC_MAX_CONNECTIONS", "1000"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+# Recycle workers after this many requests (0 never does)
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+# The app doesn't connect to MongoDB at import, so preloading it is fork-safe for
+# gthread workers. Leave it off for gevent, which must patch before the app is imported.
+preload_app = os.getenv("GUNICORN_PRELOAD", "false").lower() == "true"
+accesslog = "-"
+errorlog = "-"
@@ -0,0 +1,94 @@
+"""Index declarations for the SplitSmart collections, plus helpers to apply and audit them."""
+from bson.son import SON
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+# Every index the routes rely on, by collection. create_indexes is a no-op for
+# indexes that already exist, so applying this on every start is safe.
+REQUIRED_INDEXES = {
+    "USERS": [
+        IndexModel([("name", ASCENDING)], unique=True, name="name_unique"),
+    ],
+    "GROUPS": [
+        IndexModel([("group_members", ASCENDING)], name="group_members"),
+        # Only groups whose creation is unfinished carry "pending"
+        IndexModel([("pending", ASCENDING)], sparse=True, name="pending"),
+    ],
+    "EXPENSES": [
+        IndexModel(
+            [("group_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="group_id_created_at"
+        ),
+        # Only archive summaries, so finding a group's latest one skips its expenses
+        IndexModel(
+            [("group_id", ASCENDING), ("kind", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            partialFilterExpression={"kind": "archive_summary"},
+            name="group_id_archive_summaries"
+        ),
+    ],
+    "EXPENSES_ARCHIVE": [
+        IndexModel(
+            [("archive_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="archive_id_created_at"
+        ),
+        IndexModel(
+            [("group_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)],
+            name="group_id_created_at"
+        ),
+    ],
+    "BALANCE_SNAPSHOTS": [
+        IndexModel(
+            [("group_id", ASCENDING), ("through_created_at", DESCENDING), ("through_id", DESCENDING)],
+            name="group_id_through"
+        ),
+    ],
+}
+
+# One representative (collection, filter, sort) per lookup the routes make.
+# Add new query shapes here so check-indexes can catch unindexed ones.
+QUERY_SHAPES = [
+    ("USERS", {"name": "username"}, None),
+    ("GROUPS", {"_id": "group_id"}, None),
+    ("GROUPS", {"_id": {"$in": ["group_id"]}}, None),
+    ("GROUPS", {"group_members": "username"}, None),
+    ("GROUPS", {"pending": True}, None),
+    ("USERS", {"name": {"$in": ["username"]}}, None),
+    ("EXPENSES", {"_id": "expense_id"}, None),
+    ("EXPENSES", {"group_id": "group_id"}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("EXPENSES", {"group_id": "group_id"}, [("created_at", ASCENDING), ("_id", ASCENDING)]),
+    ("EXPENSES", {"group_id": "group_id", "kind": "archive_summary"}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("EXPENSES_ARCHIVE", {"archive_id": "archive_id", "group_id": "group_id"}, [("created_at", DESCENDING), ("_id", DESCENDING)]),
+    ("EXPENSES_ARCHIVE", {"group_id": "group_id"}, [("created_at", ASCENDING), ("_id", ASCENDING)]),
+    ("BALANCE_SNAPSHOTS", {"group_id": {"$in": ["group_id"]}}, None),
+]
+
+
+def ensure_indexes(db):
+    """Create any missing required indexes and return their names."""
+    created = []
+    for collection, models in REQUIRED_INDEXES.items():
+        created.extend(db[collection].create_indexes(models))
+    return created
+
+
+def plan_uses_collscan(plan):
+    """Walk an explain() winning plan and report whether any stage scans the collection."""
+    if isinstance(plan, dict):
+        if plan.get("stage") == "COLLSCAN":
+            return True
+        return any(plan_uses_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(plan_uses_collscan(value) for value in plan)
+    return False
+
+
+def find_collscans(db, shapes=QUERY_SHAPES):
+    """Explain each query shape and return the ones whose winning plan is a COLLSCAN."""
+    collscans = []
+    for collection, query, sort in shapes:
+        command = SON([("find", collection), ("filter", query)])
+        if sort:
+            command["sort"] = SON(sort)
+        explain = db.command("explain", command, verbosity="queryPlanner")
+        if plan_uses_collscan(explain["queryPlanner"]["winningPlan"]):
+            collscans.append((collection, query, sort))
+    return collscans
@@ -0,0 +1,188 @@
+"""Balance snapshots and incremental recomputation from the EXPENSES ledger.
+
+Every expense and settlement is a ledger entry in EXPENSES, until archive.py
+moves it to EXPENSES_ARCHIVE behind a summary row. A group's balances
+can be rebuilt by replaying its entries, but rather than replaying all of them
+we start from the group's latest snapshot in BALANCE_SNAPSHOTS and apply only
+the entries recorded after it.
+"""
+import datetime
+from itertools import islice
+
+from pymongo import DESCENDING
+
+from splits import to_cents
+
+# Kind of the row archive.py leaves in EXPENSES in place of each archived batch
+ARCHIVE_SUMMARY = "archive_summary"
+
+# Groups handled per aggregation by reconcile_balances
+RECONCILE_BATCH_SIZE = 200
+
+# Entries younger than this are never checkpointed, so an expense whose insert
+# is still in flight can't end up behind a snapshot that doesn't include it
+SNAPSHOT_MIN_AGE = datetime.timedelta(minutes=1)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def latest_snapshots(db, group_ids):
+    """Return the newest snapshot of each group in ``group_ids``, keyed by group id."""
+    pipeline = [
+        {"$match": {"group_id": {"$in": group_ids}}},
+        {"$sort": {"group_id": 1, "through_created_at": DESCENDING, "through_id": DESCENDING}},
+        {"$group": {"_id": "$group_id", "snapshot": {"$first": "$$ROOT"}}}
+    ]
+    return {row["_id"]: row["snapshot"] for row in db["BALANCE_SNAPSHOTS"].aggregate(pipeline)}
+
+
+def entries_after(group_id, snapshot):
+    """Match a group's ledger entries recorded after ``snapshot`` (all of them if None)."""
+    if snapshot is None:
+        return {"group_id": group_id}
+    created_at, entry_id = snapshot["through_created_at"], snapshot["through_id"]
+    return {"group_id": group_id, "$or": [
+        {"created_at": {"$gt": created_at}},
+        {"created_at": created_at, "_id": {"$gt": entry_id}}
+    ]}
+
+
+def replay_ledger(db, group_ids):
+    """Rebuild balances for ``group_ids`` from their latest snapshots plus newer entries.
+
+    Returns {group_id: (balances, through)} where through is the (created_at, _id)
+    of the newest entry applied, or the snapshot's if nothing newer was found.
+    All groups are replayed with one aggregation over EXPENSES.
+    """
+    snapshots = latest_snapshots(db, group_ids)
+    shares = [
+        {"$project": {"group_id": 1, "paid_by": 1, "shares": {"$objectToArray": "$split_among"}}},
+        {"$unwind": "$shares"},
+        {"$match": {"$expr": {"$ne": ["$shares.k", "$paid_by"]}}}
+    ]
+    pipeline = [
+        {"$match": {"$or": [entries_after(group_id, snapshots.get(group_id)) for group_id in group_ids]}},
+        {"$facet": {
+            # Each member owes their share of entries paid by someone else...
+            "debits": shares + [{"$group": {
+                "_id": {"group_id": "$group_id", "member": "$shares.k"},
+                "amount": {"$sum": "$shares.v"}
+            }}],
+            # ...and the payer is owed the shares of everyone else
+            "credits": shares + [{"$group": {
+                "_id": {"group_id": "$group_id", "member": "$paid_by"},
+                "amount": {"$sum": "$shares.v"}
+            }}],
+            # Archive summaries stand in for the entries they replaced with their net effect
+            "archived": [
+                {"$match": {"kind": ARCHIVE_SUMMARY}},
+                {"$project": {"group_id": 1, "deltas": {"$objectToArray": "$balance_deltas"}}},
+                {"$unwind": "$deltas"},
+                {"$group": {
+                    "_id": {"group_id": "$group_id", "member": "$deltas.k"},
+                    "amount": {"$sum": "$deltas.v"}
+                }}
+            ],
+            "latest": [
+                {"$sort": {"created_at": DESCENDING, "_id": DESCENDING}},
+                {"$group": {
+                    "_id": "$group_id",
+                    "created_at": {"$first": "$created_at"},
+                    "entry_id": {"$first": "$_id"}
+                }}
+            ]
+        }}
+    ]
+    result = next(db["EXPENSES"].aggregate(pipeline), {"debits": [], "credits": [], "archived": [], "latest": []})
+
+    cents = {}
+    through = {}
+    for group_id in group_ids:
+        snapshot = snapshots.get(group_id)
+        balances = snapshot["balances"] if snapshot else {}
+        cents[group_id] = {member: to_cents(balance) for member, balance in balances.items()}
+        through[group_id] = (snapshot["through_created_at"], snapshot["through_id"]) if snapshot else None
+
+    for sign, rows in ((-1, result["debits"]), (1, result["credits"]), (1, result["archived"])):
+        for row in rows:
+            group_balances = cents[row["_id"]["group_id"]]
+            member = row["_id"]["member"]
+            group_balances[member] = group_balances.get(member, 0) + sign * to_cents(row["amount"])
+    for row in result["latest"]:
+        through[row["_id"]] = (row["created_at"], row["entry_id"])
+
+    return {
+        group_id: ({member: amount / 100 for member, amount in cents[group_id].items()}, through[group_id])
+        for group_id in group_ids
+    }
+
+
+def recompute_balances(db, group_id):
+    """Balances for one group, rebuilt from its latest snapshot and newer entries."""
+    balances, _ = replay_ledger(db, [group_id])[group_id]
+    return balances
+
+
+def save_snapshot(db, group_id, balances, through):
+    """Checkpoint ``balances`` as the state after the ledger entry ``through``."""
+    if through is None:
+        return None
+    created_at, entry_id = through
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    if created_at > now - SNAPSHOT_MIN_AGE:
+        return None
+    snapshot = {
+        "group_id": group_id,
+        "balances": balances,
+        "through_created_at": created_at,
+        "through_id": entry_id,
+        "created_at": now
+    }
+    db["BALANCE_SNAPSHOTS"].update_one(
+        {"group_id": group_id, "through_id": entry_id},
+        {"$setOnInsert": snapshot},
+        upsert=True
+    )
+    return snapshot
+
+
+def snapshot_group(db, group_id):
+    balances, through = replay_ledger(db, [group_id])[group_id]
+    return save_snapshot(db, group_id, balances, through)
+
+
+def invalidate_snapshots(db, entry):
+    """Drop snapshots that include ``entry``, e.g. because it was just deleted."""
+    db["BALANCE_SNAPSHOTS"].delete_many({
+        "group_id": entry["group_id"],
+        "through_created_at": {"$gte": entry["created_at"]}
+    })
+
+
+def balances_match(stored, expected):
+    members = set(stored) | set(expected)
+    return all(to_cents(stored.get(member, 0)) == to_cents(expected.get(member, 0)) for member in members)
+
+
+def reconcile_balances(db, batch_size=RECONCILE_BATCH_SIZE, checkpoint=True):
+    """Compare every group's stored balances with its ledger and report the ones that drifted.
+
+    Groups are replayed in batches, one aggregation per batch, and each group is
+    checkpointed afterwards so the next run only replays entries added since.
+    """
+    drifted = []
+    groups = db["GROUPS"].find({}, {"balances": 1})
+    for batch in batched(groups, batch_size):
+        replayed = replay_ledger(db, [group["_id"] for group in batch])
+        for group in batch:
+            expected, through = replayed[group["_id"]]
+            stored = group.get("balances", {})
+            if not balances_match(stored, expected):
+                drifted.append({"group_id": group["_id"], "stored": stored, "expected": expected})
+            if checkpoint:
+                save_snapshot(db, group["_id"], expected, through)
+    return drifted
@@ -0,0 +1,121 @@
+"""In-process publish/subscribe for live group updates, sent to browsers as Server-Sent Events.
+
+Writers publish to a group's channel without ever waiting on a subscriber:
+each subscriber has a bounded queue, and one that falls that far behind is
+told to resynchronise instead of holding events back. The broker only reaches
+subscribers in the same process, so streams also poll the group's version now
+and then to catch writes made by other workers.
+"""
+import json
+import threading
+from collections import defaultdict, deque
+
+# Returned by Subscription.get in place of the events a slow subscriber missed
+OVERFLOW = object()
+
+
+class BrokerFull(Exception):
+    """Raised when a process already holds as many live streams as it allows."""
+
+
+class Subscription:
+    def __init__(self, broker, channel, queue_size):
+        self.broker = broker
+        self.channel = channel
+        self.queue_size = queue_size
+        self.overflowed = False
+        self._events = deque()
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        """Queue an event; never blocks on the subscriber."""
+        with self._ready:
+            if self.overflowed:
+                return False
+            if len(self._events) >= self.queue_size:
+                # The subscriber will reload the whole group, so the backlog is useless
+                self._events.clear()
+                self.overflowed = True
+            else:
+                self._events.append(event)
+            self._ready.notify()
+            return not self.overflowed
+
+    def get(self, timeout):
+        """The next event, OVERFLOW after missed events, or None if nothing came within ``timeout``."""
+        with self._ready:
+            if not self._events and not self.overflowed:
+                self._ready.wait(timeout)
+            if self.overflowed:
+                self.overflowed = False
+                return OVERFLOW
+            return self._events.popleft() if self._events else None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    """Fan events out to the subscribers of a channel, each with its own bounded queue."""
+
+    def __init__(self, queue_size=64, max_subscribers=1000):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.published = 0
+        self.dropped = 0
+        self._channels = defaultdict(set)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                raise BrokerFull()
+            subscription = Subscription(self, channel, self.queue_size)
+            self._channels[channel].add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._channels.get(subscription.channel)
+            if subscribers and subscription in subscribers:
+                subscribers.remove(subscription)
+                self._count -= 1
+                if not subscribers:
+                    del self._channels[subscription.channel]
+
+    def has_subscribers(self, channel):
+        return bool(self._channels.get(channel))
+
+    def publish(self, channel, event):
+        """Queue ``event`` for every subscriber of ``channel``; returns how many got it."""
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        delivered = 0
+        for subscription in subscribers:
+            if subscription.put(event):
+                delivered += 1
+            else:
+                self.dropped += 1
+        self.published += 1
+        return delivered
+
+    def stats(self):
+        with self._lock:
+            return {
+                "channels": len(self._channels),
+                "subscribers": self._count,
+                "published": self.published,
+                "dropped": self.dropped,
+            }
+
+
+def format_event(name, data, event_id=None):
+    """One Server-Sent Events message with a JSON payload."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {name}")
+    lines.append(f"data: {json.dumps(data, default=str)}")
+    return "\n".join(lines) + "\n\n"
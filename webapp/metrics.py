@@ -0,0 +1,204 @@
+"""Request latency and Mongo command metrics, rendered in the Prometheus text format.
+
+The app records one observation per request, and MongoCommandListener
+attributes every pymongo command to the request that issued it through a
+context variable. Metrics live in each worker process, so Prometheus should
+scrape every worker, not just a load balancer in front of them.
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COMMAND_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+COMMAND_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+logger = logging.getLogger(__name__)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def value(self, *label_values):
+        return self._values.get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        # Per label set: [count per bucket..., count, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def count(self, *label_values):
+        series = self._series.get(label_values)
+        return series[-2] if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ("le",)
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                for bound, cumulative in zip(self.buckets, series):
+                    lines.append(
+                        f"{self.name}_bucket{format_labels(bucket_labels, label_values + (f'{bound:g}',))} {cumulative}"
+                    )
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labels, label_values + ('+Inf',))} {series[-2]}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {series[-2]}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {series[-1]:g}")
+        return lines
+
+
+class RequestStats:
+    """Mongo commands issued while handling one request."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.commands = 0
+        self.command_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add_command(self, seconds):
+        # Lookups run side by side on lookup_pool report into the same request
+        with self._lock:
+            self.commands += 1
+            self.command_seconds += seconds
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+class Metrics:
+    """Every metric the app exports."""
+
+    def __init__(self, command_warn_threshold=25):
+        self.command_warn_threshold = command_warn_threshold
+        self.request_duration = Histogram(
+            "splitsmart_http_request_duration_seconds", "Time spent handling a request.",
+            ("endpoint", "method")
+        )
+        self.requests = Counter(
+            "splitsmart_http_requests_total", "Requests handled, by response status.",
+            ("endpoint", "method", "status")
+        )
+        self.request_commands = Histogram(
+            "splitsmart_mongo_commands_per_request", "Mongo commands issued while handling a request.",
+            ("endpoint",), buckets=COMMAND_COUNT_BUCKETS
+        )
+        self.command_duration = Histogram(
+            "splitsmart_mongo_command_duration_seconds", "Mongo command round trip time.",
+            ("endpoint", "command"), buckets=COMMAND_LATENCY_BUCKETS
+        )
+        self.command_failures = Counter(
+            "splitsmart_mongo_command_failures_total", "Mongo commands that failed.",
+            ("endpoint", "command")
+        )
+        self.heavy_requests = Counter(
+            "splitsmart_mongo_heavy_requests_total",
+            "Requests that issued more Mongo commands than the warning threshold.",
+            ("endpoint",)
+        )
+        self.rate_limited = Counter(
+            "splitsmart_rate_limited_requests_total", "Requests refused with a 429 by a rate limit.",
+            ("limiter",)
+        )
+
+    def start_request(self, endpoint):
+        stats = RequestStats(endpoint)
+        return stats, current_request.set(stats)
+
+    def finish_request(self, stats, token, method, status):
+        current_request.reset(token)
+        self.request_duration.observe(time.perf_counter() - stats.started, stats.endpoint, method)
+        self.requests.inc(stats.endpoint, method, str(status))
+        self.request_commands.observe(stats.commands, stats.endpoint)
+        if self.command_warn_threshold and stats.commands > self.command_warn_threshold:
+            self.heavy_requests.inc(stats.endpoint)
+            logger.warning(
+                "%s %s issued %d Mongo commands (%.1f ms); threshold is %d",
+                method, stats.endpoint, stats.commands, stats.command_seconds * 1000,
+                self.command_warn_threshold
+            )
+
+    def record_command(self, command, seconds, failed=False):
+        stats = current_request.get()
+        endpoint = stats.endpoint if stats else "background"
+        if stats:
+            stats.add_command(seconds)
+        self.command_duration.observe(seconds, endpoint, command)
+        if failed:
+            self.command_failures.inc(endpoint, command)
+
+    def render(self):
+        lines = []
+        for metric in (
+            self.request_duration, self.requests, self.request_commands,
+            self.command_duration, self.command_failures, self.heavy_requests, self.rate_limited,
+        ):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Feed every pymongo command into ``metrics``, attributed to the current request.
+
+    pymongo calls listeners on the thread (or greenlet) that sent the command,
+    so the context variable set for the request is visible here.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.metrics.record_command(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        self.metrics.record_command(event.command_name, event.duration_micros / 1e6, failed=True)
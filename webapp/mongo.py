@@ -0,0 +1,101 @@
+"""A MongoDB connection opened lazily, once per process, with pool settings from the environment.
+
+Nothing connects at import time. The client is created on first use and again
+in any process forked after that, so every worker of a pre-forking server gets
+its own connection pool instead of sharing sockets inherited across fork().
+"""
+import os
+import threading
+
+from pymongo.mongo_client import MongoClient
+
+# Environment variable -> MongoClient option. Unset variables keep pymongo's
+# defaults (100 connections per pool, no idle limit, 30 s server selection).
+POOL_SETTINGS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+}
+
+
+def client_options(environ=os.environ):
+    """The MongoClient pool and timeout options set in ``environ``."""
+    return {
+        option: int(environ[name])
+        for name, option in POOL_SETTINGS.items()
+        if environ.get(name, "").strip()
+    }
+
+
+class LazyMongo:
+    """Owns the process's MongoClient; ``on_connect(db)`` runs after each new client is made."""
+
+    def __init__(self, uri, dbname, on_connect=None, **options):
+        self.uri = uri
+        self.dbname = dbname
+        self.on_connect = on_connect
+        self.options = options
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, uri=None, dbname=None, **options):
+        """Change the connection settings; the next use opens a client with them."""
+        with self._lock:
+            self.uri = uri or self.uri
+            self.dbname = dbname or self.dbname
+            self.options.update(options)
+            self._client = None
+
+    @property
+    def client(self):
+        client = self._client
+        if client is not None and self._pid == os.getpid():
+            return client
+        with self._lock:
+            created = self._client is None or self._pid != os.getpid()
+            if created:
+                # A client inherited from the parent process is dropped, not closed:
+                # its sockets belong to the parent
+                self._client = MongoClient(self.uri, **self.options)
+                self._pid = os.getpid()
+            client = self._client
+        if created and self.on_connect:
+            self.on_connect(client[self.dbname])
+        return client
+
+    @property
+    def database(self):
+        return self.client[self.dbname]
+
+    def db(self):
+        """A stand-in for the database that connects on first use."""
+        return LazyDatabase(self)
+
+    def collection(self, name):
+        """A stand-in for a collection that connects on first use."""
+        return LazyCollection(self, name)
+
+
+class LazyDatabase:
+    def __init__(self, mongo):
+        self._mongo = mongo
+
+    def __getattr__(self, name):
+        return getattr(self._mongo.database, name)
+
+    def __getitem__(self, name):
+        return self._mongo.database[name]
+
+
+class LazyCollection:
+    def __init__(self, mongo, name):
+        self._mongo = mongo
+        self.name = name
+
+    def __getattr__(self, name):
+        return getattr(self._mongo.database[self.name], name)
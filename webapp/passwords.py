@@ -0,0 +1,66 @@
+"""Password hashing on a dedicated, bounded bcrypt worker pool."""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when every bcrypt worker is busy and the wait queue is full."""
+
+
+def green_threads():
+    """True when gevent has patched threading, as serve_async.py and gunicorn's gevent worker do."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+def make_executor(workers):
+    # Under gevent (serve_async.py) ordinary threads become greenlets, and bcrypt
+    # would then block the whole event loop; gevent's pool uses real OS threads
+    if green_threads():
+        from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+        return GeventThreadPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+
+
+def hash_rounds(hashed):
+    """The work factor a bcrypt hash was made with, e.g. 12 for b"$2b$12$..."."""
+    return int(hashed.split(b"$")[2])
+
+
+class PasswordHasher:
+    """Hash and check passwords on at most ``workers`` threads.
+
+    Up to ``max_queue`` more calls may wait for a worker. Beyond that, calls fail
+    at once with PasswordHasherBusy, so a login burst can't tie up every request
+    thread.
+    """
+
+    def __init__(self, workers=4, max_queue=16, rounds=12):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.rounds = rounds
+        self._executor = make_executor(workers)
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        try:
+            return self._executor.submit(func, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds=self.rounds))
+
+    def verify(self, password, hashed):
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), hashed)
+
+    def needs_rehash(self, hashed):
+        """True if ``hashed`` was made with a different work factor than the current one."""
+        return hash_rounds(hashed) != self.rounds
@@ -0,0 +1,107 @@
+"""Token-bucket rate limits, with the buckets kept in a swappable backend.
+
+A limit of ``capacity`` requests per ``period`` seconds lets a client make
+``capacity`` requests in a burst, then one more every ``period / capacity``
+seconds. MemoryBackend keeps the buckets in the worker process, so each worker
+enforces its own limits. A shared backend, Redis for example, only needs to
+implement ``take``.
+"""
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+class RateLimited(Exception):
+    """Raised when a request is over a limit; ``retry_after`` is the wait in seconds."""
+
+    def __init__(self, limiter, retry_after):
+        super().__init__(f"{limiter} rate limit exceeded")
+        self.limiter = limiter
+        self.retry_after = retry_after
+
+
+def parse_rate(value):
+    """``"capacity/period"`` (e.g. ``"10/60"``) -> (10, 60.0)."""
+    capacity, _, period = value.partition("/")
+    return int(capacity), float(period or 1)
+
+
+class RateLimitBackend(ABC):
+    """Where buckets live. ``take`` must be atomic for a given key."""
+
+    @abstractmethod
+    def take(self, key, capacity, refill_per_second):
+        """Take a token from ``key``'s bucket; returns 0 if one was left, else the seconds until one is."""
+
+    @abstractmethod
+    def clear(self):
+        """Drop every bucket."""
+
+
+class MemoryBackend(RateLimitBackend):
+    """Buckets in this process, the least recently used dropped beyond ``maxsize``.
+
+    A dropped bucket comes back full, which only errs towards letting a client in.
+    """
+
+    def __init__(self, maxsize=100000, timer=time.monotonic):
+        self.maxsize = maxsize
+        self._timer = timer
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, refill_per_second):
+        with self._lock:
+            now = self._timer()
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_per_second)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / refill_per_second
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class RateLimiter:
+    """One named limit, such as logins per IP address, applied per key."""
+
+    def __init__(self, name, capacity, period, backend, enabled=True):
+        self.name = name
+        self.capacity = capacity
+        self.period = period
+        self.backend = backend
+        self.enabled = enabled
+        self.allowed = 0
+        self.throttled = 0
+
+    def hit(self, key):
+        """Count a request against ``key``; raises RateLimited if it is over the limit."""
+        if not self.enabled:
+            return
+        wait = self.backend.take(f"{self.name}:{key}", self.capacity, self.capacity / self.period)
+        if wait:
+            self.throttled += 1
+            raise RateLimited(self.name, wait)
+        self.allowed += 1
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "capacity": self.capacity,
+            "period": self.period,
+            "allowed": self.allowed,
+            "throttled": self.throttled,
+        }
@@ -0,0 +1,34 @@
+"""Serve the webapp on gevent so requests don't block each other on Mongo round trips.
+
+Each request runs as a greenlet. After monkey patching, pymongo's socket I/O
+yields to other requests instead of blocking the worker, and the lookups that
+app.run_concurrently issues side by side become greenlets too.
+
+    python serve_async.py
+
+PORT (default 8080) and ASYNC_MAX_CONNECTIONS (default 1000) configure it.
+"""
+from gevent import monkey
+
+# Must run before anything imports socket, ssl or threading
+monkey.patch_all()
+
+import os
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from app import create_app
+
+
+def serve(host="0.0.0.0", port=8080, max_connections=1000):
+    server = WSGIServer((host, port), create_app(), spawn=Pool(max_connections))
+    print(f"Serving on http://{host}:{port} with gevent ({max_connections} concurrent requests)")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    serve(
+        port=int(os.getenv("PORT", "8080")),
+        max_connections=int(os.getenv("ASYNC_MAX_CONNECTIONS", "1000"))
+    )
@@ -0,0 +1,38 @@
+"""Debt simplification: turn a group's balances into a short list of transfers."""
+import heapq
+
+from splits import to_cents
+
+
+def suggest_settlements(balances):
+    """Return transfers that bring every balance in ``balances`` back to zero.
+
+    Positive balances are owed money, negative balances owe it. Each step pairs
+    the largest debtor with the largest creditor and settles the smaller of the
+    two, so at least one of them drops out every time. That gives at most n - 1
+    transfers in O(n log n), which is close to the minimum in practice.
+    """
+    # heapq is a min-heap, so store amounts negated to pop the largest first
+    creditors = []
+    debtors = []
+    for name, balance in balances.items():
+        cents = to_cents(balance)
+        if cents > 0:
+            creditors.append((-cents, name))
+        elif cents < 0:
+            debtors.append((cents, name))
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        owed, creditor = heapq.heappop(creditors)
+        owes, debtor = heapq.heappop(debtors)
+        amount = min(-owed, -owes)
+        transfers.append({"from": debtor, "to": creditor, "amount": amount / 100})
+
+        if -owed > amount:
+            heapq.heappush(creditors, (owed + amount, creditor))
+        if -owes > amount:
+            heapq.heappush(debtors, (owes + amount, debtor))
+    return transfers
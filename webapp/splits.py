@@ -0,0 +1,127 @@
+"""Split an expense among members in whole cents.
+
+Four modes:
+
+- ``equal``: everyone pays the same, give or take a cent.
+- ``shares``: in proportion to weights, so 2 shares pay twice what 1 share does.
+- ``percentage``: in proportion to fractions that add up to exactly 1.
+- ``exact``: the amounts given, which must add up to the total.
+
+Proportional splits use largest-remainder allocation. Each member first gets
+the whole cents of their exact share, then the cents left over go to the largest
+fractional parts, so the shares always add up to the total. Input is parsed as
+Decimal and everything after that is integer arithmetic, done in a fixed number
+of passes over the member list.
+"""
+import heapq
+from decimal import ROUND_HALF_UP, Decimal, DecimalException
+
+MODES = ("equal", "shares", "percentage", "exact")
+
+# Bounds on parsed numbers. Scaling a split value by its decimal places is
+# linear in them, so '1E-999999' would take a million-digit integer, and
+# nothing real costs anywhere near 10^15.
+MAX_MAGNITUDE = 15  # Decimal.adjusted(), i.e. the power of ten of the leading digit
+MAX_SPLIT_PLACES = 6
+
+
+class SplitError(ValueError):
+    """Split input that can't be turned into a split; the message is meant for the user."""
+
+
+def to_decimal(value, max_places=None):
+    """``value`` as a finite Decimal below 10^16, with at most ``max_places`` decimal places if given.
+
+    Extra trailing zeros are dropped rather than refused.
+    """
+    try:
+        number = Decimal(str(value).strip())
+        if not number.is_finite():
+            raise SplitError(f"Not a number: {value!r}.")
+        if number and number.adjusted() > MAX_MAGNITUDE:
+            raise SplitError(f"Too large: {value!r}.")
+        if max_places is not None and number.as_tuple().exponent < -max_places:
+            rounded = number.quantize(Decimal(1).scaleb(-max_places))
+            if rounded != number:
+                raise SplitError(f"Use at most {max_places} decimal places: {value!r}.")
+            number = rounded
+    except DecimalException:
+        raise SplitError(f"Not a number: {value!r}.")
+    return number
+
+
+def to_cents(amount):
+    """An amount of money (string, int, float or Decimal) in whole cents, rounding half up."""
+    try:
+        return int(to_decimal(amount).scaleb(2).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+    except DecimalException:
+        raise SplitError(f"Not an amount of money: {amount!r}.")
+
+
+def integer_weights(values):
+    """Decimals as integers in the same proportions, scaled by their most decimal places."""
+    places = max(0, *(-value.as_tuple().exponent for value in values))
+    return [int(value.scaleb(places)) for value in values]
+
+
+def allocate(total, weights):
+    """Split ``total`` cents in proportion to non-negative integer ``weights``."""
+    weight_sum = sum(weights)
+    if weight_sum <= 0:
+        raise SplitError("Split values must add up to more than zero.")
+    shares = [total * weight // weight_sum for weight in weights]
+    leftover = total - sum(shares)
+    if leftover:
+        remainders = [total * weight % weight_sum for weight in weights]
+        # nlargest is stable, so ties go to the earlier member and a split is repeatable
+        for i in heapq.nlargest(leftover, range(len(remainders)), key=remainders.__getitem__):
+            shares[i] += 1
+    return shares
+
+
+def split_amount(total, members, mode="percentage", values=None):
+    """Each member's share of ``total`` cents, in the order of ``members``.
+
+    ``values`` are the percentages (as fractions), shares or exact amounts for
+    each member; ``equal`` ignores them.
+    """
+    if mode not in MODES:
+        raise SplitError(f"Unknown split mode: {mode}. Use one of {', '.join(MODES)}.")
+    values = [] if mode == "equal" else list(values or ())
+    if mode != "equal" and len(values) != len(members):
+        if mode == "percentage":
+            raise SplitError("The number of split members and percentages do not match.")
+        raise SplitError("The number of split members and split values do not match.")
+    if not members:
+        raise SplitError("Choose at least one member to split with.")
+    if len(set(members)) != len(members):
+        raise SplitError("Each member can only appear once in a split.")
+    if mode == "equal":
+        return allocate(total, [1] * len(members))
+
+    # Large groups repeat a handful of values, so each distinct one is parsed once
+    parsed = {value: to_decimal(value, MAX_SPLIT_PLACES) for value in set(values)}
+    if any(number < 0 for number in parsed.values()):
+        raise SplitError("Split values can't be negative.")
+
+    if mode == "exact":
+        cents = {value: to_cents(number) for value, number in parsed.items()}
+        shares = [cents[value] for value in values]
+        if sum(shares) != total:
+            raise SplitError("Exact amounts must add up to the expense amount.")
+        return shares
+    if mode == "percentage" and sum(parsed[value] for value in values) != 1:
+        raise SplitError("Split percentages must sum to 1.0.")
+    weights = dict(zip(parsed, integer_weights(list(parsed.values()))))
+    return allocate(total, [weights[value] for value in values])
+
+
+def balance_deltas(paid_by, shares):
+    """Each member's balance change in cents, from ``{member: share in cents}``.
+
+    Everyone but the payer owes their share, and the payer is owed the sum of
+    those. The payer is always included, with 0 if they covered only themselves.
+    """
+    deltas = {member: -share for member, share in shares.items() if member != paid_by}
+    deltas[paid_by] = -sum(deltas.values())
+    return deltas
@@ -1,5 +1,12 @@
 import pytest
 import os
+import sys
+import datetime
+import threading
+import csv
+import gzip
+import io
+import json
 from bson import ObjectId
 from unittest.mock import patch
 import mongomock
@@ -10,6 +17,22 @@ os.environ["MONGO_DBNAME"] = "test_database"
 os.environ["SECRET_KEY"] = "test_key"
 
 import app  # Import after env variables are set
+import indexes
+import settlement
+import ledger
+import expense_export
+import archive
+from cache import LRUCache
+from passwords import PasswordHasher, hash_rounds
+from metrics import Metrics, MongoCommandListener
+import mongo
+import compression
+from live_updates import OVERFLOW, Broker, BrokerFull
+from ratelimit import MemoryBackend, RateLimitBackend, RateLimited, RateLimiter
+import splits
+import bcrypt
+from benchmarks.commands import CommandHook
+from pymongo.errors import DuplicateKeyError
 
 @pytest.fixture(scope='session', autouse=True)
 def mock_db():
@@ -17,10 +40,20 @@ def mock_db():
     mock_client = mongomock.MongoClient()
     test_db = mock_client["test_database"]
     # Patch the app's database references
-    app.client = mock_client
     app.mydb = test_db
     app.col_users = test_db["USERS"]
     app.col_groups = test_db["GROUPS"]
+    app.col_expenses = test_db["EXPENSES"]
+    app.col_archive = test_db["EXPENSES_ARCHIVE"]
+    app.ensure_indexes(test_db)
+    # Tests write to the database directly, so only cache tests turn the cache on
+    app.group_cache.enabled = False
+    app.user_exists_cache.enabled = False
+    app.user_version_cache.enabled = False
+    app.fragment_cache.enabled = False
+    # Tests sign in far more often than the limits allow; rate limit tests turn them on
+    for limiter in app.rate_limiters.values():
+        limiter.enabled = False
 
 
 @pytest.fixture
@@ -58,14 +91,98 @@ def test_group(test_user):
         "_id": group_id,
         "group_name": "Test Group",
         "group_members": [test_user["name"]],
-        "balances": {test_user["name"]: 0},
-        "expenses": []
+        "balances": {test_user["name"]: 0}
     }
     app.col_groups.insert_one(group)
     app.col_users.update_one({"_id": test_user["_id"]}, {"$push": {"groups": group_id}})
     yield group
     # Cleanup
     app.col_groups.delete_one({"_id": group_id})
+    app.col_expenses.delete_many({"group_id": group_id})
+    app.col_users.update_one({"_id": test_user["_id"]}, {"$set": {"groups": []}})
+
+class LockedCollection:
+    """Wrap a mongomock collection so each command runs alone, as a real server's would.
+
+    mongomock isn't thread-safe even for a single $inc; with this, only races in
+    the app itself (a read followed by a write, say) can lose updates.
+    """
+
+    def __init__(self, collection, lock):
+        self._collection = collection
+        self._lock = lock
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return locked
+
+
+@pytest.fixture
+def atomic_commands(monkeypatch):
+    """Serialize commands on the app's collections for tests that hammer them from threads."""
+    lock = threading.RLock()
+    for name in ("col_users", "col_groups", "col_expenses"):
+        monkeypatch.setattr(app, name, LockedCollection(getattr(app, name), lock))
+
+
+@pytest.fixture
+def mongo_commands(monkeypatch):
+    """Count the Mongo commands a request issues against the app's collections."""
+    log = []
+    record = lambda collection, command: log.append((collection, command))
+    monkeypatch.setattr(app, "col_users", CommandHook(app.col_users, record))
+    monkeypatch.setattr(app, "col_groups", CommandHook(app.col_groups, record))
+    monkeypatch.setattr(app, "col_expenses", CommandHook(app.col_expenses, record))
+    yield log
+
+
+@pytest.fixture
+def group_cache(monkeypatch):
+    """Turn the group cache on for one test, starting empty."""
+    monkeypatch.setattr(app, "group_cache", LRUCache())
+    yield app.group_cache
+
+@pytest.fixture
+def trip_group(test_user):
+    """A three-member group linked to test_user."""
+    group_id = str(ObjectId())
+    members = [test_user["name"], "alice", "bob"]
+    group = {
+        "_id": group_id,
+        "group_name": "Trip Group",
+        "group_members": members,
+        "balances": {name: 0 for name in members}
+    }
+    app.col_groups.insert_one(group)
+    app.col_users.update_one({"_id": test_user["_id"]}, {"$push": {"groups": group_id}})
+    yield group
+    app.col_groups.delete_one({"_id": group_id})
+    app.col_expenses.delete_many({"group_id": group_id})
+    app.col_archive.delete_many({"group_id": group_id})
+    app.col_users.update_one({"_id": test_user["_id"]}, {"$set": {"groups": []}})
+
+@pytest.fixture
+def many_groups(test_user):
+    """Link test_user to several groups, each with an embedded expense."""
+    group_ids = [str(ObjectId()) for _ in range(5)]
+    for i, group_id in enumerate(group_ids):
+        app.col_groups.insert_one({
+            "_id": group_id,
+            "group_name": f"Group {i}",
+            "group_members": [test_user["name"]],
+            "balances": {test_user["name"]: 0},
+            "expenses": [{"expense_id": str(ObjectId()), "description": "x", "amount": 1.0,
+                          "paid_by": test_user["name"], "split_among": {test_user["name"]: 1.0}}]
+        })
+    app.col_users.update_one({"_id": test_user["_id"]}, {"$push": {"groups": {"$each": group_ids}}})
+    yield group_ids
+    app.col_groups.delete_many({"_id": {"$in": group_ids}})
     app.col_users.update_one({"_id": test_user["_id"]}, {"$set": {"groups": []}})
 
 ### HOME & AUTH TESTS ###
@@ -87,6 +204,26 @@ def test_groups_no_login(client):
     assert response.status_code == 200
     assert b"Login" in response.data
 
+### GROUP SUMMARY LOADING TESTS ###
+
+def test_load_group_summaries_skips_expenses(many_groups):
+    groups = app.load_group_summaries(many_groups)
+    assert [group["_id"] for group in groups] == many_groups
+    assert all("expenses" not in group for group in groups)
+
+def test_load_group_summaries_ignores_missing_groups(many_groups):
+    groups = app.load_group_summaries(["missinggroup"] + many_groups[:2])
+    assert [group["_id"] for group in groups] == many_groups[:2]
+    assert app.load_group_summaries([]) == []
+
+@pytest.mark.parametrize("route", ["/groups", "/add-expense", "/settle-payment"])
+def test_group_pages_use_constant_commands(client, logged_in_user, many_groups, mongo_commands, route):
+    response = client.get(route)
+    assert response.status_code == 200
+    assert b"Group 4" in response.data
+    # One USERS lookup plus one batched GROUPS query, however many groups the user has
+    assert mongo_commands == [("USERS", "find_one"), ("GROUPS", "find")]
+
 ### REGISTRATION TESTS ###
 
 def test_registration_page_loads(client):
@@ -147,6 +284,71 @@ def test_login_valid(client):
     # Check a successful login flash message or redirect
     app.col_users.delete_one({"_id": user_id})
 
+### PASSWORD HASHING TESTS ###
+
+@pytest.fixture
+def fast_user():
+    """A user whose password was hashed with a low work factor."""
+    user_id = ObjectId()
+    app.col_users.insert_one({
+        "_id": user_id,
+        "name": "fastuser",
+        "password": bcrypt.hashpw(b"fastpass", bcrypt.gensalt(rounds=5)),
+        "groups": []
+    })
+    yield {"_id": user_id, "name": "fastuser", "password": "fastpass"}
+    app.col_users.delete_one({"_id": user_id})
+
+def test_password_hasher_round_trip():
+    hasher = PasswordHasher(workers=1, rounds=4)
+    hashed = hasher.hash("secret")
+    assert hash_rounds(hashed) == 4
+    assert hasher.verify("secret", hashed)
+    assert not hasher.verify("wrong", hashed)
+    assert not hasher.needs_rehash(hashed)
+    assert PasswordHasher(workers=1, rounds=5).needs_rehash(hashed)
+
+def test_login_upgrades_hash_when_work_factor_changes(client, fast_user, monkeypatch):
+    monkeypatch.setattr(app, "password_hasher", PasswordHasher(workers=1, rounds=4))
+    data = {"username": fast_user["name"], "password": fast_user["password"]}
+    response = client.post("/login", data=data, follow_redirects=True)
+    assert b"Login successful!" in response.data
+
+    stored = app.col_users.find_one({"_id": fast_user["_id"]})["password"]
+    assert hash_rounds(stored) == 4
+    assert bcrypt.checkpw(b"fastpass", stored)
+
+def test_login_returns_503_when_hasher_saturated(client, fast_user, monkeypatch):
+    hasher = PasswordHasher(workers=1, max_queue=0, rounds=4)
+    monkeypatch.setattr(app, "password_hasher", hasher)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_job():
+        started.set()
+        release.wait(5)
+
+    blocker = threading.Thread(target=hasher._run, args=(slow_job,))
+    blocker.start()
+    started.wait(5)
+    try:
+        data = {"username": fast_user["name"], "password": fast_user["password"]}
+        response = client.post("/login", data=data)
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == app.PASSWORD_RETRY_AFTER
+    finally:
+        release.set()
+        blocker.join()
+
+    response = client.post("/login", data=data, follow_redirects=True)
+    assert b"Login successful!" in response.data
+
+def test_registration_uses_configured_work_factor(client, monkeypatch):
+    monkeypatch.setattr(app, "password_hasher", PasswordHasher(workers=1, rounds=4))
+    client.post("/registration", data={"username": "quickuser", "password": "pw"})
+    user = app.col_users.find_one({"name": "quickuser"})
+    assert hash_rounds(user["password"]) == 4
+    app.col_users.delete_one({"_id": user["_id"]})
+
 ### CHECK-USER TESTS ###
 
 def test_check_user_exists(client, test_user):
@@ -158,6 +360,53 @@ def test_check_user_not_exists(client):
     response = client.get("/check-user?username=notreal")
     assert response.json == {"exists": False}
 
+@pytest.fixture
+def user_exists_cache(monkeypatch):
+    """Turn the username cache on for one test, starting empty."""
+    monkeypatch.setattr(app, "user_exists_cache", LRUCache())
+    yield app.user_exists_cache
+
+def test_check_users_batch_uses_one_query(client, test_user, mongo_commands):
+    response = client.post("/check-users", json={"usernames": ["testuser", " notreal ", "testuser", ""]})
+    assert response.json == {"exists": {"testuser": True, "notreal": False}}
+    assert mongo_commands == [("USERS", "find")]
+
+def test_check_users_served_from_cache(client, test_user, user_exists_cache, mongo_commands):
+    client.post("/check-users", json={"usernames": ["testuser", "notreal"]})
+    del mongo_commands[:]
+    response = client.post("/check-users", json={"usernames": ["testuser", "notreal"]})
+    assert response.json == {"exists": {"testuser": True, "notreal": False}}
+    assert mongo_commands == []
+
+    response = client.get("/check-user?username=notreal")
+    assert response.json == {"exists": False}
+    assert mongo_commands == []
+
+def test_registration_clears_cached_missing_username(client, user_exists_cache, monkeypatch):
+    monkeypatch.setattr(app, "password_hasher", PasswordHasher(workers=1, rounds=4))
+    assert client.get("/check-user?username=brandnew").json == {"exists": False}
+    client.post("/registration", data={"username": "brandnew", "password": "pw"})
+    assert client.get("/check-user?username=brandnew").json == {"exists": True}
+    app.col_users.delete_one({"name": "brandnew"})
+
+@pytest.mark.parametrize("payload", [{}, {"usernames": "testuser"}, {"usernames": [1]},
+                                     {"usernames": ["u"] * (app.MAX_USERNAME_BATCH + 1)}])
+def test_check_users_rejects_bad_payloads(client, payload):
+    response = client.post("/check-users", json=payload)
+    assert response.status_code == 400
+
+### CONCURRENT LOOKUP TESTS ###
+
+def test_run_concurrently_overlaps_calls():
+    # Each call waits for the other, so this only finishes if they run at the same time
+    barrier = threading.Barrier(2, timeout=5)
+
+    def lookup(value):
+        barrier.wait()
+        return value
+
+    assert app.run_concurrently(lambda: lookup("group"), lambda: lookup("expenses")) == ["group", "expenses"]
+
 ### GROUP DETAILS TESTS ###
 
 def test_group_details_no_login(client, test_group):
@@ -171,6 +420,114 @@ def test_group_details_logged_in(client, logged_in_user, test_group):
     assert response.status_code == 200
     assert b"Test Group" in response.data
 
+### INDEX TESTS ###
+
+def test_ensure_indexes_is_idempotent():
+    app.ensure_indexes(app.mydb)
+    app.ensure_indexes(app.mydb)
+    assert "name_unique" in app.col_users.index_information()
+    assert "group_members" in app.col_groups.index_information()
+    assert "group_id_created_at" in app.col_expenses.index_information()
+
+def test_users_name_is_unique(test_user):
+    with pytest.raises(DuplicateKeyError):
+        app.col_users.insert_one({"name": test_user["name"], "password": b"x", "groups": []})
+
+def test_registration_duplicate_insert_race(client, test_user, monkeypatch):
+    # Simulate another request registering the name after the existence check
+    monkeypatch.setattr(app.col_users, "find_one", lambda *args, **kwargs: None)
+    data = {"username": test_user["name"], "password": "newpass"}
+    response = client.post("/registration", data=data, follow_redirects=True)
+    assert b"Username already in use." in response.data
+
+def test_plan_uses_collscan():
+    indexed = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "name_unique"}}
+    scanned = {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}
+    branched = {"stage": "OR", "inputStages": [indexed, scanned]}
+    assert not indexes.plan_uses_collscan(indexed)
+    assert indexes.plan_uses_collscan(scanned)
+    assert indexes.plan_uses_collscan(branched)
+
+def test_find_collscans_reports_unindexed_shapes(monkeypatch):
+    def fake_explain(command_name, command, verbosity):
+        stage = "IXSCAN" if command["find"] == "USERS" else "COLLSCAN"
+        return {"queryPlanner": {"winningPlan": {"stage": "FETCH", "inputStage": {"stage": stage}}}}
+
+    monkeypatch.setattr(app.mydb, "command", fake_explain)
+    shapes = [("USERS", {"name": "x"}, None), ("GROUPS", {"unindexed": 1}, None)]
+    assert indexes.find_collscans(app.mydb, shapes) == [("GROUPS", {"unindexed": 1}, None)]
+
+### EXPENSE PAGINATION TESTS ###
+
+def insert_expenses(group_id, count):
+    start = datetime.datetime(2024, 1, 1)
+    app.col_expenses.insert_many([{
+        "_id": str(ObjectId()),
+        "group_id": group_id,
+        "description": f"Expense {i}",
+        "amount": 1.0,
+        "paid_by": "testuser",
+        "split_among": {"testuser": 1.0},
+        # Pairs of expenses share a timestamp so the _id tiebreak is exercised
+        "created_at": start + datetime.timedelta(seconds=i // 2)
+    } for i in range(count)])
+
+def test_list_group_expenses_pages_newest_first(test_group):
+    insert_expenses(test_group["_id"], 45)
+    seen = []
+    cursor = None
+    while True:
+        page, cursor = app.list_group_expenses(test_group["_id"], before=cursor)
+        seen.extend(expense["description"] for expense in page)
+        if cursor is None:
+            break
+        assert len(page) == app.EXPENSES_PAGE_SIZE
+    assert len(seen) == 45
+    assert len(set(seen)) == 45
+    assert seen[0] in ("Expense 44", "Expense 45")
+
+def test_group_details_paginates(client, logged_in_user, test_group):
+    insert_expenses(test_group["_id"], app.EXPENSES_PAGE_SIZE + 1)
+    response = client.get(f"/group/{test_group['_id']}")
+    assert b"Older Expenses" in response.data
+    assert response.data.count(b"delete-expense-button\"") == app.EXPENSES_PAGE_SIZE
+
+    _, cursor = app.list_group_expenses(test_group["_id"])
+    response = client.get(f"/group/{test_group['_id']}?before={cursor}")
+    assert b"Older Expenses" not in response.data
+    assert b"Newest Expenses" in response.data
+    assert b"Expense 0" in response.data
+
+def test_migrate_embedded_expenses(test_group):
+    expense_id = str(ObjectId())
+    app.col_groups.update_one({"_id": test_group["_id"]}, {"$set": {"expenses": [{
+        "expense_id": expense_id,
+        "description": "Legacy",
+        "amount": 10.0,
+        "paid_by": "testuser",
+        "split_among": {"testuser": 10.0}
+    }]}})
+
+    assert app.migrate_embedded_expenses() == 1
+    # A second run finds nothing left to move
+    assert app.migrate_embedded_expenses() == 0
+
+    assert "expenses" not in app.col_groups.find_one({"_id": test_group["_id"]})
+    migrated = app.col_expenses.find_one({"_id": expense_id})
+    assert migrated["group_id"] == test_group["_id"]
+    assert migrated["description"] == "Legacy"
+    assert migrated["created_at"] == ObjectId(expense_id).generation_time.replace(tzinfo=None)
+
+def test_delete_expense(client, logged_in_user, test_group):
+    insert_expenses(test_group["_id"], 1)
+    expense = app.col_expenses.find_one({"group_id": test_group["_id"]})
+    response = client.delete(f"/delete-expense/{expense['_id']}")
+    assert response.json["success"] is True
+    assert app.col_expenses.find_one({"_id": expense["_id"]}) is None
+
+    response = client.delete(f"/delete-expense/{expense['_id']}")
+    assert response.status_code == 404
+
 ### CREATE GROUP TESTS ###
 
 def test_create_group_logged_out(client):
@@ -191,6 +548,56 @@ def test_create_group_logged_in_nonexistent_member(client, logged_in_user):
 def test_create_group_success(client, logged_in_user, test_user):
     data = {"group_name": "MyNewGroup", "members": "testuser"}
     response = client.post("/create-group", data=data, follow_redirects=True)
+    app.col_groups.delete_many({"group_name": "MyNewGroup"})
+
+@pytest.fixture
+def other_users():
+    names = [f"member{i}" for i in range(6)]
+    app.col_users.insert_many([{"name": name, "password": b"x", "groups": []} for name in names])
+    yield names
+    app.col_users.delete_many({"name": {"$in": names}})
+
+def test_create_group_uses_constant_commands(client, logged_in_user, test_user, other_users, mongo_commands):
+    data = {"group_name": "BigGroup", "members": ",".join(other_users + [other_users[0]])}
+    response = client.post("/create-group", data=data, follow_redirects=True)
+    assert b"BigGroup&#39; created successfully!" in response.data
+
+    # One member lookup and three writes, however many members there are
+    assert mongo_commands[:4] == [
+        ("USERS", "find"), ("GROUPS", "insert_one"), ("USERS", "update_many"), ("GROUPS", "update_one")
+    ]
+    group = app.col_groups.find_one({"group_name": "BigGroup"})
+    assert group["group_members"] == other_users + ["testuser"]
+    assert "pending" not in group
+    for name in other_users + ["testuser"]:
+        assert app.col_users.find_one({"name": name})["groups"] == [group["_id"]]
+    app.col_groups.delete_one({"_id": group["_id"]})
+
+def test_create_group_reports_missing_member(client, logged_in_user, other_users):
+    data = {"group_name": "Partial", "members": f"{other_users[0]}, ghost"}
+    response = client.post("/create-group", data=data, follow_redirects=True)
+    assert b"ghost&#39; does not exist." in response.data
+    assert app.col_groups.find_one({"group_name": "Partial"}) is None
+
+def test_complete_pending_groups(other_users):
+    old_id = str(ObjectId.from_datetime(datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)))
+    new_id = str(ObjectId())
+    for group_id in (old_id, new_id):
+        app.col_groups.insert_one({
+            "_id": group_id, "group_name": "Interrupted", "group_members": other_users[:2],
+            "balances": {}, "pending": True
+        })
+
+    assert app.complete_pending_groups() == [old_id]
+    assert "pending" not in app.col_groups.find_one({"_id": old_id})
+    assert app.col_groups.find_one({"_id": new_id})["pending"] is True
+    assert app.col_users.find_one({"name": other_users[0]})["groups"] == [old_id]
+
+    # Running it again doesn't add the group twice
+    app.col_groups.update_one({"_id": old_id}, {"$set": {"pending": True}})
+    app.complete_pending_groups()
+    assert app.col_users.find_one({"name": other_users[0]})["groups"] == [old_id]
+    app.col_groups.delete_many({"_id": {"$in": [old_id, new_id]}})
 
 ### ADD EXPENSE TESTS ###
 
@@ -244,13 +651,327 @@ def test_add_expense_success(client, logged_in_user, test_group):
 
     updated_group = app.col_groups.find_one({"_id": test_group["_id"]})
     assert updated_group is not None
-    assert len(updated_group["expenses"]) == 1
-    expense = updated_group["expenses"][0]
+    assert "expenses" not in updated_group
+    expenses = list(app.col_expenses.find({"group_id": test_group["_id"]}))
+    assert len(expenses) == 1
+    expense = expenses[0]
     assert expense["description"] == "Test Dinner"
     assert expense["amount"] == 100.0
     assert expense["paid_by"] == "testuser"
     assert expense["split_among"]["testuser"] == 100.0
 
+def post_trip_expense(client, group_id, amount="90"):
+    data = {
+        "group_id": group_id,
+        "description": "Groceries",
+        "amount": amount,
+        "paid_by": "testuser",
+        "split_with[]": ["testuser", "alice", "bob"],
+        "percentages": "0.5,0.25,0.25"
+    }
+    return client.post("/add-expense", data=data, follow_redirects=True)
+
+def test_add_expense_increments_balances(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"])
+    post_trip_expense(client, trip_group["_id"])
+    balances = app.col_groups.find_one({"_id": trip_group["_id"]})["balances"]
+    assert balances == {"testuser": 90.0, "alice": -45.0, "bob": -45.0}
+
+def test_add_expense_member_outside_group(client, logged_in_user, test_group):
+    data = {
+        "group_id": test_group["_id"],
+        "description": "Stranger",
+        "amount": "10",
+        "paid_by": "testuser",
+        "split_with[]": ["testuser", "stranger"],
+        "percentages": "0.5,0.5"
+    }
+    response = client.post("/add-expense", data=data, follow_redirects=True)
+    assert b"Error adding expense:" in response.data
+    assert app.col_expenses.count_documents({"group_id": test_group["_id"]}) == 0
+    assert app.col_groups.find_one({"_id": test_group["_id"]})["balances"] == {"testuser": 0}
+
+def test_delete_expense_reverses_balances(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    post_trip_expense(client, trip_group["_id"], amount="90")
+    expense = app.col_expenses.find_one({"group_id": trip_group["_id"], "amount": 60.0})
+
+    client.delete(f"/delete-expense/{expense['_id']}")
+    balances = app.col_groups.find_one({"_id": trip_group["_id"]})["balances"]
+    assert balances == {"testuser": 45.0, "alice": -22.5, "bob": -22.5}
+
+def test_add_expense_applies_balances_in_one_increment(trip_group, mongo_commands, monkeypatch):
+    # Concurrent adds can't lose each other's changes if balances are never read
+    # back and rewritten, only changed by a single $inc on the server
+    updates = []
+    update_one = app.col_groups.update_one
+    monkeypatch.setattr(app.col_groups, "update_one", lambda query, update: updates.append(update) or update_one(query, update))
+
+    app.record_expense(trip_group["_id"], "Groceries", "4", "testuser", ["testuser", "alice", "bob"], ["0.5", "0.25", "0.25"])
+    assert [command for command in mongo_commands if command[0] == "GROUPS"] == [("GROUPS", "update_one")]
+    assert updates[0]["$inc"] == {"balances.testuser": 2.0, "balances.alice": -1.0, "balances.bob": -1.0, "version": 1}
+
+def test_concurrent_expenses_keep_balances_consistent(test_user, trip_group, atomic_commands):
+    writers, per_writer = 8, 25
+
+    def hammer():
+        with app.app.test_client() as thread_client:
+            with thread_client.session_transaction() as sess:
+                sess["username"] = test_user["name"]
+            for _ in range(per_writer):
+                post_trip_expense(thread_client, trip_group["_id"], amount="4")
+
+    # Switch threads as often as possible so read-modify-write races would show up
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        threads = [threading.Thread(target=hammer) for _ in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    total = writers * per_writer
+    assert app.col_expenses.count_documents({"group_id": trip_group["_id"]}) == total
+    balances = app.col_groups.find_one({"_id": trip_group["_id"]})["balances"]
+    assert balances == {"testuser": 2.0 * total, "alice": -1.0 * total, "bob": -1.0 * total}
+
+def test_expense_routes_need_group_membership(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    expense = app.col_expenses.find_one({"group_id": trip_group["_id"]})
+    app.col_users.insert_one({"name": "mallory", "password": b"x", "groups": []})
+    with client.session_transaction() as sess:
+        sess["username"] = "mallory"
+
+    assert client.delete(f"/delete-expense/{expense['_id']}").status_code == 404
+    client.post("/add-expense", data={
+        "group_id": trip_group["_id"], "description": "Debt", "amount": "50", "paid_by": "alice",
+        "split_with[]": ["bob"], "percentages": "1"
+    })
+    app.col_users.delete_one({"name": "mallory"})
+    assert app.col_expenses.count_documents({"group_id": trip_group["_id"]}) == 1
+    assert stored_balances(trip_group["_id"]) == {"testuser": 30.0, "alice": -15.0, "bob": -15.0}
+
+def test_usernames_that_break_balance_paths_are_rejected(client, logged_in_user, trip_group):
+    for username in ("a.b", "$where"):
+        response = client.post("/registration", data={"username": username, "password": "pw"}, follow_redirects=True)
+        assert b"can&#39;t contain" in response.data
+        assert app.col_users.find_one({"name": username}) is None
+
+    app.col_users.insert_one({"name": "old.name", "password": b"x", "groups": []})
+    response = client.post("/create-group", data={"group_name": "G", "members": "old.name"}, follow_redirects=True)
+    assert b"can&#39;t be added to a group" in response.data
+    app.col_users.delete_one({"name": "old.name"})
+
+### SUGGESTED SETTLEMENT TESTS ###
+
+def test_suggest_settlements_clears_balances():
+    balances = {"a": -30.0, "b": -20.5, "c": 10.25, "d": 40.25, "e": 0}
+    transfers = settlement.suggest_settlements(balances)
+    remaining = {name: splits.to_cents(balance) for name, balance in balances.items()}
+    for transfer in transfers:
+        assert transfer["amount"] > 0
+        remaining[transfer["from"]] += splits.to_cents(transfer["amount"])
+        remaining[transfer["to"]] -= splits.to_cents(transfer["amount"])
+    assert set(remaining.values()) == {0}
+    # Never more than one transfer per member with a non-zero balance, minus one
+    assert len(transfers) <= 3
+
+def test_suggest_settlements_pairs_largest_first():
+    transfers = settlement.suggest_settlements({"a": -50, "b": -10, "c": 50, "d": 10})
+    assert transfers == [
+        {"from": "a", "to": "c", "amount": 50.0},
+        {"from": "b", "to": "d", "amount": 10.0}
+    ]
+
+def test_suggest_settlements_all_settled():
+    assert settlement.suggest_settlements({"a": 0, "b": 0.001}) == []
+
+def test_group_settlements_endpoint(client, logged_in_user, test_group):
+    app.col_groups.update_one(
+        {"_id": test_group["_id"]},
+        {"$set": {"balances": {"testuser": -25, "creditor": 25}}}
+    )
+    response = client.get(f"/group/{test_group['_id']}/settlements")
+    assert response.json["settlements"] == [{"from": "testuser", "to": "creditor", "amount": 25.0}]
+
+    response = client.get("/group/missinggroup/settlements")
+    assert response.status_code == 404
+
+    with client.session_transaction() as sess:
+        sess["username"] = "mallory"
+    response = client.get(f"/group/{test_group['_id']}/settlements")
+    assert response.status_code == 404
+
+def test_group_settlements_not_logged_in(client, test_group):
+    response = client.get(f"/group/{test_group['_id']}/settlements")
+    assert response.status_code == 401
+
+def test_group_details_shows_suggested_settlements(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"], amount="40")
+    response = client.get(f"/group/{trip_group['_id']}")
+    assert b"alice pays testuser $10.00" in response.data
+    assert b"bob pays testuser $10.00" in response.data
+
+    with client.session_transaction() as sess:
+        sess["username"] = "mallory"
+    response = client.get(f"/group/{trip_group['_id']}", follow_redirects=True)
+    assert b"pays" not in response.data
+    assert b"Group not found." in response.data
+
+### LEDGER SNAPSHOT & RECONCILIATION TESTS ###
+
+@pytest.fixture
+def no_snapshot_age(monkeypatch):
+    """Allow snapshots of entries created moments ago."""
+    monkeypatch.setattr(ledger, "SNAPSHOT_MIN_AGE", datetime.timedelta(0))
+
+def stored_balances(group_id):
+    return app.col_groups.find_one({"_id": group_id})["balances"]
+
+def test_recompute_balances_matches_stored(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    post_trip_expense(client, trip_group["_id"], amount="90")
+    assert ledger.recompute_balances(app.mydb, trip_group["_id"]) == stored_balances(trip_group["_id"])
+
+def test_recompute_applies_only_entries_after_snapshot(client, logged_in_user, trip_group, no_snapshot_age):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    snapshot = ledger.snapshot_group(app.mydb, trip_group["_id"])
+    assert snapshot["balances"] == {"testuser": 30.0, "alice": -15.0, "bob": -15.0}
+
+    # Entries covered by the snapshot are not replayed again
+    app.col_expenses.update_many({"group_id": trip_group["_id"]}, {"$set": {"split_among": {}}})
+    post_trip_expense(client, trip_group["_id"], amount="40")
+    assert ledger.recompute_balances(app.mydb, trip_group["_id"]) == {
+        "testuser": 50.0, "alice": -25.0, "bob": -25.0
+    }
+
+def test_snapshot_skips_entries_still_in_flight(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    assert ledger.snapshot_group(app.mydb, trip_group["_id"]) is None
+
+def test_delete_expense_invalidates_snapshots(client, logged_in_user, trip_group, no_snapshot_age):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    post_trip_expense(client, trip_group["_id"], amount="90")
+    ledger.snapshot_group(app.mydb, trip_group["_id"])
+    expense = app.col_expenses.find_one({"group_id": trip_group["_id"], "amount": 60.0})
+
+    client.delete(f"/delete-expense/{expense['_id']}")
+    assert app.mydb["BALANCE_SNAPSHOTS"].count_documents({"group_id": trip_group["_id"]}) == 0
+    assert ledger.recompute_balances(app.mydb, trip_group["_id"]) == stored_balances(trip_group["_id"])
+
+def test_reconcile_reports_drifted_groups(client, logged_in_user, trip_group, test_group, no_snapshot_age):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    app.col_groups.update_one({"_id": trip_group["_id"]}, {"$inc": {"balances.alice": 5}})
+
+    drifted = [group for group in ledger.reconcile_balances(app.mydb, batch_size=1)
+               if group["group_id"] in (trip_group["_id"], test_group["_id"])]
+    assert drifted == [{
+        "group_id": trip_group["_id"],
+        "stored": {"testuser": 30.0, "alice": -10.0, "bob": -15.0},
+        "expected": {"testuser": 30.0, "alice": -15.0, "bob": -15.0}
+    }]
+    assert app.mydb["BALANCE_SNAPSHOTS"].count_documents({"group_id": trip_group["_id"]}) == 1
+    app.mydb["BALANCE_SNAPSHOTS"].delete_many({"group_id": trip_group["_id"]})
+
+def test_settlement_is_recorded_in_ledger(client, logged_in_user, trip_group):
+    app.col_users.insert_one({"name": "alice", "password": b"x", "groups": [trip_group["_id"]]})
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    with client.session_transaction() as sess:
+        sess["username"] = "alice"
+    client.post("/settle-payment", data={"group_id": trip_group["_id"], "payment_amount": "10"})
+    app.col_users.delete_one({"name": "alice"})
+
+    assert stored_balances(trip_group["_id"]) == {"testuser": 20.0, "alice": -5.0, "bob": -15.0}
+    entry = app.col_expenses.find_one({"group_id": trip_group["_id"], "kind": "settlement"})
+    assert entry["paid_by"] == "alice"
+    assert entry["split_among"] == {"testuser": 10.0}
+    assert ledger.recompute_balances(app.mydb, trip_group["_id"]) == stored_balances(trip_group["_id"])
+
+### GROUP CACHE TESTS ###
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+def test_lru_cache_expires_entries():
+    timer = FakeTimer()
+    cache = LRUCache(ttl=10, timer=timer)
+    cache.set("a", 1)
+    timer.now = 9.9
+    assert cache.get("a") == 1
+    timer.now = 10
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["size"] == 0
+
+def test_lru_cache_disabled():
+    cache = LRUCache(enabled=False)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert cache.stats()["size"] == 0
+
+def test_lru_cache_delete_where():
+    cache = LRUCache()
+    cache.set(("summary", "g1"), 1)
+    cache.set(("expenses", "g1", None), 2)
+    cache.set(("summary", "g2"), 3)
+    cache.delete_where(lambda key: key[1] == "g1")
+    assert cache.stats()["size"] == 1
+    assert cache.get(("summary", "g2")) == 3
+
+def test_groups_page_served_from_cache(client, logged_in_user, many_groups, group_cache, mongo_commands):
+    client.get("/groups")
+    del mongo_commands[:]
+    response = client.get("/groups")
+    assert b"Group 4" in response.data
+    assert mongo_commands == [("USERS", "find_one")]
+    assert group_cache.stats()["hits"] == len(many_groups)
+
+def test_group_details_served_from_cache(client, logged_in_user, trip_group, group_cache, mongo_commands):
+    client.get(f"/group/{trip_group['_id']}")
+    del mongo_commands[:]
+    response = client.get(f"/group/{trip_group['_id']}")
+    assert b"Trip Group" in response.data
+    assert mongo_commands == []
+
+def test_writes_invalidate_group_cache(client, logged_in_user, trip_group, group_cache):
+    client.get(f"/group/{trip_group['_id']}")
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    response = client.get(f"/group/{trip_group['_id']}")
+    assert b"Groceries" in response.data
+    assert b"Owed $30.0" in response.data
+
+    expense = app.col_expenses.find_one({"group_id": trip_group["_id"]})
+    client.delete(f"/delete-expense/{expense['_id']}")
+    response = client.get(f"/group/{trip_group['_id']}")
+    assert b"Groceries" not in response.data
+    assert b"Owed $" not in response.data
+
+def test_cache_stats_endpoint(client, group_cache):
+    group_cache.set(("summary", "g"), {})
+    group_cache.get(("summary", "g"))
+    response = client.get("/cache-stats")
+    assert response.json["hits"] == 1
+    assert response.json["size"] == 1
+
 ### SETTLE PAYMENTS TESTS ###
 
 def test_settle_payment_not_logged_in(client):
@@ -336,3 +1057,899 @@ def test_settle_payment_partial_balance(client, logged_in_user, test_group):
     updated_group = app.col_groups.find_one({"_id": test_group["_id"]})
     assert updated_group["balances"][test_group["group_members"][0]] == -25
     assert updated_group["balances"]["creditor"] == 25
+
+
+### JSON API TESTS ###
+
+def api_trip_expense(client, group_id, amount=90):
+    return client.post(f"/api/v1/groups/{group_id}/expenses", json={
+        "description": "Groceries",
+        "amount": amount,
+        "split_with": ["testuser", "alice", "bob"],
+        "percentages": [0.5, 0.25, 0.25]
+    })
+
+def test_api_requires_login(client, trip_group):
+    assert client.get("/api/v1/groups").status_code == 401
+    assert client.get(f"/api/v1/groups/{trip_group['_id']}").status_code == 401
+
+def test_api_groups_lists_groups(client, logged_in_user, trip_group):
+    response = client.get("/api/v1/groups")
+    assert response.status_code == 200
+    assert response.headers["ETag"]
+    assert [group["group_id"] for group in response.json["groups"]] == [trip_group["_id"]]
+
+def test_api_group_details_returns_304_until_a_write(client, logged_in_user, trip_group):
+    url = f"/api/v1/groups/{trip_group['_id']}"
+    first = client.get(url)
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+
+    cached = client.get(url, headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.data == b""
+
+    api_trip_expense(client, trip_group["_id"])
+    changed = client.get(url, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json["balances"] == {"testuser": 45.0, "alice": -22.5, "bob": -22.5}
+
+def other_worker_expense(group_id):
+    """Write an expense the way another worker would, without touching this worker's caches."""
+    app.col_expenses.insert_one({
+        "_id": str(ObjectId()), "group_id": group_id, "description": "Elsewhere", "amount": 10.0,
+        "paid_by": "alice", "split_among": {"testuser": 10.0}, "created_at": datetime.datetime.utcnow()
+    })
+    app.col_groups.update_one(
+        {"_id": group_id},
+        {"$inc": {"balances.alice": 10.0, "balances.testuser": -10.0, "version": 1}}
+    )
+
+def test_api_body_is_never_older_than_its_etag(client, logged_in_user, trip_group, group_cache):
+    url = f"/api/v1/groups/{trip_group['_id']}"
+    client.get(url)
+    client.get("/api/v1/groups")
+    other_worker_expense(trip_group["_id"])
+
+    response = client.get(url)
+    assert response.json["version"] == 1
+    assert [expense["description"] for expense in response.json["expenses"]] == ["Elsewhere"]
+    assert response.json["balances"]["alice"] == 10.0
+    group = client.get("/api/v1/groups").json["groups"][0]
+    assert (group["version"], group["balances"]["alice"]) == (1, 10.0)
+
+def test_malformed_cursors_are_rejected(client, logged_in_user, trip_group):
+    for before in ("garbage", "99999999999999999999_x", "123_"):
+        assert client.get(f"/api/v1/groups/{trip_group['_id']}?before={before}").status_code == 400
+        assert client.get(f"/group/{trip_group['_id']}/archive/a1?before={before}").status_code == 400
+        # The page itself just starts from the newest expenses
+        assert client.get(f"/group/{trip_group['_id']}?before={before}").status_code == 200
+
+def test_api_not_modified_skips_full_read(client, logged_in_user, trip_group, mongo_commands):
+    url = f"/api/v1/groups/{trip_group['_id']}"
+    etag = client.get(url).headers["ETag"]
+    mongo_commands.clear()
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    assert mongo_commands == [("GROUPS", "find_one")]
+
+def test_api_groups_if_modified_since(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"])
+    last_modified = client.get("/api/v1/groups").headers["Last-Modified"]
+    response = client.get("/api/v1/groups", headers={"If-Modified-Since": last_modified})
+    assert response.status_code == 304
+
+def test_writes_bump_group_version(client, logged_in_user, trip_group):
+    def version():
+        return app.col_groups.find_one({"_id": trip_group["_id"]}).get("version", 0)
+
+    api_trip_expense(client, trip_group["_id"])
+    assert version() == 1
+    expense = app.col_expenses.find_one({"group_id": trip_group["_id"]})
+    assert client.delete(f"/api/v1/expenses/{expense['_id']}").status_code == 200
+    assert version() == 2
+
+def test_api_add_expense_validates(client, logged_in_user, trip_group):
+    response = client.post(f"/api/v1/groups/{trip_group['_id']}/expenses", json={
+        "description": "Groceries", "amount": 90,
+        "split_with": ["testuser", "alice"], "percentages": [0.5, 0.25]
+    })
+    assert response.status_code == 400
+    assert response.json["message"] == "Split percentages must sum to 1.0."
+
+    response = client.post(f"/api/v1/groups/{trip_group['_id']}/expenses", json={"amount": 90})
+    assert response.status_code == 400
+
+def test_api_hides_other_groups(client, logged_in_user, trip_group):
+    app.col_groups.update_one({"_id": trip_group["_id"]}, {"$pull": {"group_members": "testuser"}})
+    assert client.get(f"/api/v1/groups/{trip_group['_id']}").status_code == 404
+    assert api_trip_expense(client, trip_group["_id"]).status_code == 404
+
+def test_api_settle_payment(client, logged_in_user, trip_group):
+    app.col_groups.update_one(
+        {"_id": trip_group["_id"]},
+        {"$set": {"balances": {"testuser": -30, "alice": 20, "bob": 10}}}
+    )
+    response = client.post(f"/api/v1/groups/{trip_group['_id']}/settlements", json={"amount": 25})
+    assert response.status_code == 201
+    assert response.json["paid_to"] == {"alice": 20, "bob": 5}
+    assert stored_balances(trip_group["_id"]) == {"testuser": -5, "alice": 0, "bob": 5}
+
+    response = client.post(f"/api/v1/groups/{trip_group['_id']}/settlements", json={"amount": 0})
+    assert response.status_code == 400
+
+
+### EXPENSE IMPORT TESTS ###
+
+TRIP_CSV = (
+    'description,amount,paid_by,split_with,percentages\n'
+    'Groceries,90,testuser,"testuser,alice,bob","0.5,0.25,0.25"\n'
+    'Taxi,40,alice,"alice,bob","0.5,0.6"\n'
+    'Museum,20,bob,"bob,carol","0.5,0.5"\n'
+    'Dinner,30,alice,"testuser,alice","0.5,0.5"\n'
+)
+
+def import_lines(response):
+    return [json.loads(line) for line in response.data.decode().splitlines()]
+
+def test_import_csv_reports_each_row(client, logged_in_user, trip_group):
+    response = client.post(
+        f"/api/v1/groups/{trip_group['_id']}/expenses/import",
+        data=TRIP_CSV, content_type="text/csv", buffered=True
+    )
+    lines = import_lines(response)
+    assert [line["ok"] for line in lines[:4]] == [True, False, False, True]
+    assert lines[1]["message"] == "Split percentages must sum to 1.0."
+    assert lines[2]["message"] == "Members are not part of the group."
+    assert lines[4] == {"imported": 2, "failed": 2}
+    assert stored_balances(trip_group["_id"]) == {"testuser": 30.0, "alice": -7.5, "bob": -22.5}
+    assert app.col_expenses.count_documents({"group_id": trip_group["_id"]}) == 2
+
+def test_import_ndjson_body(client, logged_in_user, trip_group):
+    body = "\n".join([
+        json.dumps({"description": "Tickets", "amount": 60, "paid_by": "bob",
+                    "split_with": ["alice", "bob"], "percentages": [0.5, 0.5]}),
+        "",
+        "not json",
+        json.dumps({"description": "Snacks", "amount": 10}),
+    ])
+    response = client.post(
+        f"/api/v1/groups/{trip_group['_id']}/expenses/import",
+        data=body, content_type="application/x-ndjson", buffered=True
+    )
+    lines = import_lines(response)
+    assert [line["row"] for line in lines[:3]] == [1, 2, 3]
+    assert lines[1]["message"].startswith("Invalid JSON")
+    assert lines[2]["message"] == "Missing field: paid_by"
+    assert stored_balances(trip_group["_id"])["alice"] == -30.0
+
+def test_import_writes_in_batches(client, logged_in_user, trip_group, mongo_commands, monkeypatch):
+    monkeypatch.setattr(app, "IMPORT_BATCH_SIZE", 10)
+    rows = "".join(f'Row {i},4,testuser,"testuser,alice","0.5,0.5"\n' for i in range(25))
+    response = client.post(
+        f"/api/v1/groups/{trip_group['_id']}/expenses/import?format=csv",
+        data="description,amount,paid_by,split_with,percentages\n" + rows,
+        content_type="text/plain", buffered=True
+    )
+    assert import_lines(response)[-1] == {"imported": 25, "failed": 0}
+    writes = [command for command in mongo_commands if command[1] in ("update_one", "insert_many")]
+    assert len(writes) == 6
+    assert stored_balances(trip_group["_id"]) == {"testuser": 50.0, "alice": -50.0, "bob": 0}
+
+def test_import_rejects_unknown_format(client, logged_in_user, trip_group):
+    response = client.post(
+        f"/api/v1/groups/{trip_group['_id']}/expenses/import",
+        data="whatever", content_type="text/plain"
+    )
+    assert response.status_code == 400
+
+
+### LEDGER EXPORT TESTS ###
+
+def test_export_csv(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"], amount="40")
+    with client.session_transaction() as sess:
+        sess["username"] = "mallory"
+    response = client.get(f"/api/v1/groups/{trip_group['_id']}/export")
+    assert response.status_code == 404
+
+    with client.session_transaction() as sess:
+        sess["username"] = "testuser"
+    response = client.get(f"/api/v1/groups/{trip_group['_id']}/export", buffered=True)
+    assert response.mimetype == "text/csv"
+    assert "attachment" in response.headers["Content-Disposition"]
+    rows = list(csv.DictReader(io.StringIO(response.data.decode())))
+    assert [row["type"] for row in rows] == ["expense", "balance", "balance", "balance"]
+    assert rows[0]["split_among"] == "testuser:20.0,alice:10.0,bob:10.0"
+    assert {row["paid_by"]: float(row["amount"]) for row in rows[1:]} == {
+        "testuser": 20.0, "alice": -10.0, "bob": -10.0
+    }
+
+def test_export_csv_defuses_formulas(client, logged_in_user, trip_group):
+    app.col_expenses.insert_one({
+        "_id": str(ObjectId()), "group_id": trip_group["_id"], "description": "=HYPERLINK(\"x\")",
+        "amount": 5.0, "paid_by": "testuser", "split_among": {"testuser": 5.0},
+        "created_at": datetime.datetime(2024, 1, 1)
+    })
+    response = client.get(f"/api/v1/groups/{trip_group['_id']}/export", buffered=True)
+    rows = list(csv.DictReader(io.StringIO(response.data.decode())))
+    assert rows[0]["description"] == "'=HYPERLINK(\"x\")"
+    assert rows[0]["amount"] == "5.0"
+
+def test_export_ndjson_includes_settlements(client, logged_in_user, trip_group):
+    app.col_groups.update_one(
+        {"_id": trip_group["_id"]},
+        {"$set": {"balances": {"testuser": -30, "alice": 20, "bob": 10}}}
+    )
+    client.post(f"/api/v1/groups/{trip_group['_id']}/settlements", json={"amount": 30})
+    response = client.get(f"/api/v1/groups/{trip_group['_id']}/export?format=ndjson", buffered=True)
+    lines = import_lines(response)
+    assert lines[0]["type"] == "settlement"
+    assert lines[0]["split_among"] == {"alice": 20, "bob": 10}
+    assert lines[1:] == [
+        {"type": "balance", "member": name, "balance": 0} for name in ["testuser", "alice", "bob"]
+    ]
+
+def test_export_streams_one_chunk_per_batch(trip_group):
+    insert_expenses(trip_group["_id"], 5)
+    group = app.col_groups.find_one({"_id": trip_group["_id"]})
+    chunks = list(expense_export.export_ledger(app.mydb, group, "csv", batch_size=2))
+    # Header, three batches of entries, balances
+    assert len(chunks) == 5
+    assert chunks[0].startswith("type,expense_id")
+
+
+### METRICS TESTS ###
+
+class FakeCommandEvent:
+    def __init__(self, command_name, duration_micros=1000):
+        self.command_name = command_name
+        self.duration_micros = duration_micros
+
+def test_metrics_records_request_latency(client):
+    client.get("/")
+    response = client.get("/metrics")
+    assert response.mimetype == "text/plain"
+    text = response.data.decode()
+    assert 'splitsmart_http_request_duration_seconds_count{endpoint="base",method="GET"}' in text
+    assert 'splitsmart_http_requests_total{endpoint="base",method="GET",status="200"}' in text
+
+def test_command_listener_attributes_commands_to_request():
+    registry = Metrics()
+    listener = MongoCommandListener(registry)
+    stats, token = registry.start_request("groups")
+    listener.succeeded(FakeCommandEvent("find", 2000))
+    listener.failed(FakeCommandEvent("update", 500))
+    registry.finish_request(stats, token, "GET", 200)
+    listener.succeeded(FakeCommandEvent("ping"))
+
+    assert stats.commands == 2
+    assert registry.command_duration.count("groups", "find") == 1
+    assert registry.command_failures.value("groups", "update") == 1
+    assert registry.command_duration.count("background", "ping") == 1
+    assert 'splitsmart_mongo_commands_per_request_bucket{endpoint="groups",le="2"} 1' in registry.render()
+
+def test_run_concurrently_counts_commands_against_request():
+    registry = Metrics()
+    stats, token = registry.start_request("group_details")
+    app.run_concurrently(
+        lambda: registry.record_command("find", 0.001),
+        lambda: registry.record_command("find", 0.001)
+    )
+    registry.finish_request(stats, token, "GET", 200)
+    assert stats.commands == 2
+
+def test_heavy_request_logs_warning(caplog):
+    registry = Metrics(command_warn_threshold=3)
+    stats, token = registry.start_request("groups")
+    for _ in range(4):
+        registry.record_command("find", 0.001)
+    registry.finish_request(stats, token, "GET", 200)
+    assert "GET groups issued 4 Mongo commands" in caplog.text
+    assert registry.heavy_requests.value("groups") == 1
+
+
+### CONNECTION TESTS ###
+
+def test_readiness(client, monkeypatch):
+    monkeypatch.setattr(app, "indexes_ready", threading.Event())
+    assert client.get("/readyz").json == {"ready": True, "indexes": True}
+
+    class DownDatabase:
+        def command(self, name):
+            raise ConnectionError("no servers available")
+
+    monkeypatch.setattr(app, "mydb", DownDatabase())
+    response = client.get("/readyz")
+    assert response.status_code == 503
+    assert response.json["ready"] is False
+
+def test_client_options_from_environment():
+    assert mongo.client_options({
+        "MONGO_MAX_POOL_SIZE": "50", "MONGO_WAIT_QUEUE_TIMEOUT_MS": "2000", "MONGO_MIN_POOL_SIZE": ""
+    }) == {"maxPoolSize": 50, "waitQueueTimeoutMS": 2000}
+
+def test_lazy_mongo_connects_once_per_process(monkeypatch):
+    created = []
+    monkeypatch.setattr(mongo, "MongoClient", lambda uri, **options: created.append(uri) or mongomock.MongoClient())
+    connected = []
+    lazy = mongo.LazyMongo("mongodb://db", "splitsmart", on_connect=connected.append)
+    users = lazy.collection("USERS")
+    assert created == []
+
+    users.insert_one({"name": "a"})
+    assert lazy.db()["USERS"].count_documents({}) == 1
+    assert len(created) == 1 and len(connected) == 1
+
+    # A forked worker sees a different pid and opens its own client
+    monkeypatch.setattr(mongo.os, "getpid", lambda: -1)
+    users.count_documents({})
+    assert len(created) == 2
+
+
+### CURRENT USER TESTS ###
+
+@pytest.fixture
+def user_version_cache(monkeypatch):
+    """Turn the groups_version cache on for one test, starting empty."""
+    monkeypatch.setattr(app, "user_version_cache", LRUCache())
+    yield app.user_version_cache
+
+def test_current_user_loads_once_without_password(test_user, mongo_commands):
+    with app.app.test_request_context():
+        app.session["username"] = test_user["name"]
+        user = app.current_user()
+        assert app.current_user() is user
+    assert "password" not in user
+    assert user["_id"] == str(test_user["_id"])
+    assert mongo_commands == [("USERS", "find_one")]
+
+def test_session_user_skips_users_lookup(client, logged_in_user, trip_group, user_version_cache, mongo_commands):
+    client.get("/groups")
+    mongo_commands.clear()
+    response = client.get("/groups")
+    assert b"Trip Group" in response.data
+    assert ("USERS", "find_one") not in mongo_commands
+
+def test_stale_session_user_is_reloaded_in_one_read(client, logged_in_user, test_user, trip_group, user_version_cache, mongo_commands):
+    client.get("/groups")
+    app.col_users.update_one({"_id": test_user["_id"]}, {"$inc": {"groups_version": 1}})
+    user_version_cache.clear()
+    mongo_commands.clear()
+    assert b"Trip Group" in client.get("/groups").data
+    assert mongo_commands.count(("USERS", "find_one")) == 1
+    assert user_version_cache.get(test_user["name"]) == test_user.get("groups_version", 0) + 1
+
+def test_new_group_invalidates_session_user(client, logged_in_user, test_user, other_users, user_version_cache):
+    client.get("/groups")
+    client.post("/create-group", data={"group_name": "Fresh Group", "members": other_users[0]}, follow_redirects=True)
+    assert b"Fresh Group" in client.get("/groups").data
+    app.col_groups.delete_many({"group_name": "Fresh Group"})
+
+def test_session_user_not_stored_for_long_group_lists(client, logged_in_user, many_groups, monkeypatch):
+    monkeypatch.setattr(app, "SESSION_MAX_GROUPS", 2)
+    client.get("/groups")
+    with client.session_transaction() as sess:
+        assert "user" not in sess
+
+
+### DASHBOARD TESTS ###
+
+def test_balance_dashboard_uses_one_query(client, logged_in_user, trip_group, test_group, mongo_commands):
+    app.col_groups.update_one(
+        {"_id": trip_group["_id"]},
+        {"$set": {"balances": {"testuser": -12.5, "alice": 20, "bob": -7.5}}}
+    )
+    app.col_groups.update_one({"_id": test_group["_id"]}, {"$set": {"balances": {"testuser": 30}}})
+
+    mongo_commands.clear()
+    response = client.get("/api/v1/dashboard")
+    assert mongo_commands == [("GROUPS", "aggregate")]
+    assert response.json["groups"] == [
+        {"group_id": test_group["_id"], "group_name": "Test Group", "balance": 30},
+        {"group_id": trip_group["_id"], "group_name": "Trip Group", "balance": -12.5},
+    ]
+    assert (response.json["owed"], response.json["owes"], response.json["net"]) == (30, 12.5, 17.5)
+
+def test_home_shows_balances(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"], amount="40")
+    response = client.get("/main")
+    assert b"You are owed $20.00" in response.data
+    assert b"Overall you are owed <strong>$20.00</strong>" in response.data
+
+def test_balance_dashboard_without_groups(client, logged_in_user):
+    assert client.get("/api/v1/dashboard").json["groups"] == []
+    assert b"You are not part of any groups yet." in client.get("/main").data
+
+
+### FRAGMENT CACHE TESTS ###
+
+@pytest.fixture
+def fragment_cache(monkeypatch):
+    """Turn the expense-list fragment cache on for one test, starting empty."""
+    monkeypatch.setattr(app, "fragment_cache", LRUCache())
+    yield app.fragment_cache
+
+def test_group_details_reuses_expense_fragment(client, logged_in_user, trip_group, fragment_cache, mongo_commands):
+    post_trip_expense(client, trip_group["_id"])
+    client.get(f"/group/{trip_group['_id']}")
+    mongo_commands.clear()
+    response = client.get(f"/group/{trip_group['_id']}")
+    assert b"Groceries" in response.data
+    assert ("EXPENSES", "find") not in mongo_commands
+
+def test_write_renders_new_fragment(client, logged_in_user, trip_group, fragment_cache):
+    client.get(f"/group/{trip_group['_id']}")
+    post_trip_expense(client, trip_group["_id"])
+    response = client.get(f"/group/{trip_group['_id']}")
+    assert b"Groceries" in response.data
+    assert b"No expenses added yet" not in response.data
+
+def test_fragment_cache_keyed_by_version(trip_group, fragment_cache):
+    with app.app.test_request_context():
+        first = app.render_expense_list(trip_group["_id"], 1)
+        insert_expenses(trip_group["_id"], 1)
+        assert app.render_expense_list(trip_group["_id"], 1) == first
+        assert "Expense 0" in app.render_expense_list(trip_group["_id"], 2)
+
+def test_fragment_for_new_version_ignores_stale_expense_page(client, logged_in_user, trip_group, fragment_cache, group_cache):
+    client.get(f"/group/{trip_group['_id']}")
+    other_worker_expense(trip_group["_id"])
+
+    with app.app.test_request_context():
+        version, event = app.group_snapshot(trip_group["_id"], 0)
+    assert version == 1 and "Elsewhere" in event
+    # Once the cached summary expires the page asks for version 1 as well
+    group_cache.delete(("summary", trip_group["_id"]))
+    assert b"Elsewhere" in client.get(f"/group/{trip_group['_id']}").data
+
+def test_expense_is_in_the_ledger_before_the_version_moves(trip_group, monkeypatch):
+    seen = []
+    update_one = app.col_groups.update_one
+    def update_and_look(query, update):
+        seen.append(app.col_expenses.count_documents({"group_id": trip_group["_id"]}))
+        return update_one(query, update)
+    monkeypatch.setattr(app.col_groups, "update_one", update_and_look)
+
+    app.record_expense(trip_group["_id"], "Groceries", "4", "testuser", ["alice"], ["1"])
+    assert seen == [1]
+    with pytest.raises(ValueError):
+        app.record_expense(trip_group["_id"], "Groceries", "4", "testuser", ["mallory"], ["1"])
+    assert app.col_expenses.count_documents({"group_id": trip_group["_id"]}) == 1
+
+def test_compile_templates_command(tmp_path, monkeypatch):
+    monkeypatch.setattr(app.app.jinja_env.bytecode_cache, "directory", str(tmp_path))
+    result = app.app.test_cli_runner().invoke(args=["compile-templates"])
+    assert result.exit_code == 0
+    assert len(list(tmp_path.iterdir())) >= len(app.app.jinja_env.list_templates(extensions=["html"]))
+
+
+### COMPRESSION AND STATIC ASSET TESTS ###
+
+def test_html_is_gzipped_when_accepted(client, logged_in_user, trip_group):
+    response = client.get(f"/group/{trip_group['_id']}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert b"Trip Group" in gzip.decompress(response.data)
+
+def test_brotli_preferred_when_available(client, logged_in_user, trip_group):
+    if compression.brotli is None:
+        pytest.skip("brotli is not installed")
+    response = client.get(f"/group/{trip_group['_id']}", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["Content-Encoding"] == "br"
+    assert b"Trip Group" in compression.brotli.decompress(response.data)
+
+def test_small_or_unaccepted_responses_are_not_compressed(client, logged_in_user):
+    assert "Content-Encoding" not in client.get("/readyz", headers={"Accept-Encoding": "gzip"}).headers
+    assert "Content-Encoding" not in client.get("/main").headers
+
+def test_compressed_etag_becomes_weak(client, logged_in_user, many_groups):
+    response = client.get("/api/v1/groups", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["ETag"].startswith('W/"')
+    cached = client.get("/api/v1/groups", headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]})
+    assert cached.status_code == 304
+
+def test_static_urls_are_fingerprinted(client):
+    with app.app.test_request_context():
+        url = app.url_for("static", filename="css/style.css")
+    assert url.startswith("/static/css/style.") and url != "/static/css/style.css"
+    assert url.encode() in client.get("/login").data
+
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Cache-Control"] == compression.IMMUTABLE_CACHE_CONTROL
+    assert response.headers["Content-Encoding"] == "gzip"
+    with open(os.path.join(app.app.static_folder, "css", "style.css"), "rb") as f:
+        assert gzip.decompress(response.data) == f.read()
+
+    assert client.get(url, headers={"If-None-Match": response.headers["ETag"], "Accept-Encoding": "gzip"}).status_code == 304
+    assert client.get("/static/css/style.css").status_code == 200
+
+
+### LIVE UPDATE TESTS ###
+
+def test_broker_bounds_slow_subscribers():
+    broker = Broker(queue_size=2, max_subscribers=2)
+    fast = broker.subscribe("group")
+    slow = broker.subscribe("group")
+    with pytest.raises(BrokerFull):
+        broker.subscribe("other")
+
+    received = []
+    for event, delivered in [(1, 2), (2, 2), (3, 1), (4, 1)]:  # slow stops reading after two
+        assert broker.publish("group", event) == delivered
+        received.append(fast.get(0))
+    assert received == [1, 2, 3, 4]
+    assert slow.get(0) is OVERFLOW
+    assert slow.get(0) is None
+    assert broker.stats()["dropped"] == 2
+
+    fast.close()
+    slow.close()
+    assert not broker.has_subscribers("group")
+    assert broker.stats()["subscribers"] == 0
+
+def test_live_streams_leave_request_threads_free():
+    # Streams and password checks each hold a gthread request thread; together
+    # they must still leave one for everything else
+    bcrypt_threads = app.password_hasher.workers + app.password_hasher.max_queue
+    assert bcrypt_threads <= app.BCRYPT_SLOTS
+    assert app.broker.max_subscribers + app.BCRYPT_SLOTS < app.REQUEST_THREADS
+
+@pytest.fixture
+def live_broker(monkeypatch):
+    """A fresh broker with streams that poll quickly and end after a second."""
+    monkeypatch.setattr(app, "broker", Broker())
+    monkeypatch.setattr(app, "LIVE_UPDATES_POLL_SECONDS", 0.05)
+    monkeypatch.setattr(app, "LIVE_UPDATES_MAX_SECONDS", 1)
+    yield app.broker
+
+def read_events(response, count):
+    """Parse the first ``count`` named events off a Server-Sent Events response, then close it."""
+    events = []
+    for chunk in response.response:
+        fields = dict(line.split(": ", 1) for line in chunk.decode().splitlines() if ": " in line)
+        if "event" in fields:
+            events.append((fields["event"], int(fields["id"]), json.loads(fields["data"])))
+            if len(events) == count:
+                break
+    response.close()
+    return events
+
+def test_group_events_stream_writes(client, logged_in_user, trip_group, live_broker):
+    response = client.get(f"/group/{trip_group['_id']}/events")
+    assert response.mimetype == "text/event-stream"
+    assert live_broker.has_subscribers(trip_group["_id"])
+
+    # Written through the app's helpers: a request made now would push its
+    # context on top of the stream's, which a server never does
+    group_id = trip_group["_id"]
+    expense_id = app.record_expense(group_id, "Groceries", 90, "testuser", ["testuser", "alice", "bob"], [0.5, 0.25, 0.25])["_id"]
+    app.remove_expense(expense_id)
+    app.col_groups.update_one({"_id": group_id}, {"$set": {"balances.testuser": -10, "balances.alice": 10}})
+    app.record_settlement(group_id, "testuser", 10)
+
+    added, deleted, settled = read_events(response, 3)
+    assert added[:2] == ("expense_added", 1)
+    assert added[2]["balances"] == {"testuser": 45, "alice": -22.5, "bob": -22.5}
+    assert added[2]["changes"] == {"testuser": 45, "alice": -22.5, "bob": -22.5}
+    assert added[2]["expense"]["expense_id"] == expense_id
+    assert added[2]["settlements"] == [
+        {"from": "alice", "to": "testuser", "amount": 22.5}, {"from": "bob", "to": "testuser", "amount": 22.5}
+    ]
+    assert deleted[:2] == ("expense_deleted", 2)
+    assert deleted[2]["balances"] == {"testuser": 0, "alice": 0, "bob": 0}
+    assert settled[0] == "settlement"
+    assert settled[2]["balances"] == {"testuser": 0, "alice": 0, "bob": 0}
+    assert settled[2]["expense"]["split_among"] == [{"name": "alice", "amount": 10}]
+
+    assert not live_broker.has_subscribers(trip_group["_id"])
+
+def test_group_events_snapshot_after_missed_writes(client, logged_in_user, trip_group, live_broker):
+    # A write this worker never published, as if another worker made it
+    api_trip_expense(client, trip_group["_id"])
+    response = client.get(f"/group/{trip_group['_id']}/events", headers={"Last-Event-ID": "0"})
+    name, version, snapshot = read_events(response, 1)[0]
+    assert (name, version) == ("snapshot", 1)
+    assert snapshot["balances"]["testuser"] == 45
+    assert "Groceries" in snapshot["expense_list"]
+
+def test_group_events_unsubscribe_when_body_is_never_read(client, logged_in_user, trip_group, live_broker):
+    response = client.head(f"/group/{trip_group['_id']}/events")
+    assert response.status_code == 200
+    response.close()
+    assert not live_broker.has_subscribers(trip_group["_id"])
+
+    response = client.get(f"/group/{trip_group['_id']}/events")
+    assert live_broker.has_subscribers(trip_group["_id"])
+    response.close()
+    assert not live_broker.has_subscribers(trip_group["_id"])
+
+def test_group_events_requires_membership(client, logged_in_user, trip_group, live_broker):
+    app.col_groups.update_one({"_id": trip_group["_id"]}, {"$pull": {"group_members": "testuser"}})
+    assert client.get(f"/group/{trip_group['_id']}/events").status_code == 404
+    assert not live_broker.has_subscribers(trip_group["_id"])
+
+def test_group_page_subscribes_to_events(client, logged_in_user, trip_group):
+    response = client.get(f"/group/{trip_group['_id']}")
+    assert f"/group/{trip_group['_id']}/events".encode() in response.data
+    assert b'data-member="alice"' in response.data
+
+
+### RATE LIMIT TESTS ###
+
+def test_token_bucket_refills_over_time():
+    now = [0.0]
+    limiter = RateLimiter("test", 2, 10, MemoryBackend(timer=lambda: now[0]))
+    limiter.hit("1.2.3.4")
+    limiter.hit("1.2.3.4")
+    with pytest.raises(RateLimited) as throttled:
+        limiter.hit("1.2.3.4")
+    assert throttled.value.retry_after == pytest.approx(5)
+    limiter.hit("5.6.7.8")  # every key has its own bucket
+
+    now[0] = 5
+    limiter.hit("1.2.3.4")
+    assert (limiter.allowed, limiter.throttled) == (4, 1)
+
+def test_memory_backend_is_bounded():
+    backend = MemoryBackend(maxsize=2)
+    for key in ("a", "b", "c"):
+        backend.take(key, 1, 1)
+    assert len(backend) == 2
+
+@pytest.fixture
+def rate_limits(monkeypatch):
+    """Turn the rate limits on for one test, with empty buckets."""
+    backend = MemoryBackend()
+    for limiter in app.rate_limiters.values():
+        monkeypatch.setattr(limiter, "enabled", True)
+        monkeypatch.setattr(limiter, "backend", backend)
+    yield app.rate_limiters
+
+def test_rate_limit_backend_must_implement_take():
+    class Incomplete(RateLimitBackend):
+        def clear(self):
+            pass
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_login_throttled_before_database_and_bcrypt(client, rate_limits, mongo_commands, monkeypatch):
+    monkeypatch.setattr(rate_limits["login_ip"], "capacity", 2)
+    for _ in range(2):
+        client.post("/login", data={"username": "nobody", "password": "x"})
+    mongo_commands.clear()
+    monkeypatch.setattr(app.password_hasher, "verify", lambda *args: pytest.fail("bcrypt ran"))
+
+    response = client.post("/login", data={"username": "nobody", "password": "x"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert mongo_commands == []
+    assert 'splitsmart_rate_limited_requests_total{limiter="login_ip"}' in client.get("/metrics").data.decode()
+    assert client.get("/rate-limit-stats").json["login_ip"]["throttled"] >= 1
+
+def test_login_limited_per_username_across_addresses(client, rate_limits):
+    statuses = [
+        client.post(
+            "/login", data={"username": "victim", "password": "guess"},
+            environ_base={"REMOTE_ADDR": f"10.0.0.{i}"}
+        ).status_code
+        for i in range(rate_limits["login_user"].capacity + 1)
+    ]
+    assert statuses[-1] == 429 and 429 not in statuses[:-1]
+
+def test_check_user_throttled_with_json(client, rate_limits, monkeypatch):
+    monkeypatch.setattr(rate_limits["check_user_ip"], "capacity", 1)
+    assert client.get("/check-user?username=someone").status_code == 200
+    response = client.post("/check-users", json={"usernames": ["someone"]})
+    assert response.status_code == 429
+    assert response.json["success"] is False
+
+def test_registration_throttled(client, test_user, rate_limits, monkeypatch):
+    monkeypatch.setattr(rate_limits["registration_ip"], "capacity", 1)
+    client.post("/registration", data={"username": "testuser", "password": "x"})
+    assert client.post("/registration", data={"username": "testuser", "password": "x"}).status_code == 429
+    assert client.get("/registration").status_code == 200
+
+
+### SPLIT ENGINE TESTS ###
+
+def test_equal_split_keeps_every_cent():
+    assert splits.split_amount(100, ["a", "b", "c"], "equal") == [34, 33, 33]
+    assert splits.split_amount(1, ["a", "b"], "equal") == [1, 0]
+
+def test_largest_remainder_goes_to_largest_fractions():
+    # Exact shares are 33.33, 16.67 and 50.0 cents
+    assert splits.split_amount(100, ["a", "b", "c"], "shares", ["2", "1", "3"]) == [33, 17, 50]
+    total = 123457
+    shares = splits.split_amount(total, [f"m{i}" for i in range(997)], "shares", [i % 7 + 1 for i in range(997)])
+    assert sum(shares) == total
+
+def test_percentages_are_summed_exactly():
+    # As floats, 0.1 + 0.2 + 0.7 is 1.0000000000000002
+    assert splits.split_amount(1000, ["a", "b", "c"], "percentage", ["0.1", "0.2", "0.7"]) == [100, 200, 700]
+    with pytest.raises(splits.SplitError, match="must sum to 1.0"):
+        splits.split_amount(1000, ["a", "b"], "percentage", ["0.5", "0.4"])
+
+def test_exact_split_must_match_total():
+    assert splits.split_amount(1000, ["a", "b"], "exact", ["2.50", "7.50"]) == [250, 750]
+    with pytest.raises(splits.SplitError, match="add up to the expense amount"):
+        splits.split_amount(1000, ["a", "b"], "exact", ["2.50", "7"])
+
+@pytest.mark.parametrize("mode, members, values", [
+    ("thirds", ["a"], None),
+    ("shares", ["a", "b"], ["1"]),
+    ("shares", ["a", "a"], ["1", "1"]),
+    ("shares", ["a", "b"], ["1", "-1"]),
+    ("shares", ["a", "b"], ["0", "0"]),
+    ("exact", ["a"], ["ten"]),
+    ("exact", ["a"], ["1E+999999"]),
+    ("shares", ["a", "b"], ["1", "1E-999999"]),
+    ("percentage", ["a", "b"], ["0.5", "0.5000001"]),
+    ("equal", [], None),
+])
+def test_invalid_splits_rejected(mode, members, values):
+    with pytest.raises(splits.SplitError):
+        splits.split_amount(1000, members, mode, values)
+
+def test_balance_deltas_credit_payer_exactly():
+    assert splits.balance_deltas("a", {"a": 34, "b": 33, "c": 33}) == {"b": -33, "c": -33, "a": 66}
+    assert splits.balance_deltas("a", {"a": 100}) == {"a": 0}
+
+def test_add_expense_equal_split(client, logged_in_user, trip_group):
+    client.post("/add-expense", data={
+        "group_id": trip_group["_id"],
+        "description": "Taxi",
+        "amount": "10",
+        "paid_by": "testuser",
+        "split_with[]": ["testuser", "alice", "bob"],
+        "split_mode": "equal"
+    })
+    expense = app.col_expenses.find_one({"group_id": trip_group["_id"]})
+    assert expense["split_among"] == {"testuser": 3.34, "alice": 3.33, "bob": 3.33}
+    assert stored_balances(trip_group["_id"]) == {"testuser": 6.66, "alice": -3.33, "bob": -3.33}
+
+def test_api_add_expense_exact_split(client, logged_in_user, trip_group):
+    response = client.post(f"/api/v1/groups/{trip_group['_id']}/expenses", json={
+        "description": "Dinner", "amount": "42.10", "split_with": ["alice", "bob"],
+        "split_mode": "exact", "split_values": ["30", "12.10"]
+    })
+    assert response.status_code == 201
+    assert stored_balances(trip_group["_id"]) == {"testuser": 42.1, "alice": -30, "bob": -12.1}
+
+    response = client.post(f"/api/v1/groups/{trip_group['_id']}/expenses", json={
+        "description": "Dinner", "amount": 5, "split_with": ["alice"], "split_mode": "shares"
+    })
+    assert response.json["message"] == "Missing field: split_values"
+
+def test_import_split_modes(client, logged_in_user, trip_group):
+    body = (
+        'description,amount,paid_by,split_with,split_mode,split_values\n'
+        'Hotel,300,testuser,"testuser,alice,bob",shares,"2,1,1"\n'
+        'Snacks,1,alice,"alice,bob,testuser",equal,\n'
+    )
+    response = client.post(
+        f"/api/v1/groups/{trip_group['_id']}/expenses/import", data=body,
+        content_type="text/csv", buffered=True
+    )
+    assert json.loads(response.data.splitlines()[-1]) == {"imported": 2, "failed": 0}
+    assert stored_balances(trip_group["_id"]) == {"testuser": 149.67, "alice": -74.34, "bob": -75.33}
+
+def test_out_of_range_numbers_are_rejected_not_crashed_on(client, logged_in_user, trip_group):
+    assert api_trip_expense(client, trip_group["_id"], amount=1e30).status_code == 400
+    response = client.post(f"/api/v1/groups/{trip_group['_id']}/expenses", json={
+        "description": "Groceries", "amount": 90, "split_with": ["testuser", "alice"],
+        "split_mode": "shares", "split_values": ["0E-999999", "1E-999999"]
+    })
+    assert response.status_code == 400
+
+    body = (
+        'description,amount,paid_by,split_with,split_mode,split_values\n'
+        'Huge,1e30,testuser,"testuser,alice",equal,\n'
+        'Tiny,10,testuser,"testuser,alice",shares,"1,1E-999999"\n'
+        'Fine,10,testuser,"testuser,alice",equal,\n'
+    )
+    response = client.post(
+        f"/api/v1/groups/{trip_group['_id']}/expenses/import", data=body,
+        content_type="text/csv", buffered=True
+    )
+    assert json.loads(response.data.splitlines()[-1]) == {"imported": 1, "failed": 2}
+
+### ARCHIVE TESTS ###
+
+def run_archive(days=365):
+    # Archive as if a few minutes have passed, so entries just written count as settled in
+    return archive.archive_expenses(
+        app.mydb, datetime.timedelta(days=days),
+        now=datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+    )
+
+def test_archive_moves_old_entries_behind_summary(client, logged_in_user, trip_group, no_snapshot_age):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    post_trip_expense(client, trip_group["_id"], amount="40")
+    app.col_expenses.update_many(
+        {"group_id": trip_group["_id"]},
+        {"$set": {"created_at": datetime.datetime(2023, 5, 1)}}
+    )
+    ledger.snapshot_group(app.mydb, trip_group["_id"])
+    post_trip_expense(client, trip_group["_id"], amount="20")
+
+    summaries = [summary for summary in run_archive() if summary["group_id"] == trip_group["_id"]]
+    assert len(summaries) == 1
+    summary = summaries[0]
+    assert (summary["entries"], summary["amount"]) == (2, 100.0)
+    assert summary["balance_deltas"] == {"testuser": 50.0, "alice": -25.0, "bob": -25.0}
+    assert app.col_archive.count_documents({"archive_id": summary["_id"]}) == 2
+    assert app.col_expenses.count_documents({"group_id": trip_group["_id"]}) == 2
+    # The snapshot covered archived entries, so replaying from it would count them twice
+    assert app.mydb["BALANCE_SNAPSHOTS"].count_documents({"group_id": trip_group["_id"]}) == 0
+    assert ledger.recompute_balances(app.mydb, trip_group["_id"]) == stored_balances(trip_group["_id"])
+
+    # The group page shows the summary; the entries load only when asked for
+    response = client.get(f"/group/{trip_group['_id']}")
+    assert b"2 archived entries" in response.data
+    assert b"2023-05-01 to 2023-05-01" in response.data
+    assert response.data.count(b'class="delete-expense-button"') == 1
+    response = client.get(f"/group/{trip_group['_id']}/archive/{summary['_id']}")
+    assert response.data.count(b"Groceries") == 2
+    assert client.delete(f"/delete-expense/{summary['_id']}").status_code == 404
+
+    with client.session_transaction() as sess:
+        sess["username"] = "mallory"
+    assert client.get(f"/group/{trip_group['_id']}/archive/{summary['_id']}").status_code == 404
+
+def test_archive_takes_entries_behind_settled_point(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    for debtor in ("alice", "bob"):
+        with client.session_transaction() as sess:
+            sess["username"] = debtor
+        client.post(f"/api/v1/groups/{trip_group['_id']}/settlements", json={"amount": 15})
+    with client.session_transaction() as sess:
+        sess["username"] = "testuser"
+    post_trip_expense(client, trip_group["_id"], amount="40")
+
+    # Everyone was square after the settlement, so only the last expense stays
+    summary = next(summary for summary in run_archive() if summary["group_id"] == trip_group["_id"])
+    assert summary["entries"] == 3
+    assert summary["balance_deltas"] == {}
+    assert [entry.get("kind") for entry in app.col_expenses.find({"group_id": trip_group["_id"]})] \
+        .count("archive_summary") == 1
+    assert not [summary for summary in run_archive() if summary["group_id"] == trip_group["_id"]]
+
+    # The export still lists every entry, archived ones first, and no summary rows
+    response = client.get(f"/api/v1/groups/{trip_group['_id']}/export?format=ndjson", buffered=True)
+    types = [line["type"] for line in import_lines(response)]
+    assert types == ["expense", "settlement", "settlement", "expense", "balance", "balance", "balance"]
+
+def test_archive_run_stopped_before_deleting_is_finished_next_time(client, logged_in_user, trip_group):
+    post_trip_expense(client, trip_group["_id"], amount="60")
+    app.col_expenses.update_many({"group_id": trip_group["_id"]}, {"$set": {"created_at": datetime.datetime(2023, 5, 1)}})
+    summary = next(summary for summary in run_archive() if summary["group_id"] == trip_group["_id"])
+    # As if the run had stopped between writing the summary and deleting the originals
+    app.col_expenses.insert_many(app.col_archive.find({"archive_id": summary["_id"]}, archive.ARCHIVED_FIELDS))
+
+    assert not [summary for summary in run_archive() if summary["group_id"] == trip_group["_id"]]
+    assert app.col_expenses.count_documents({"group_id": trip_group["_id"]}) == 1
+    assert ledger.recompute_balances(app.mydb, trip_group["_id"]) == stored_balances(trip_group["_id"])
+
+def test_archive_pages_archived_entries(client, logged_in_user, test_group):
+    insert_expenses(test_group["_id"], 25)
+    summary = next(summary for summary in run_archive() if summary["group_id"] == test_group["_id"])
+    assert summary["entries"] == 25
+    expenses, next_cursor = app.list_archived_expenses(test_group["_id"], summary["_id"])
+    assert [expense["description"] for expense in expenses[:2]] == ["Expense 24", "Expense 23"]
+    expenses, next_cursor = app.list_archived_expenses(test_group["_id"], summary["_id"], before=next_cursor)
+    assert len(expenses) == 5 and next_cursor is None
+    app.col_archive.delete_many({"group_id": test_group["_id"]})
+
+def test_import_sums_batch_deltas_in_cents(client, logged_in_user, trip_group):
+    body = "description,amount,paid_by,split_with,split_mode,split_values\n" + "Gum,0.1,testuser,alice,exact,0.1\n" * 3
+    client.post(
+        f"/api/v1/groups/{trip_group['_id']}/expenses/import", data=body,
+        content_type="text/csv", buffered=True
+    )
+    assert stored_balances(trip_group["_id"]) == {"testuser": 0.3, "alice": -0.3, "bob": 0}
+
+def test_to_cents_rounds_half_up_everywhere():
+    assert settlement.to_cents is splits.to_cents
+    assert splits.to_cents(0.125) == 13
@@ -0,0 +1,9 @@
+"""WSGI entry point for production servers.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+See gunicorn.conf.py for the worker and thread settings.
+"""
+from app import create_app
+
+app = create_app()